@@ -1,243 +1,2537 @@
+from __future__ import annotations
+
+import time
+
+# 进程启动时间，用于统计启动各阶段耗时
+_PROCESS_START = time.time()
+
 import os
 import sys
+import re
 import json
-import time
-import requests
-from typing import Dict
+import importlib
+import queue
+import sqlite3
+import asyncio
+import random
+import hashlib
+import threading
+import contextvars
+import uuid
+import weakref
+import shutil
+import socket
+import struct
+import multiprocessing
+from array import array
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+from urllib.parse import urlparse, parse_qs
+
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只使用进程内的锁
+    fcntl = None
 
-import yt_dlp
-from faster_whisper import WhisperModel
+try:
+    import resource
+except ImportError:  # Windows 上没有 resource，不统计峰值内存
+    resource = None
+
+import httpx
 from dotenv import load_dotenv
 from datetime import datetime
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import Context, FastMCP
+
+import whisper_worker
 
 # 加载环境变量
 load_dotenv()
 
+# 启动配置：fast 延迟导入重量级依赖，端口立即可用；warm 在后台预加载模型并试解码，完成后才标记就绪
+STARTUP_PROFILE = os.getenv("STARTUP_PROFILE", "fast")
+STARTUP_METRICS: Dict = {"profile": STARTUP_PROFILE, "phases": {}, "imports": {}}
+SERVER_READY = threading.Event()
+
+
+class LazyModule:
+    """首次访问属性时才导入的模块代理，用于推迟 yt-dlp、faster-whisper 等重量级依赖的导入"""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    start = time.time()
+                    module = importlib.import_module(self._name)
+                    STARTUP_METRICS["imports"][self._name] = round(time.time() - start, 3)
+                    self._module = module
+        return self._module
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+class LazyObject:
+    """首次访问属性时才创建的全局对象代理
+
+    结果缓存、任务库、检索索引、暂存区等全局对象创建时会打开数据库、执行迁移或扫描目录；
+    推迟到首次使用，导入本模块（包括 spawn 子进程重新执行主模块）时没有这些副作用。
+    """
+
+    def __init__(self, factory: Callable):
+        self._lazy_factory = factory
+        self._lazy_instance = None
+        self._lazy_lock = threading.Lock()
+
+    def load(self):
+        if self._lazy_instance is None:
+            with self._lazy_lock:
+                if self._lazy_instance is None:
+                    self._lazy_instance = self._lazy_factory()
+        return self._lazy_instance
+
+    def __getattr__(self, attr: str):
+        return getattr(self.load(), attr)
+
+
+np = LazyModule("numpy")
+av = LazyModule("av")
+yt_dlp = LazyModule("yt_dlp")
+requests = LazyModule("requests")
+faster_whisper = LazyModule("faster_whisper")
+faster_whisper_vad = LazyModule("faster_whisper.vad")
 
 
 # 定义常量
-API_BASE = "https://api.siliconflow.cn/v1"
+API_BASE = os.getenv("API_BASE", "https://api.siliconflow.cn/v1")
 API_KEY = os.getenv("OPENAI_API_KEY", "sk-")
 MCP_PORT =  int(os.getenv("MCP_PORT", 8001))
 MODEL_NAME = "Qwen/Qwen3-8B"
 DEFAULT_OUTPUT_DIR = "downloads"
 DEFAULT_MODEL_DIR = "models"
-WHISPER_MODEL_SIZE = "tiny"  # 固定使用tiny模型
+WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL_SIZE", "tiny")
+WHISPER_COMPUTE_TYPE = "int8"
+WHISPER_DEVICE = "cpu"
+
+# 模型文件与下载配置
+MODEL_FILES = ["model.bin", "config.json", "tokenizer.json", "vocabulary.txt"]
+# 不在 guillaumekln 仓库中的模型大小：模型大小 -> (仓库, 文件列表)
+MODEL_REPOS = {
+    "large-v3": (
+        "Systran/faster-whisper-large-v3",
+        ["model.bin", "config.json", "preprocessor_config.json", "tokenizer.json", "vocabulary.json"],
+    ),
+}
+MODEL_MANIFEST_NAME = ".manifest.json"
+MODEL_MIRROR = os.getenv("MODEL_MIRROR", "")
+MODEL_DOWNLOAD_CHUNK = 1024 * 1024  # 1 MB
+
+# 解码参数：beam_size=1 为贪心解码（更快），>1 为束搜索（质量更好）
+WHISPER_LANGUAGE = os.getenv("WHISPER_LANGUAGE", "zh")
+WHISPER_BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", 5))
+# 解码引擎：sequential 逐段解码；batched 先用 VAD 切分语音段，再按 WHISPER_BATCH_SIZE 成批解码
+WHISPER_ENGINE = os.getenv("WHISPER_ENGINE", "sequential")
+WHISPER_BATCH_SIZE = int(os.getenv("WHISPER_BATCH_SIZE", 8))
+# 是否输出逐词时间戳（顺序转录时保存在转录结果中，会增加转录耗时）
+WHISPER_WORD_TIMESTAMPS = os.getenv("WHISPER_WORD_TIMESTAMPS", "false").lower() in ("1", "true", "yes")
+
+# 模型池配置：每个模型最多常驻的副本数、内存上限（字节，0 表示不限）、空闲淘汰时间（秒，0 表示不淘汰）
+WHISPER_POOL_REPLICAS = int(os.getenv("WHISPER_POOL_REPLICAS", 1))
+WHISPER_POOL_MAX_BYTES = int(os.getenv("WHISPER_POOL_MAX_BYTES", 0))
+WHISPER_POOL_IDLE_TTL = float(os.getenv("WHISPER_POOL_IDLE_TTL", 0))
+
+# 各流水线阶段的并发上限，阻塞任务在对应线程池中执行，不占用事件循环
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", 4))
+# 音频格式策略：asr 选择满足最低码率的最小音频流（Whisper 只用 16 kHz 单声道），best 选择最高码率
+AUDIO_FORMAT_POLICY = os.getenv("AUDIO_FORMAT_POLICY", "asr")
+AUDIO_MIN_ABR = int(os.getenv("AUDIO_MIN_ABR", 48))  # kbps
+# 分片（DASH/HLS 分段）流的并发下载数
+DOWNLOAD_FRAGMENTS = int(os.getenv("DOWNLOAD_FRAGMENTS", 4))
+# 字幕策略：prefer 在视频有字幕（UP主字幕或 AI 字幕）时直接使用，跳过下载与转录；off 始终转录音频
+SUBTITLE_POLICY = os.getenv("SUBTITLE_POLICY", "prefer")
+SUBTITLE_LANGS = [lang.strip() for lang in os.getenv(
+    "SUBTITLE_LANGS", "zh-CN,zh-Hans,zh-Hant,zh-HK,zh-TW,ai-zh,zh"
+).split(",") if lang.strip()]
+# yt-dlp 使用的 Cookie 文件（Netscape 格式），B站字幕通常需要登录后才能获取
+BILIBILI_COOKIES = os.getenv("BILIBILI_COOKIES", "")
+TRANSCRIBE_CONCURRENCY = int(os.getenv("TRANSCRIBE_CONCURRENCY", WHISPER_POOL_REPLICAS))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", 8))
+# LLM 请求超时（秒）与 429/5xx 的最大重试次数
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", 10))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", 300))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 3))
+# stream 模式下请求接口在最后一个数据块返回 usage（stream_options.include_usage），不支持该参数的接口可关闭
+LLM_STREAM_USAGE = os.getenv("LLM_STREAM_USAGE", "true").lower() in ("1", "true", "yes")
+# 每个模型副本的 CTranslate2 计算线程数，默认按并发转录数均分 CPU 核心
+WHISPER_CPU_THREADS = int(os.getenv(
+    "WHISPER_CPU_THREADS", max(1, (os.cpu_count() or 1) // max(1, TRANSCRIBE_CONCURRENCY))
+))
+
+# 转录采样率：faster-whisper 需要 16 kHz 单声道 float32 PCM
+AUDIO_SAMPLE_RATE = 16000
+# 解码后的 PCM 是否落盘为内存映射文件（长视频可降低常驻内存），默认直接保存在内存中
+AUDIO_PCM_MMAP = os.getenv("AUDIO_PCM_MMAP", "false").lower() in ("1", "true", "yes")
+
+# 转录模式：file 先下载完整音频再转录；stream 边下载边解码，按静音切分的窗口逐段转录
+TRANSCRIBE_MODE = os.getenv("TRANSCRIBE_MODE", "file")
+STREAM_WINDOW_SECONDS = float(os.getenv("STREAM_WINDOW_SECONDS", 60))
+STREAM_BLOCK_SECONDS = 5.0
+
+# 长音频并行转录：超过阈值的音频在静音处切块，由进程池中每个进程各自持有一个模型并行转录
+LONG_AUDIO_SECONDS = float(os.getenv("LONG_AUDIO_SECONDS", 1200))
+LONG_AUDIO_CHUNK_SECONDS = float(os.getenv("LONG_AUDIO_CHUNK_SECONDS", 300))
+LONG_AUDIO_WORKERS = int(os.getenv("LONG_AUDIO_WORKERS", max(1, (os.cpu_count() or 1) // 2)))
+
+# 长转录分段总结：超过 NOTES_CHUNK_TOKENS 的转录按窗口并发总结后再汇总
+NOTES_CHUNK_TOKENS = int(os.getenv("NOTES_CHUNK_TOKENS", 6000))
+NOTES_MAP_CONCURRENCY = int(os.getenv("NOTES_MAP_CONCURRENCY", 4))
+# 提示词中的转录按段落合并，每段只标注一次起始时间；段落最长 NOTES_PARAGRAPH_SECONDS 秒
+NOTES_PARAGRAPH_SECONDS = float(os.getenv("NOTES_PARAGRAPH_SECONDS", 30))
+
+# 结果缓存配置：过期时间（秒，0 表示永不过期）与容量上限（字节）
+CACHE_DB = os.getenv("CACHE_DB", os.path.join("cache", "results.db"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", 7 * 24 * 3600))
+CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 512 * 1024 * 1024))
+
+# 转录全文检索索引（SQLite FTS5），不随结果缓存过期或淘汰
+SEARCH_DB = os.getenv("SEARCH_DB", os.path.join("cache", "search.db"))
+
+# 批量处理：同时在流水线中的视频数（下载、转录、生成笔记各阶段交错执行）与单次批量的视频数上限
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", 3))
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 50))
+
+# 本地暂存区：请求的临时下载目录、保留的音频与任务目录都放在这里，总大小受字节预算约束
+SCRATCH_DIR = os.getenv("SCRATCH_DIR", "scratch")
+SCRATCH_MAX_BYTES = int(os.getenv("SCRATCH_MAX_BYTES", 2 * 1024 * 1024 * 1024))
+# 转录完成后保留音频，同一视频再次请求时跳过下载（超出预算时按最久未使用淘汰）
+SCRATCH_RETAIN_AUDIO = os.getenv("SCRATCH_RETAIN_AUDIO", "false").lower() in ("1", "true", "yes")
+
+# 阶段耗时日志：每个阶段结束时写一行 JSON，"-" 表示输出到标准输出，留空不输出
+METRICS_LOG = os.getenv("METRICS_LOG", "")
+
+# 持久化任务队列：任务与各阶段检查点存放在 SQLite 中，音频保存在任务目录直到任务完成
+JOBS_DB = os.getenv("JOBS_DB", os.path.join("cache", "jobs.db"))
+JOBS_DIR = os.getenv("JOBS_DIR", os.path.join(SCRATCH_DIR, "jobs"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 1))
+# 转录过程中保存已完成片段的最短间隔（秒）
+JOB_CHECKPOINT_INTERVAL = float(os.getenv("JOB_CHECKPOINT_INTERVAL", 30))
+# 工作进程持有任务的租约时长（秒），超时未续约的任务会被其他工作进程接手
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", 60))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 2))
+# 任务库放在网络文件系统上时需改为 DELETE，WAL 依赖共享内存，只能在同一台主机上使用
+JOBS_DB_JOURNAL_MODE = os.getenv("JOBS_DB_JOURNAL_MODE", "WAL")
+WORKER_ID = os.getenv("WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+# 部署角色：all 同一进程既提供 MCP 服务又执行任务；frontend 只负责入队和查询；
+# worker 不提供 MCP 服务，只从共享任务队列中领取任务执行
+SERVER_ROLE = os.getenv("SERVER_ROLE", "all")
 
 # 初始化FastMCP服务器
 mcp = FastMCP("bili_note_generator", port=MCP_PORT)
 
+
+class _PoolEntry:
+    """模型池中同一配置的所有副本"""
+
+    def __init__(self):
+        self.models = []      # 已加载的全部副本
+        self.idle = []        # 当前空闲的副本
+        self.loading = 0      # 正在加载中的副本数
+        self.size_bytes = 0   # 单个副本的估算内存占用
+        self.last_used = time.monotonic()
+
+
+class WhisperModelPool:
+    """进程级 Whisper 模型池
+
+    每个 (模型大小, compute_type, device) 只加载一次并常驻内存，最多保留
+    ``replicas`` 个副本供并发任务使用；超过内存上限或空闲超时的副本会被淘汰。
+    空闲超时由后台线程定期检查，服务不再收到请求时模型也会按时释放。
+    """
+
+    def __init__(self, replicas: int = 1, max_bytes: int = 0, idle_ttl: float = 0):
+        self.replicas = max(1, replicas)
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._cond = threading.Condition()
+        self._entries: Dict[Hashable, _PoolEntry] = {}
+        self._sweeper: Optional[threading.Thread] = None
+
+    @contextmanager
+    def acquire(self, key: Hashable, loader: Callable[[], object], size_bytes: int = 0):
+        """借出一个模型副本，用完自动归还；没有空闲副本且未达上限时调用 loader 加载"""
+        with self._cond:
+            entry = self._entries.setdefault(key, _PoolEntry())
+            while True:
+                if entry.idle:
+                    model = entry.idle.pop()
+                    need_load = False
+                    break
+                if len(entry.models) + entry.loading < self.replicas:
+                    entry.loading += 1
+                    need_load = True
+                    break
+                self._cond.wait()
+
+        if need_load:
+            print(f"模型池加载新副本: {key}")
+            try:
+                model = loader()
+            except BaseException:
+                with self._cond:
+                    entry.loading -= 1
+                    self._cond.notify_all()
+                raise
+            with self._cond:
+                entry.loading -= 1
+                entry.models.append(model)
+                entry.size_bytes = size_bytes
+                # 为新副本腾出内存
+                self._evict_locked(protect=key)
+                self._start_sweeper_locked()
+
+        try:
+            yield model
+        finally:
+            with self._cond:
+                entry.last_used = time.monotonic()
+                if model in entry.models:
+                    entry.idle.append(model)
+                self._evict_locked()
+                self._cond.notify_all()
+
+    def sweep(self):
+        """淘汰空闲超时的副本"""
+        with self._cond:
+            self._evict_locked()
+            self._cond.notify_all()
+
+    def _start_sweeper_locked(self):
+        if self.idle_ttl <= 0 or self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_forever, name="model-pool-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_forever(self):
+        # 检查间隔为空闲超时的四分之一（1-60 秒），副本最多比超时晚这么久释放
+        interval = min(60.0, max(1.0, self.idle_ttl / 4))
+        while True:
+            time.sleep(interval)
+            self.sweep()
+
+    def stats(self) -> Dict:
+        """返回模型池当前状态"""
+        with self._cond:
+            return {
+                str(key): {
+                    "replicas": len(entry.models),
+                    "idle": len(entry.idle),
+                    "size_bytes": entry.size_bytes,
+                }
+                for key, entry in self._entries.items()
+            }
+
+    def _total_bytes_locked(self) -> int:
+        return sum(entry.size_bytes * len(entry.models) for entry in self._entries.values())
+
+    def _drop_idle_locked(self, key: Hashable, entry: _PoolEntry):
+        model = entry.idle.pop()
+        entry.models.remove(model)
+        print(f"模型池淘汰空闲副本: {key}")
+        if not entry.models and not entry.loading:
+            del self._entries[key]
+
+    def _evict_locked(self, protect: Hashable = None):
+        now = time.monotonic()
+        # 空闲超时淘汰
+        if self.idle_ttl > 0:
+            for key, entry in list(self._entries.items()):
+                while entry.idle and now - entry.last_used > self.idle_ttl and key != protect:
+                    self._drop_idle_locked(key, entry)
+        # 超出内存上限时按最久未使用顺序淘汰空闲副本
+        if self.max_bytes > 0:
+            candidates = sorted(
+                (item for item in self._entries.items() if item[0] != protect),
+                key=lambda item: item[1].last_used,
+            )
+            for key, entry in candidates:
+                while entry.idle and self._total_bytes_locked() > self.max_bytes:
+                    self._drop_idle_locked(key, entry)
+
+
+# 全局模型池，所有 MCP 工具调用共享
+WHISPER_POOL = WhisperModelPool(
+    replicas=WHISPER_POOL_REPLICAS,
+    max_bytes=WHISPER_POOL_MAX_BYTES,
+    idle_ttl=WHISPER_POOL_IDLE_TTL,
+)
+
+# 阶段线程池：yt-dlp 下载、faster-whisper 转录（CTranslate2 推理期间会释放 GIL）、
+# 本地 SQLite 读写与暂存区目录操作（单独的小线程池，不排在耗时的下载后面）、
+# b23.tv 短链接解析（只发一次 HEAD 请求，同样不排在下载后面）
+# LLM 请求走异步 HTTP 客户端，由 LLMClient 的信号量限制并发
+STAGE_EXECUTORS = {
+    "download": ThreadPoolExecutor(max_workers=DOWNLOAD_CONCURRENCY, thread_name_prefix="download"),
+    "transcribe": ThreadPoolExecutor(max_workers=TRANSCRIBE_CONCURRENCY, thread_name_prefix="transcribe"),
+    "storage": ThreadPoolExecutor(max_workers=2, thread_name_prefix="storage"),
+    "resolve": ThreadPoolExecutor(max_workers=4, thread_name_prefix="resolve"),
+}
+
+
+def peak_rss_bytes() -> int:
+    """进程的峰值常驻内存（字节）"""
+    if resource is None:
+        return 0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 上单位是 KB，macOS 上是字节
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Metrics:
+    """进程内的阶段指标
+
+    按阶段记录耗时与排队等待的直方图，以及字节数、音频秒数、token 数等累计量，
+    以 Prometheus 文本格式导出（GET /metrics），同时可按 METRICS_LOG 写出每个阶段的 JSON 日志。
+    """
+
+    BUCKETS = {
+        "duration_seconds": (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800),
+        "queue_wait_seconds": (0.001, 0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 300),
+        "asr_rtf": (0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2),
+    }
+    # span 属性名 -> 累计量指标名
+    COUNTERS = {
+        "bytes": "bytes_total",
+        "audio_seconds": "audio_seconds_total",
+        "prompt_tokens": "prompt_tokens_total",
+        "completion_tokens": "completion_tokens_total",
+    }
+
+    def __init__(self, log_path: str = METRICS_LOG):
+        self.log_path = log_path
+        self._lock = threading.Lock()
+        self._histograms: Dict[Tuple[str, str], list] = {}
+        self._counters: Dict[Tuple[str, Tuple], float] = {}
+
+    def observe(self, name: str, stage: str, value: float):
+        buckets = self.BUCKETS[name]
+        with self._lock:
+            counts = self._histograms.setdefault((name, stage), [[0] * len(buckets), 0.0, 0])
+            for index, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[0][index] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_span(self, stage: str, duration: float, status: str, attrs: Dict):
+        """记录一个阶段结束：耗时直方图、各项累计量、峰值内存，并写出 JSON 日志"""
+        attrs["peak_rss_bytes"] = peak_rss_bytes()
+        if attrs.get("error"):
+            status = "error"
+        if attrs.get("audio_seconds"):
+            attrs["rtf"] = round(duration / attrs["audio_seconds"], 4)
+        self.observe("duration_seconds", stage, duration)
+        self.inc("spans_total", stage=stage, status=status)
+        for attr, name in self.COUNTERS.items():
+            if attrs.get(attr):
+                self.inc(name, attrs[attr], stage=stage)
+        if stage == "asr" and "rtf" in attrs:
+            self.observe("asr_rtf", stage, attrs["rtf"])
+        if self.log_path:
+            self._write_log(dict(
+                ts=datetime.now().isoformat(timespec="milliseconds"), span=stage,
+                duration_s=round(duration, 4), status=status, **attrs,
+            ))
+
+    def _write_log(self, record: Dict):
+        line = json.dumps(record, ensure_ascii=False, default=str)
+        if self.log_path == "-":
+            print(line)
+            return
+        with self._lock:
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+
+    def render(self) -> str:
+        """导出 Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            for (name, stage), (counts, total, count) in sorted(self._histograms.items()):
+                metric = f"bilimind_stage_{name}"
+                for bound, value in zip(self.BUCKETS[name], counts):
+                    lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {value}')
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {count}')
+                lines.append(f'{metric}_sum{{stage="{stage}"}} {total}')
+                lines.append(f'{metric}_count{{stage="{stage}"}} {count}')
+            for (name, labels), value in sorted(self._counters.items()):
+                label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+                lines.append(f"bilimind_stage_{name}{{{label_text}}} {value}")
+        lines.append(f"bilimind_peak_rss_bytes {peak_rss_bytes()}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+# 当前阶段的属性字典，供 run_stage 和 LLMClient 记录排队等待时间
+_CURRENT_SPAN: contextvars.ContextVar = contextvars.ContextVar("bilimind_span", default=None)
+
+
+@contextmanager
+def span(stage: str, **attrs):
+    """记录一个阶段（resolve、download、decode、asr、llm、postprocess）的耗时与资源
+
+    产出一个属性字典，调用方可以写入 bytes、audio_seconds、prompt_tokens、completion_tokens
+    等属性；排队等待时间由 run_stage 和 LLMClient 自动累加到 queue_wait_s。
+    """
+    record = dict(attrs)
+    token = _CURRENT_SPAN.set(record)
+    start = time.monotonic()
+    status = "ok"
+    try:
+        yield record
+    except (asyncio.CancelledError, PipelineCancelled):
+        status = "cancelled"
+        raise
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        _CURRENT_SPAN.reset(token)
+        METRICS.record_span(stage, time.monotonic() - start, status, record)
+
+
+def record_queue_wait(stage: str, wait: float, current: Optional[Dict] = None):
+    """记录排队等待时间（线程池或并发信号量），并累加到当前阶段"""
+    METRICS.observe("queue_wait_seconds", stage, wait)
+    current = current if current is not None else _CURRENT_SPAN.get()
+    if current is not None:
+        current["queue_wait_s"] = round(current.get("queue_wait_s", 0) + wait, 4)
+
+
+async def run_stage(stage: str, func: Callable, *args, **kwargs):
+    """在指定阶段的线程池中执行阻塞函数，事件循环保持响应；记录在线程池中的排队时间"""
+    loop = asyncio.get_running_loop()
+    submitted = time.monotonic()
+    current = _CURRENT_SPAN.get()
+
+    def call():
+        record_queue_wait(stage, time.monotonic() - submitted, current)
+        return func(*args, **kwargs)
+
+    return await loop.run_in_executor(STAGE_EXECUTORS[stage], call)
+
+
+# 转录片段，只保留下游需要的字段；转录过程中逐个回调，完成后汇总为 Transcript
+TranscriptSegment = namedtuple("TranscriptSegment", ["start", "end", "text"])
+
+
+class Transcript:
+    """按列存储的紧凑转录结果，是 TranscriptSegment 的只读序列
+
+    片段的开始、结束时间是并行的 float64 数组；文本存放在同一个 UTF-8 缓冲区中，每个片段后跟一个空格，
+    offsets[i] 是第 i 个片段的起始字节（末尾多一项结束位置）。开启逐词时间戳时，逐词的起止时间、
+    文本偏移以及每个片段的首个词序号同样按列存储。所有列都是 memoryview：按下标切片
+    得到共享缓冲区的视图，不复制数据；to_bytes 输出带 JSON 头的列式二进制，from_bytes 直接在
+    字节缓冲区上建立视图（零拷贝）。片段需按时间排序。
+    """
+
+    MAGIC = b"BMTS"
+    VERSION = 1
+    # 列名与 array 类型码，逐词列可以缺省
+    COLUMNS = (
+        ("starts", "d"), ("ends", "d"), ("offsets", "q"), ("text", "B"),
+        ("word_starts", "d"), ("word_ends", "d"), ("word_offsets", "q"), ("word_text", "B"), ("word_index", "q"),
+    )
+
+    def __init__(self, columns: Dict[str, memoryview], language: Optional[str] = None, source: str = "asr"):
+        self._columns = columns
+        self.language = language
+        # 转录来源：asr 或 subtitle:<字幕语言>
+        self.source = source
+
+    @classmethod
+    def from_segments(cls, segments, language: Optional[str] = None, source: str = "asr",
+                      words: Optional[list] = None) -> "Transcript":
+        """由片段构建；words 为与片段一一对应的 [(开始, 结束, 词)] 列表"""
+        starts, ends, offsets = array("d"), array("d"), array("q")
+        text = bytearray()
+        word_starts, word_ends, word_offsets, word_index = array("d"), array("d"), array("q", [0]), array("q")
+        word_text = bytearray()
+        for index, segment in enumerate(segments):
+            starts.append(segment.start)
+            ends.append(segment.end)
+            offsets.append(len(text))
+            text += segment.text.encode("utf-8") + b" "
+            word_index.append(len(word_starts))
+            for start, end, word in (words[index] if words else ()):
+                word_starts.append(start)
+                word_ends.append(end)
+                word_text += word.encode("utf-8")
+                word_offsets.append(len(word_text))
+        offsets.append(len(text))
+        word_index.append(len(word_starts))
+
+        columns = {"starts": memoryview(starts), "ends": memoryview(ends),
+                   "offsets": memoryview(offsets), "text": memoryview(bytes(text))}
+        if words:
+            columns.update(word_starts=memoryview(word_starts), word_ends=memoryview(word_ends),
+                           word_offsets=memoryview(word_offsets), word_text=memoryview(bytes(word_text)),
+                           word_index=memoryview(word_index))
+        return cls(columns, language, source)
+
+    @classmethod
+    def restore(cls, value) -> "Transcript":
+        """从缓存或检查点中的值还原：二进制格式，或旧版本保存的 JSON 字典"""
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return cls.from_bytes(value)
+        return cls.from_segments(
+            [TranscriptSegment(*segment) for segment in value["segments"]],
+            value.get("language"), value.get("source", "asr"),
+        )
+
+    def __len__(self) -> int:
+        return len(self._columns["starts"])
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                raise ValueError("Transcript 只支持连续切片")
+            return self._view(start, max(start, stop))
+        if index < 0:
+            index += len(self)
+        columns = self._columns
+        return TranscriptSegment(columns["starts"][index], columns["ends"][index], self.text_of(index))
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def text_of(self, index: int) -> str:
+        offsets = self._columns["offsets"]
+        return bytes(self._columns["text"][offsets[index]:offsets[index + 1] - 1]).decode("utf-8")
+
+    @property
+    def full_text(self) -> str:
+        """所有片段以空格连接的全文（每次访问时解码，不常驻内存）"""
+        offsets = self._columns["offsets"]
+        return bytes(self._columns["text"][offsets[0]:offsets[len(self)]]).decode("utf-8").strip()
+
+    @property
+    def end(self) -> float:
+        return self._columns["ends"][-1] if len(self) else 0.0
+
+    @property
+    def has_words(self) -> bool:
+        return "word_index" in self._columns
+
+    def words(self, index: int) -> List[Tuple[float, float, str]]:
+        """第 index 个片段的逐词时间戳，未开启时为空列表"""
+        if not self.has_words:
+            return []
+        columns = self._columns
+        word_offsets = columns["word_offsets"]
+        return [
+            (columns["word_starts"][word], columns["word_ends"][word],
+             bytes(columns["word_text"][word_offsets[word]:word_offsets[word + 1]]).decode("utf-8"))
+            for word in range(columns["word_index"][index], columns["word_index"][index + 1])
+        ]
+
+    def shifted(self, seconds: float) -> "Transcript":
+        """所有时间戳加上 seconds 后的副本，文本缓冲区共享"""
+        columns = dict(self._columns)
+        for name in ("starts", "ends", "word_starts", "word_ends"):
+            if name in columns:
+                columns[name] = memoryview(array("d", (value + seconds for value in columns[name])))
+        return Transcript(columns, self.language, self.source)
+
+    def _view(self, start: int, stop: int) -> "Transcript":
+        columns = dict(self._columns)
+        columns.update(starts=columns["starts"][start:stop], ends=columns["ends"][start:stop],
+                       offsets=columns["offsets"][start:stop + 1])
+        if self.has_words:
+            columns["word_index"] = columns["word_index"][start:stop + 1]
+        return Transcript(columns, self.language, self.source)
+
+    def compact(self) -> "Transcript":
+        """视图只引用共享缓冲区的一部分，复制为独立的紧凑副本"""
+        words = [self.words(index) for index in range(len(self))] if self.has_words else None
+        return Transcript.from_segments(self, self.language, self.source, words=words)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(column.nbytes for column in self._columns.values())
+
+    def to_bytes(self) -> bytes:
+        """序列化为列式二进制：MAGIC、头长度、JSON 头（语言、来源、字节序、各列长度），各列按 8 字节对齐"""
+        transcript = self
+        offsets = self._columns["offsets"]
+        if offsets[0] != 0 or offsets[len(self)] != len(self._columns["text"]) or (
+                self.has_words and self._columns["word_index"][0] != 0):
+            transcript = self.compact()
+
+        columns = [(name, code, transcript._columns[name]) for name, code in self.COLUMNS
+                   if name in transcript._columns]
+        header = json.dumps({
+            "version": self.VERSION, "language": self.language, "source": self.source,
+            "byteorder": sys.byteorder, "count": len(self),
+            "columns": [[name, code, column.nbytes] for name, code, column in columns],
+        }).encode("utf-8")
+        parts = [self.MAGIC, struct.pack("<I", len(header)), header]
+        size = len(self.MAGIC) + 4 + len(header)
+        for _, _, column in columns:
+            parts.append(b"\0" * (-size % 8))
+            size += -size % 8
+            parts.append(column.cast("B"))
+            size += column.nbytes
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, buffer) -> "Transcript":
+        """在字节缓冲区（bytes、mmap 等）上建立各列的视图，不复制数据"""
+        view = memoryview(buffer).cast("B")
+        if bytes(view[:len(cls.MAGIC)]) != cls.MAGIC:
+            raise ValueError("不是 Transcript 二进制格式")
+        position = len(cls.MAGIC)
+        (header_size,) = struct.unpack_from("<I", view, position)
+        position += 4
+        header = json.loads(bytes(view[position:position + header_size]))
+        position += header_size
+
+        columns = {}
+        for name, code, size in header["columns"]:
+            position += -position % 8
+            raw = view[position:position + size]
+            if header["byteorder"] == sys.byteorder or code == "B":
+                columns[name] = raw.cast(code)
+            else:
+                values = array(code, bytes(raw))
+                values.byteswap()
+                columns[name] = memoryview(values)
+            position += size
+        return cls(columns, header["language"], header["source"])
+
+_BVID_RE = re.compile(r"(BV[0-9A-Za-z]{10})")
+_AVID_RE = re.compile(r"(?:^|[/_])av(\d+)", re.IGNORECASE)
+_PART_SUFFIX_RE = re.compile(r"_p(\d+)$")
+
+
+def parse_bilibili_url(video_url: str) -> Tuple[Optional[str], int]:
+    """从B站链接或 yt-dlp 视频ID中解析 (视频ID, 分P序号)，无法识别时视频ID为 None"""
+    parsed = urlparse(video_url)
+    target = parsed.path if parsed.scheme else video_url
+
+    part = 1
+    suffix = _PART_SUFFIX_RE.search(target)
+    if suffix:
+        part = int(suffix.group(1))
+    query_part = parse_qs(parsed.query).get("p")
+    if query_part and query_part[0].isdigit():
+        part = int(query_part[0])
+    # 分P从 1 开始，p=0 与默认分P是同一个视频
+    part = max(1, part)
+
+    bvid = _BVID_RE.search(target)
+    if bvid:
+        return bvid.group(1), part
+    avid = _AVID_RE.search(target)
+    if avid:
+        return f"av{avid.group(1)}", part
+    return None, part
+
+
+def canonicalize_bilibili_url(video_url: str) -> Tuple[str, Optional[str], int]:
+    """去掉分享链接中的 spm_id_from、vd_source 等参数，返回 (规范链接, 视频ID, 分P序号)
+
+    b23.tv 短链接会先跟随跳转解析出真实地址；仍无法识别时原样返回链接。
+    """
+    video_url = video_url.strip()
+    if urlparse(video_url).netloc.endswith("b23.tv"):
+        try:
+            response = requests.head(video_url, allow_redirects=True, timeout=10)
+            video_url = response.url
+        except Exception as e:
+            print(f"解析短链接失败: {e}")
+
+    video_id, part = parse_bilibili_url(video_url)
+    if not video_id:
+        return video_url, None, part
+    canonical_url = f"https://www.bilibili.com/video/{video_id}/"
+    if part > 1:
+        canonical_url += f"?p={part}"
+    return canonical_url, video_id, part
+
+
+async def resolve_video_url(video_url: str) -> Tuple[str, Optional[str], int]:
+    """异步版本的 canonicalize_bilibili_url：BV/av 链接直接解析，只有短链接放到线程池中跟随跳转"""
+    with span("resolve"):
+        if urlparse(video_url.strip()).netloc.endswith("b23.tv"):
+            return await run_stage("resolve", canonicalize_bilibili_url, video_url)
+        return canonicalize_bilibili_url(video_url)
+
+
+class PipelineCancelled(Exception):
+    """所有等待者都已取消请求，流水线中止"""
+
+
+class PipelineProgress:
+    """流水线进度广播
+
+    把下载百分比、转录位置、LLM 生成的 token 等阶段事件，通过 MCP 进度通知和日志消息
+    推送给所有等待同一结果的客户端。emit 可在工作线程中调用；取消后下一次 emit 会抛出
+    PipelineCancelled，用于中止仍在线程中运行的阶段。
+    """
+
+    # 各阶段在总进度（0-100）中所占的区间
+    STAGE_RANGES = {"download": (0, 30), "transcribe": (30, 70), "llm": (70, 100)}
+    MIN_INTERVAL = 0.5
+
+    def __init__(self, on_update: Optional[Callable[[str, float, str], None]] = None):
+        self._loop = asyncio.get_running_loop()
+        self._on_update = on_update
+        self._contexts: list = []
+        self._send_locks: Dict[int, asyncio.Lock] = {}
+        self._last_emit: Dict[str, float] = {}
+        self._pending_text: list = []
+        self.cancelled = threading.Event()
+
+    def subscribe(self, ctx: Optional[Context]):
+        if ctx is not None:
+            self._contexts.append(ctx)
+            self._send_locks[id(ctx)] = asyncio.Lock()
+
+    def unsubscribe(self, ctx: Optional[Context]):
+        if ctx in self._contexts:
+            self._contexts.remove(ctx)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise PipelineCancelled("请求已取消")
+
+    def emit(self, stage: str, fraction: float, message: str, force: bool = False):
+        """上报阶段进度，fraction 为该阶段内的完成比例（0-1）"""
+        self.check_cancelled()
+        now = time.monotonic()
+        if not force and now - self._last_emit.get(stage, 0) < self.MIN_INTERVAL:
+            return
+        self._last_emit[stage] = now
+        low, high = self.STAGE_RANGES[stage]
+        progress = low + (high - low) * max(0.0, min(1.0, fraction))
+        print(f"[{progress:5.1f}%] {message}")
+        if self._on_update:
+            self._on_update(stage, progress, message)
+        self._loop.call_soon_threadsafe(self._dispatch, progress, message, None)
+
+    def emit_text(self, text: str, force: bool = False):
+        """推送 LLM 生成的增量文本，按时间间隔合并后发送"""
+        self.check_cancelled()
+        if text:
+            self._pending_text.append(text)
+        now = time.monotonic()
+        if not self._pending_text or (not force and now - self._last_emit.get("text", 0) < self.MIN_INTERVAL):
+            return
+        self._last_emit["text"] = now
+        chunk = "".join(self._pending_text)
+        self._pending_text.clear()
+        self._loop.call_soon_threadsafe(self._dispatch, None, None, chunk)
+
+    def _dispatch(self, progress: Optional[float], message: Optional[str], text: Optional[str]):
+        for ctx in list(self._contexts):
+            asyncio.ensure_future(self._send(ctx, progress, message, text))
+
+    async def _send(self, ctx: Context, progress: Optional[float], message: Optional[str], text: Optional[str]):
+        # 每个客户端按顺序发送，避免增量文本乱序
+        async with self._send_locks[id(ctx)]:
+            try:
+                if progress is not None:
+                    await ctx.report_progress(progress, 100, message)
+                if text:
+                    await ctx.log("info", text, logger_name="notes")
+            except Exception as e:
+                print(f"发送进度通知失败: {e}")
+
+
+class _Flight:
+    def __init__(self, task: asyncio.Task, progress: PipelineProgress):
+        self.task = task
+        self.progress = progress
+        self.waiters = 0
+
+
+class SingleFlight:
+    """合并同一键的并发请求：流水线只执行一次，所有等待者得到相同的结果或异常
+
+    所有等待者共享同一个 PipelineProgress；只有当全部等待者都取消时才中止流水线。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, _Flight] = {}
+
+    async def do(self, key: Hashable, factory: Callable, ctx: Optional[Context] = None):
+        flight = self._inflight.get(key)
+        if flight is None:
+            progress = PipelineProgress()
+            flight = _Flight(asyncio.ensure_future(factory(progress)), progress)
+            self._inflight[key] = flight
+            flight.task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            print(f"合并重复请求: {key}")
+
+        flight.waiters += 1
+        flight.progress.subscribe(ctx)
+        try:
+            # shield 保证某个等待者被取消时不会中断其他等待者共享的任务
+            return await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                print(f"所有等待者均已取消，中止流水线: {key}")
+                flight.progress.cancel()
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            flight.progress.unsubscribe(ctx)
+
+
+INFLIGHT = SingleFlight()
+
+
+class ResultCache:
+    """基于 SQLite 的流水线结果缓存
+
+    每一层（音频元数据、转录、笔记）按视频ID、分P、模型大小、提示词指纹等组成的键存储，
+    支持过期时间与按容量的 LRU 淘汰。总大小在内存中累计，写入使总量超出容量、或距上次
+    校准超过 SYNC_INTERVAL 秒（其他进程也可能写入同一数据库）时才扫描全表清理。
+    读写都是同步的 SQLite 操作，异步代码中通过 run_stage("storage", ...) 调用。
+    """
+
+    SYNC_INTERVAL = 60.0
+
+    def __init__(self, db_path: str = CACHE_DB, ttl: float = CACHE_TTL,
+                 max_bytes: int = CACHE_MAX_BYTES):
+        self.db_path = db_path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS results (
+                key TEXT PRIMARY KEY,
+                layer TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_results_accessed ON results(accessed_at)")
+        with self._lock:
+            self._evict_locked()
+            self._conn.commit()
+
+    @staticmethod
+    def make_key(layer: str, *parts) -> str:
+        return ":".join([layer] + [str(part) for part in parts])
+
+    def get(self, layer: str, *parts):
+        """读取缓存，未命中或已过期返回 None"""
+        key = self.make_key(layer, *parts)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, size, created_at FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            value, size, created_at = row
+            if self.ttl > 0 and now - created_at > self.ttl:
+                self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                self._conn.commit()
+                self._total -= size
+                return None
+            self._conn.execute("UPDATE results SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+        return value if isinstance(value, bytes) else json.loads(value)
+
+    def set(self, layer: str, parts: tuple, value) -> None:
+        """写入缓存，并在超出容量时淘汰最久未访问的条目；bytes 按原样存为 BLOB，其余值存为 JSON"""
+        key = self.make_key(layer, *parts)
+        payload = value if isinstance(value, bytes) else json.dumps(value, ensure_ascii=False).encode("utf-8")
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT size FROM results WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results (key, layer, value, size, created_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (key, layer, payload if isinstance(value, bytes) else payload.decode("utf-8"),
+                 len(payload), now, now),
+            )
+            self._total += len(payload) - (row[0] if row else 0)
+            if (0 < self.max_bytes < self._total
+                    or time.monotonic() - self._synced_at >= self.SYNC_INTERVAL):
+                self._evict_locked()
+            self._conn.commit()
+
+    def _evict_locked(self):
+        """删除过期条目，校准总大小，超出容量时按最久未访问淘汰"""
+        if self.ttl > 0:
+            self._conn.execute("DELETE FROM results WHERE created_at < ?", (time.time() - self.ttl,))
+        self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+        self._synced_at = time.monotonic()
+        if self.max_bytes <= 0 or self._total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM results ORDER BY accessed_at ASC"
+        ).fetchall():
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self._total -= size
+            if self._total <= self.max_bytes:
+                break
+
+
+RESULT_CACHE = LazyObject(ResultCache)
+
+
+def load_cached_transcript(video_id: str, part: int) -> Optional[Transcript]:
+    """读取转录缓存（二进制列式格式，直接在读出的字节上建立视图）"""
+    cached = RESULT_CACHE.get("transcript", video_id, part, WHISPER_MODEL_SIZE)
+    return Transcript.restore(cached) if cached is not None else None
+
+
+def store_cached_transcript(video_id: str, part: int, transcript: Transcript) -> None:
+    """写入转录缓存"""
+    RESULT_CACHE.set("transcript", (video_id, part, WHISPER_MODEL_SIZE), transcript.to_bytes())
+
+
+def audio_metadata(audio_info: Dict) -> Dict:
+    """音频信息中可以缓存的部分（去掉本地文件路径和会过期的音频流地址）"""
+    return {k: v for k, v in audio_info.items() if k not in ('file_path', 'stream_url', 'http_headers')}
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _tree_size(path: str) -> int:
+    """目录占用的字节数，硬链接的文件只计一次"""
+    total = 0
+    seen = set()
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                stat = os.stat(os.path.join(dirpath, filename))
+            except OSError:
+                continue
+            if (stat.st_dev, stat.st_ino) not in seen:
+                seen.add((stat.st_dev, stat.st_ino))
+                total += stat.st_size
+    return total
+
+
+class ScratchSpace:
+    """下载与中间音频文件的本地暂存区
+
+    work/ 下是每个请求的临时目录（目录名带进程号，进程被杀后遗留的目录在启动时清理）；
+    audio/ 下是转录后保留的音频，按最近使用时间（mtime）做 LRU 淘汰，使整个暂存区不超过字节预算。
+    占用字节数在内存中累计：新写入的文件由 track 计入，删除临时目录、淘汰音频时扣除；
+    只有启动清理（rescan）时才遍历整个暂存区重新统计。
+    """
+
+    def __init__(self, root: str = SCRATCH_DIR, max_bytes: int = SCRATCH_MAX_BYTES,
+                 retain_audio: bool = SCRATCH_RETAIN_AUDIO):
+        self.root = root
+        self.work_dir = os.path.join(root, "work")
+        self.audio_dir = os.path.join(root, "audio")
+        self.max_bytes = max_bytes
+        self.retain_audio = retain_audio
+        self._lock = threading.Lock()
+        self._bytes: Optional[int] = None
+        os.makedirs(self.work_dir, exist_ok=True)
+        os.makedirs(self.audio_dir, exist_ok=True)
+
+    def create_workdir(self, name: str) -> str:
+        """为一次请求创建临时目录，创建前先按预算淘汰保留的音频，为新的下载腾出空间"""
+        self.enforce_budget()
+        path = os.path.join(self.work_dir, f"{name}-{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(path)
+        return path
+
+    def release_workdir(self, path: str):
+        """删除临时目录并扣除其占用（硬链接自保留区的音频仍占用空间，不扣除）"""
+        freed = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                try:
+                    stat = os.stat(os.path.join(dirpath, filename))
+                except OSError:
+                    continue
+                if stat.st_nlink == 1:
+                    freed += stat.st_size
+        shutil.rmtree(path, ignore_errors=True)
+        self._adjust(-freed)
+
+    def track(self, path: str):
+        """把新写入暂存区的文件（下载的音频、解码出的 PCM）计入占用"""
+        root = os.path.abspath(self.root) + os.sep
+        if os.path.abspath(path).startswith(root) and os.path.exists(path):
+            self._adjust(os.path.getsize(path))
+
+    def _adjust(self, delta: int):
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes = max(0, self._bytes + delta)
+
+    def sweep_orphans(self) -> int:
+        """删除已退出进程遗留的临时目录，返回删除的目录数"""
+        removed = 0
+        for name in os.listdir(self.work_dir):
+            try:
+                pid = int(name.rsplit("-", 2)[1])
+            except (IndexError, ValueError):
+                pid = None
+            if pid is not None and (pid == os.getpid() or _pid_alive(pid)):
+                continue
+            shutil.rmtree(os.path.join(self.work_dir, name), ignore_errors=True)
+            removed += 1
+        if removed:
+            print(f"清理遗留的临时目录: {removed} 个")
+        return removed
+
+    def reuse_audio(self, video_id: str, part: int, workdir: str) -> Optional[str]:
+        """查找保留的音频并硬链接到请求的临时目录，转录期间即使被淘汰也不受影响"""
+        prefix = f"{video_id}_p{part}."
+        for name in os.listdir(self.audio_dir):
+            if name.startswith(prefix) and not name.endswith(".f32"):
+                path = os.path.join(self.audio_dir, name)
+                target = os.path.join(workdir, name)
+                try:
+                    os.utime(path)
+                    os.link(path, target)
+                except OSError:
+                    return None
+                return target
+        return None
+
+    def keep_audio(self, video_id: str, part: int, audio_path: str) -> Optional[str]:
+        """转录完成后把音频移入保留区并返回新路径；未开启保留时返回 None（由调用方删除）"""
+        pcm_path = os.path.splitext(audio_path)[0] + ".f32"
+        if os.path.exists(pcm_path):
+            self._adjust(-os.path.getsize(pcm_path))
+            os.remove(pcm_path)
+        if not self.retain_audio:
+            return None
+        target = os.path.join(self.audio_dir, f"{video_id}_p{part}{os.path.splitext(audio_path)[1]}")
+        if os.path.abspath(audio_path) != os.path.abspath(target):
+            if os.path.exists(target):
+                self._adjust(-os.path.getsize(target))
+            os.replace(audio_path, target)
+        os.utime(target)
+        self.enforce_budget()
+        return target
+
+    def usage(self) -> int:
+        """暂存区占用的字节数（累计值，首次调用时统计一次）"""
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = _tree_size(self.root)
+            return self._bytes
+
+    def rescan(self) -> int:
+        """遍历整个暂存区重新统计占用"""
+        total = _tree_size(self.root)
+        with self._lock:
+            self._bytes = total
+        return total
+
+    def enforce_budget(self):
+        """超出预算时按最久未使用淘汰保留的音频；正在使用的临时目录不会被删除"""
+        if self.max_bytes <= 0 or self.usage() <= self.max_bytes:
+            return
+        with self._lock:
+            total = self._bytes
+            if total <= self.max_bytes:
+                return
+            retained = sorted(
+                (entry for entry in os.scandir(self.audio_dir) if entry.is_file()),
+                key=lambda entry: entry.stat().st_mtime,
+            )
+            for entry in retained:
+                stat = entry.stat()
+                os.remove(entry.path)
+                # 仍硬链接在某个临时目录中的音频要等临时目录删除时才释放空间
+                if stat.st_nlink == 1:
+                    total -= stat.st_size
+                print(f"暂存区超出预算，淘汰保留的音频: {entry.name}")
+                if total <= self.max_bytes:
+                    break
+            self._bytes = total
+            if total > self.max_bytes:
+                print(f"暂存区占用 {total / 1024 / 1024:.1f} MB，仍超出预算 {self.max_bytes / 1024 / 1024:.1f} MB")
+
+
+SCRATCH = LazyObject(ScratchSpace)
+
+
+class JobStore:
+    """基于 SQLite 的持久化任务队列
+
+    jobs 表记录任务状态、进度与最终结果；checkpoints 表按任务保存各阶段产物
+    （音频信息、已转录片段、分段总结），进程崩溃或重启后任务可以从最近的检查点继续。
+
+    多个进程（可以在不同主机上，通过共享文件系统访问同一个数据库）共用一个队列：
+    工作进程领取任务时获得带过期时间的租约并定期续约，租约过期的任务由其他工作进程接手。
+    """
+
+    ACTIVE_STATUSES = ("queued", "running")
+    LEASE_COLUMNS = {"worker": "TEXT", "lease_token": "TEXT", "lease_until": "REAL"}
+
+    def __init__(self, db_path: str = JOBS_DB, lease_seconds: float = JOB_LEASE_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self._lock = threading.Lock()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        # 多个进程同时写入时等待锁释放，而不是立即报错
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute(f"PRAGMA journal_mode={JOBS_DB_JOURNAL_MODE}")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                video_url TEXT NOT NULL,
+                video_id TEXT,
+                part INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                stage TEXT,
+                progress REAL NOT NULL DEFAULT 0,
+                message TEXT,
+                result TEXT,
+                error TEXT,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                job_id TEXT NOT NULL,
+                name TEXT NOT NULL,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (job_id, name)
+            )
+            """
+        )
+        # 兼容旧版本创建的任务库
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, column_type in self.LEASE_COLUMNS.items():
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {column_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at)")
+        self._conn.commit()
+
+    def submit(self, video_url: str, video_id: Optional[str], part: int) -> Dict:
+        """提交任务；同一视频已有未完成的任务时复用它，失败的任务重新排队并保留检查点"""
+        now = time.time()
+        with self._lock:
+            row = None
+            if video_id:
+                row = self._conn.execute(
+                    "SELECT * FROM jobs WHERE video_id = ? AND part = ? AND status != 'done' "
+                    "ORDER BY created_at DESC LIMIT 1",
+                    (video_id, part),
+                ).fetchone()
+            if row is not None:
+                if row["status"] not in self.ACTIVE_STATUSES:
+                    self._conn.execute(
+                        "UPDATE jobs SET status = 'queued', error = NULL, updated_at = ? WHERE id = ?",
+                        (now, row["id"]),
+                    )
+                    self._conn.commit()
+                    print(f"任务重新排队: {row['id']}")
+                job_id = row["id"]
+            else:
+                job_id = uuid.uuid4().hex
+                self._conn.execute(
+                    "INSERT INTO jobs (id, video_url, video_id, part, status, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                    (job_id, video_url, video_id, part, now, now),
+                )
+                self._conn.commit()
+        return self.get(job_id)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def update(self, job_id: str, token: str, **fields) -> bool:
+        """在仍持有租约时更新任务的阶段与进度，返回 False 表示租约已被其他工作进程接手"""
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ? AND lease_token = ?", (*fields.values(), job_id, token)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def claim(self, worker: str = WORKER_ID) -> Optional[Dict]:
+        """领取最早排队的任务（或租约已过期、没有租约的运行中任务），返回的任务带有 lease_token
+
+        领取由一条 UPDATE 语句完成，SQLite 的写锁保证多个进程不会领到同一个任务。
+        """
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                """
+                UPDATE jobs SET status = 'running', worker = ?, lease_token = ?, lease_until = ?,
+                    attempts = attempts + 1, updated_at = ?
+                WHERE id = (
+                    SELECT id FROM jobs
+                    WHERE status = 'queued' OR (status = 'running' AND (lease_until IS NULL OR lease_until < ?))
+                    ORDER BY created_at LIMIT 1
+                )
+                """,
+                (worker, token, now + self.lease_seconds, now, now),
+            )
+            self._conn.commit()
+            if cursor.rowcount == 0:
+                return None
+            row = self._conn.execute("SELECT * FROM jobs WHERE lease_token = ?", (token,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def renew_lease(self, job_id: str, token: str) -> bool:
+        """续约，返回 False 表示租约已过期并被其他工作进程接手"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE id = ? AND lease_token = ?",
+                (time.time() + self.lease_seconds, job_id, token),
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def finish(self, job_id: str, token: str, **fields) -> bool:
+        """在仍持有租约时写入任务的最终状态"""
+        fields.update(updated_at=time.time(), lease_token=None, lease_until=None)
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock:
+            cursor = self._conn.execute(
+                f"UPDATE jobs SET {columns} WHERE id = ? AND lease_token = ?", (*fields.values(), job_id, token)
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def save_checkpoint(self, job_id: str, token: str, name: str, value) -> bool:
+        """在仍持有租约时保存检查点，bytes 按原样存为 BLOB，其余值存为 JSON；返回 False 表示租约已失效"""
+        payload = value if isinstance(value, bytes) else json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR REPLACE INTO checkpoints (job_id, name, value, updated_at) "
+                "SELECT ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM jobs WHERE id = ? AND lease_token = ?)",
+                (job_id, name, payload, time.time(), job_id, token),
+            )
+            self._conn.commit()
+        return cursor.rowcount > 0
+
+    def load_checkpoints(self, job_id: str) -> Dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, value FROM checkpoints WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {
+            row["name"]: row["value"] if isinstance(row["value"], bytes) else json.loads(row["value"])
+            for row in rows
+        }
+
+    def clear_checkpoints(self, job_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+            self._conn.commit()
+
+
+JOB_STORE = LazyObject(JobStore)
+
+
+class JobCheckpoint:
+    """单个任务的检查点读写，供流水线在各阶段完成后保存产物
+
+    写入以领取任务时的 lease_token 为条件；租约失效（任务已由其他工作进程接手）后
+    lease_lost 置位，之后的检查点与进度写入都会跳过，不会覆盖新持有者的数据。
+    """
+
+    def __init__(self, store: JobStore, job_id: str, token: str):
+        self.store = store
+        self.job_id = job_id
+        self.token = token
+        self.lease_lost = False
+        self.output_dir = os.path.join(JOBS_DIR, job_id)
+        self.data = store.load_checkpoints(job_id)
+        self.segments = [TranscriptSegment(*segment) for segment in self.data.get("segments", [])]
+        self._last_segment_save = time.monotonic()
+
+    def get(self, name: str):
+        return self.data.get(name)
+
+    def save(self, name: str, value) -> None:
+        self.data[name] = value
+        if self.lease_lost:
+            return
+        if not self.store.save_checkpoint(self.job_id, self.token, name, value):
+            self.lease_lost = True
+            print(f"任务 {self.job_id} 的租约已失效，不再写入检查点")
+
+    def update(self, **fields) -> None:
+        """更新任务的阶段与进度"""
+        if not self.lease_lost and not self.store.update(self.job_id, self.token, **fields):
+            self.lease_lost = True
+
+    def add_segment(self, segment: TranscriptSegment) -> None:
+        """记录新转录的片段，按 JOB_CHECKPOINT_INTERVAL 间隔落盘"""
+        self.segments.append(segment)
+        if time.monotonic() - self._last_segment_save >= JOB_CHECKPOINT_INTERVAL:
+            self.save_segments()
+
+    def save_segments(self) -> None:
+        self._last_segment_save = time.monotonic()
+        self.save("segments", [list(segment) for segment in self.segments])
+
+    def clear(self) -> None:
+        self.data.clear()
+        self.store.clear_checkpoints(self.job_id)
+
+
+_SEARCH_TOKEN_RE = re.compile(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[0-9a-z\u00c0-\u024f]+")
+
+
+def search_tokens(text: str) -> List[str]:
+    """全文检索的分词：中日韩字符按相邻两字切分（bigram），字母数字按单词，统一小写
+
+    连续中日韩字符的最后一个字单独作为一个词（其余的字都是某个 bigram 的开头），
+    单字查询按前缀匹配即可命中任意位置的字。
+    """
+    tokens = []
+    for match in _SEARCH_TOKEN_RE.finditer(text.lower()):
+        run = match.group()
+        if run[0] > "\u024f":
+            tokens.extend(run[index:index + 2] for index in range(len(run) - 1))
+            tokens.append(run[-1])
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class SearchIndex:
+    """转录全文检索索引
+
+    每个转录按段落（约 PARAGRAPH_SECONDS 秒）写入 SQLite FTS5 表，检索列是 search_tokens 切出的
+    bigram 序列，原文与段落起始时间作为不参与检索的列保存；使用未经提示词清理的原始文本，
+    被过滤掉的语气词、重复片段同样可以检索。查询词同样切分后按短语匹配，
+    因此中文关键词按子串命中；结果按 bm25 排序。转录完成时增量写入，同一视频分P重新写入时覆盖。
+    """
+
+    PARAGRAPH_SECONDS = 20
+    # 分词方式变化时递增，打开旧版本的索引时清空，转录在下次请求时从缓存重新写入
+    TOKENIZER_VERSION = 2
+
+    def __init__(self, db_path: str = SEARCH_DB):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        if os.path.dirname(db_path):
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS videos (
+                video_id TEXT NOT NULL,
+                part INTEGER NOT NULL,
+                title TEXT,
+                source TEXT,
+                segments INTEGER NOT NULL,
+                indexed_at REAL NOT NULL,
+                PRIMARY KEY (video_id, part)
+            )
+            """
+        )
+        try:
+            self._conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS passages USING fts5("
+                "tokens, text UNINDEXED, video_id UNINDEXED, part UNINDEXED, start UNINDEXED)"
+            )
+            self.enabled = True
+        except sqlite3.OperationalError as e:
+            # 编译时未启用 FTS5 的 SQLite 不支持检索，流水线照常运行
+            print(f"SQLite 不支持 FTS5，转录检索不可用: {e}")
+            self.enabled = False
+        version, = self._conn.execute("PRAGMA user_version").fetchone()
+        if self.enabled and version < self.TOKENIZER_VERSION:
+            self._conn.execute("DELETE FROM passages")
+            self._conn.execute("DELETE FROM videos")
+            self._conn.execute(f"PRAGMA user_version = {self.TOKENIZER_VERSION}")
+        self._conn.commit()
+
+    def is_indexed(self, video_id: str, part: int, transcript: Transcript) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source, segments FROM videos WHERE video_id = ? AND part = ?", (video_id, part)
+            ).fetchone()
+        return row is not None and tuple(row) == (transcript.source, len(transcript))
+
+    def add(self, video_id: str, part: int, title: Optional[str], transcript: Transcript) -> int:
+        """写入（或覆盖）一个视频分P的转录，返回写入的段落数"""
+        if not self.enabled:
+            return 0
+        rows = [
+            (" ".join(search_tokens(text)), text, video_id, part, start)
+            for start, text in encode_transcript_paragraphs(transcript, self.PARAGRAPH_SECONDS, clean=False)
+        ]
+        with self._lock:
+            self._conn.execute("DELETE FROM passages WHERE video_id = ? AND part = ?", (video_id, part))
+            self._conn.executemany(
+                "INSERT INTO passages (tokens, text, video_id, part, start) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO videos (video_id, part, title, source, segments, indexed_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (video_id, part, title, transcript.source, len(transcript), time.time()),
+            )
+            self._conn.commit()
+        return len(rows)
+
+    @staticmethod
+    def match_query(query: str) -> str:
+        """把用户输入转换为 FTS5 查询：每个词切分为短语（末尾前缀匹配），多个词之间为 AND"""
+        phrases = []
+        for term in query.split():
+            tokens = search_tokens(term)
+            if tokens:
+                phrases.append('"' + " ".join(tokens) + '" *')
+        return " AND ".join(phrases)
+
+    def search(self, query: str, video_id: Optional[str] = None, limit: int = 10) -> List[Dict]:
+        """按关键词检索，返回 [{video_id, part, title, start, snippet}]，按相关度排序"""
+        match = self.match_query(query)
+        if not self.enabled or not match:
+            return []
+        sql = ("SELECT p.video_id, p.part, v.title, p.start, p.text FROM passages p "
+               "LEFT JOIN videos v ON v.video_id = p.video_id AND v.part = p.part "
+               "WHERE passages MATCH ?")
+        params = [match]
+        if video_id:
+            sql += " AND p.video_id = ?"
+            params.append(video_id)
+        sql += " ORDER BY bm25(passages) LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        terms = query.split()
+        return [
+            {"video_id": vid, "part": part, "title": title, "start": start, "snippet": make_snippet(text, terms)}
+            for vid, part, title, start, text in rows
+        ]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            videos, = self._conn.execute("SELECT COUNT(*) FROM videos").fetchone()
+            passages, = self._conn.execute("SELECT COUNT(*) FROM passages").fetchone() if self.enabled else (0,)
+        return {"videos": videos, "passages": passages}
+
+
+def make_snippet(text: str, terms: List[str], width: int = 40) -> str:
+    """截取第一个命中关键词附近的文本，命中的关键词用【】标出"""
+    lowered = text.lower()
+    hits = [lowered.find(term.lower()) for term in terms]
+    hits = [hit for hit in hits if hit >= 0]
+    first = min(hits) if hits else 0
+    start = max(0, first - width)
+    end = min(len(text), first + width * 2)
+    # 长的关键词优先，一次替换，避免嵌套标记
+    pattern = "|".join(re.escape(term) for term in sorted(set(terms), key=len, reverse=True))
+    snippet = re.sub(pattern, lambda match: f"【{match.group()}】", text[start:end], flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+
+SEARCH_INDEX = LazyObject(SearchIndex)
+
+
+_SUBTITLE_TIME_RE = re.compile(
+    r"((?:\d+:)?\d{1,2}:\d{2}[,.]\d{1,3})\s*-->\s*((?:\d+:)?\d{1,2}:\d{2}[,.]\d{1,3})"
+)
+
+
+def _subtitle_seconds(timecode: str) -> float:
+    seconds = 0.0
+    for value in timecode.replace(",", ".").split(":"):
+        seconds = seconds * 60 + float(value)
+    return seconds
+
+
+def parse_subtitle(content: str, ext: str) -> List[TranscriptSegment]:
+    """把字幕内容转换为转录片段，支持B站字幕 JSON（body 中的 from/to/content）、SRT 与 WebVTT"""
+    if ext == "json":
+        body = json.loads(content).get("body") or []
+        segments = [
+            TranscriptSegment(float(line["from"]), float(line["to"]), str(line["content"]).strip())
+            for line in body
+        ]
+    else:
+        segments = []
+        for block in re.split(r"\n\s*\n", content.replace("\r\n", "\n")):
+            lines = block.strip().split("\n")
+            for index, line in enumerate(lines):
+                match = _SUBTITLE_TIME_RE.search(line)
+                if match:
+                    text = " ".join(item.strip() for item in lines[index + 1:] if item.strip())
+                    segments.append(TranscriptSegment(
+                        _subtitle_seconds(match.group(1)), _subtitle_seconds(match.group(2)),
+                        re.sub(r"<[^>]+>", "", text),
+                    ))
+                    break
+    return [segment for segment in segments if segment.text]
+
+
+def subtitle_language(lang: str) -> str:
+    """字幕语言标签转换为转录使用的语言代码，例如 zh-CN、ai-zh -> zh"""
+    if lang.startswith("ai-"):
+        lang = lang[len("ai-"):]
+    return lang.split("-")[0]
+
+
 class BilibiliDownloader:
     """哔哩哔哩视频下载器"""
+
+    AUDIO_FORMAT = 'bestaudio[ext=m4a]/bestaudio/best'
+    # 码率未知的格式也参与选择（abr>=?），没有满足条件的音频流时退回最小的音频流
+    AUDIO_FORMAT_ASR = 'worstaudio[abr>=?{min_abr}]/worstaudio/worst'
     
     def __init__(self, output_dir: str = DEFAULT_OUTPUT_DIR):
         self.output_dir = output_dir
         os.makedirs(self.output_dir, exist_ok=True)
 
-    def download_audio(self, video_url: str) -> dict:
-        """下载B站视频的音频"""
+    @staticmethod
+    def _ydl_options(**options) -> dict:
+        """yt-dlp 参数，配置了 BILIBILI_COOKIES 时附带 Cookie 文件"""
+        if BILIBILI_COOKIES:
+            options['cookiefile'] = BILIBILI_COOKIES
+        return options
+
+    @classmethod
+    def audio_format(cls, policy: str = AUDIO_FORMAT_POLICY) -> str:
+        """按格式策略返回 yt-dlp 的格式选择表达式"""
+        if policy == "best":
+            return cls.AUDIO_FORMAT
+        return cls.AUDIO_FORMAT_ASR.format(min_abr=AUDIO_MIN_ABR)
+
+    def download_audio(self, video_url: str, progress_hook: Optional[Callable] = None,
+                       info: Optional[dict] = None) -> dict:
+        """下载B站视频的音频，progress_hook 接收 yt-dlp 的下载进度事件
+
+        info 为 probe_video 返回的未处理视频信息，提供时直接从中选择格式并下载，不再重复解析视频页面。
+        """
         print(f"开始下载视频音频: {video_url}")
         output_path = os.path.join(self.output_dir, "%(id)s.%(ext)s")
         
-        ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio/best',
+        # 保留原始音频容器，不再转码为 mp3，转录前直接解码为 PCM
+        ydl_opts = self._ydl_options(**{
+            'format': self.audio_format(),
             'outtmpl': output_path,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-            }],
+            'concurrent_fragment_downloads': DOWNLOAD_FRAGMENTS,
+            # 多P视频只下载链接指定的分P（未指定时为第一P），展开全部分P由 expand_playlist 负责
+            'noplaylist': True,
             'quiet': True,
-        }
+        })
+        if progress_hook:
+            ydl_opts['progress_hooks'] = [progress_hook]
 
         with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(video_url, download=True)
+            if info is not None:
+                info = ydl.process_ie_result(info, download=True)
+            else:
+                info = ydl.extract_info(video_url, download=True)
             video_id = info.get("id")
-            audio_path = os.path.join(self.output_dir, f"{video_id}.mp3")
-            
-        print(f"音频下载完成: {audio_path}")
+            requested = info.get("requested_downloads") or [{}]
+            audio_path = requested[0].get("filepath") or ydl.prepare_filename(info)
+
+        bytes_downloaded = os.path.getsize(audio_path) if os.path.exists(audio_path) else 0
+        print(f"音频下载完成: {audio_path}（格式 {info.get('format_id')}，{info.get('abr') or '?'} kbps，"
+              f"{bytes_downloaded / 1024 / 1024:.2f} MB）")
         return {
             'file_path': audio_path,
             'title': info.get("title"),
             'duration': info.get("duration", 0),
             'cover_url': info.get("thumbnail"),
             'video_id': video_id,
+            'format_id': info.get("format_id"),
+            'abr': info.get("abr"),
+            'bytes_downloaded': bytes_downloaded,
         }
 
-class WhisperTranscriber:
-    """使用Faster-Whisper转录音频"""
-    
-    def __init__(self, model_dir: str = DEFAULT_MODEL_DIR):
-        self.model_dir = model_dir
-        os.makedirs(model_dir, exist_ok=True)
-    
-    def check_model_files(self) -> bool:
-        """检查模型文件是否已完整存在"""
-        model_size = WHISPER_MODEL_SIZE
-        model_path = os.path.join(self.model_dir, model_size)
-        
-        # 需要检查的文件列表
-        required_files = [
-            "model.bin",
-            "config.json",
-            "tokenizer.json",
-            "vocabulary.txt"
-        ]
+    def resolve_audio_stream(self, video_url: str) -> dict:
+        """只解析音频流地址而不下载，用于边下载边转录"""
+        print(f"解析视频音频流: {video_url}")
+        ydl_opts = self._ydl_options(**{
+            'format': self.audio_format(),
+            'noplaylist': True,
+            'quiet': True,
+        })
+
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=False)
+
+        audio_format = (info.get("requested_formats") or [info])[0]
+        return {
+            'file_path': None,
+            'stream_url': audio_format.get("url"),
+            'http_headers': audio_format.get("http_headers") or info.get("http_headers") or {},
+            'title': info.get("title"),
+            'duration': info.get("duration", 0),
+            'cover_url': info.get("thumbnail"),
+            'video_id': info.get("id"),
+            'format_id': audio_format.get("format_id"),
+            'abr': audio_format.get("abr"),
+        }
+
+    def probe_video(self, video_url: str, subtitle_langs: List[str] = SUBTITLE_LANGS) -> dict:
+        """解析视频信息（不下载）并按 subtitle_langs 的顺序查找字幕轨道
+
+        返回视频元数据、选中的字幕（{'lang', 'segments'}，没有可用字幕时为 None），
+        以及 yt-dlp 未处理的视频信息 info，没有字幕时交给 download_audio 复用。
+        """
+        print(f"查找视频字幕: {video_url}")
+        ydl_opts = self._ydl_options(noplaylist=True, writesubtitles=True, quiet=True)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(video_url, download=False, process=False)
+            subtitle = self._select_subtitle(ydl, info.get("subtitles") or {}, subtitle_langs)
+
+        if subtitle:
+            print(f"使用视频字幕: {subtitle['lang']}，{len(subtitle['segments'])} 条")
+        return {
+            'title': info.get("title"),
+            'duration': info.get("duration", 0),
+            'cover_url': info.get("thumbnail"),
+            'video_id': info.get("id"),
+            'subtitle': subtitle,
+            'info': info,
+        }
+
+    @staticmethod
+    def _select_subtitle(ydl, subtitles: Dict, langs: List[str]) -> Optional[dict]:
+        """按语言优先级选择第一条能解析出内容的字幕轨道（弹幕等非字幕轨道不在语言列表中）"""
+        for lang in langs:
+            for track in subtitles.get(lang) or []:
+                ext = track.get("ext")
+                if ext not in ("json", "srt", "vtt"):
+                    continue
+                try:
+                    content = track.get("data")
+                    if content is None:
+                        content = ydl.urlopen(track["url"]).read().decode("utf-8")
+                    segments = parse_subtitle(content, ext)
+                except Exception as e:
+                    print(f"读取字幕 {lang} 失败: {e}")
+                    continue
+                if segments:
+                    return {'lang': lang, 'segments': segments}
+        return None
+
+    @staticmethod
+    def expand_playlist(url: str, max_items: int = BATCH_MAX_ITEMS) -> List[str]:
+        """把合集、收藏夹、系列或多P视频展开为视频链接列表（只展开一层，不下载）
+
+        已指定分P的链接原样返回；单个视频返回只含自身的列表。
+        """
+        if "p" in parse_qs(urlparse(url).query):
+            return [url]
+        ydl_opts = BilibiliDownloader._ydl_options(**{
+            'extract_flat': 'in_playlist',
+            'playlistend': max_items,
+            'quiet': True,
+        })
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = ydl.extract_info(url, download=False, process=True)
+
+        if info.get("_type") != "playlist":
+            return [url]
+        entries = [entry.get("url") or entry.get("webpage_url") for entry in info.get("entries") or []]
+        print(f"展开 {info.get('title') or url}: {len(entries)} 个视频")
+        return [entry for entry in entries if entry][:max_items]
+
+def load_audio_pcm(audio_path: str, mmap: bool = AUDIO_PCM_MMAP) -> np.ndarray:
+    """将音频一次性解码为 16 kHz 单声道 float32 PCM
+
+    开启 mmap 时，解码出的帧逐块写入与音频同目录的 .f32 文件（内存中不保留整段 PCM），
+    完成后以只读内存映射方式返回，解码期间和转录期间的常驻内存都不随音频时长增长。
+    """
+    start = time.time()
+    with span("decode") as decode_span:
+        if mmap:
+            pcm_path = os.path.splitext(audio_path)[0] + ".f32"
+            samples = _decode_to_file(audio_path, pcm_path)
+            SCRATCH.track(pcm_path)
+            audio = np.memmap(pcm_path, dtype=np.float32, mode="r") if samples else np.zeros(0, np.float32)
+        else:
+            audio = faster_whisper.decode_audio(audio_path, sampling_rate=AUDIO_SAMPLE_RATE)
+        decode_span["bytes"] = os.path.getsize(audio_path)
+        decode_span["audio_seconds"] = round(len(audio) / AUDIO_SAMPLE_RATE, 3)
+    print(f"音频解码完成: {len(audio) / AUDIO_SAMPLE_RATE:.1f} 秒音频，耗时 {time.time() - start:.2f} 秒")
+    return audio
+
+
+def _decode_to_file(audio_path: str, pcm_path: str) -> int:
+    """把音频解码并重采样为 16 kHz 单声道 float32，逐帧追加写入 pcm_path，返回采样数"""
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=AUDIO_SAMPLE_RATE)
+    samples = 0
+    with av.open(audio_path, mode="r", metadata_errors="ignore") as container, open(pcm_path, "wb") as f:
+        for frame in _resample_frames(container.decode(audio=0), resampler):
+            block = frame.to_ndarray().reshape(-1).astype(np.float32) / 32768.0
+            block.tofile(f)
+            samples += len(block)
+    return samples
+
+
+def iter_stream_pcm(stream_url: str, headers: Dict, block_seconds: float = STREAM_BLOCK_SECONDS):
+    """边下载边解码音频流，按块产出 16 kHz 单声道 float32 PCM"""
+    header_lines = "".join(f"{key}: {value}\r\n" for key, value in headers.items())
+    resampler = av.audio.resampler.AudioResampler(format="s16", layout="mono", rate=AUDIO_SAMPLE_RATE)
+    block_samples = int(block_seconds * AUDIO_SAMPLE_RATE)
+    pending = []
+    pending_samples = 0
+
+    with av.open(stream_url, mode="r", options={"headers": header_lines}, metadata_errors="ignore") as container:
+        frames = container.decode(audio=0)
+        for frame in _resample_frames(frames, resampler):
+            samples = frame.to_ndarray().reshape(-1).astype(np.float32) / 32768.0
+            pending.append(samples)
+            pending_samples += len(samples)
+            if pending_samples >= block_samples:
+                yield np.concatenate(pending)
+                pending = []
+                pending_samples = 0
+
+    if pending:
+        yield np.concatenate(pending)
+
+
+def _resample_frames(frames, resampler):
+    """重采样音频帧，结束时冲刷重采样器中剩余的数据"""
+    for frame in frames:
+        yield from resampler.resample(frame)
+    yield from resampler.resample(None)
+
+
+def find_silence_cut(audio: np.ndarray, min_fraction: float = 0.5) -> int:
+    """用 VAD 在音频后半段寻找最靠后的静音位置作为切分点，找不到时返回音频末尾"""
+    length = len(audio)
+    speech = faster_whisper_vad.get_speech_timestamps(audio, faster_whisper_vad.VadOptions(min_silence_duration_ms=300))
+    if not speech:
+        return length
+
+    candidates = [(prev["end"] + nxt["start"]) // 2 for prev, nxt in zip(speech, speech[1:])]
+    if speech[-1]["end"] < length:
+        candidates.append((speech[-1]["end"] + length) // 2)
+    candidates = [cut for cut in candidates if cut >= length * min_fraction]
+    return max(candidates) if candidates else length
+
+
+def whisper_options() -> Dict:
+    """当前配置的解码引擎与解码参数"""
+    return {"engine": WHISPER_ENGINE, "language": WHISPER_LANGUAGE, "beam_size": WHISPER_BEAM_SIZE,
+            "batch_size": WHISPER_BATCH_SIZE, "word_timestamps": WHISPER_WORD_TIMESTAMPS}
+
+
+def run_whisper(model: faster_whisper.WhisperModel, audio: np.ndarray):
+    """按配置的解码引擎与解码参数执行转录，返回 faster-whisper 的 (segments, info)"""
+    return whisper_worker.run_whisper(model, audio, **whisper_options())
+
+
+def split_on_silence(audio: np.ndarray, chunk_seconds: float) -> list:
+    """把音频切成不超过 chunk_seconds 的块，切分点尽量落在静音处，返回 [(起始采样, 结束采样)]"""
+    chunk_samples = int(chunk_seconds * AUDIO_SAMPLE_RATE)
+    bounds = []
+    start = 0
+    while len(audio) - start > chunk_samples:
+        cut = start + find_silence_cut(audio[start:start + chunk_samples])
+        bounds.append((start, cut))
+        start = cut
+    if start < len(audio):
+        bounds.append((start, len(audio)))
+    return bounds
+
+
+def merge_chunk_segments(chunk_results: list) -> list:
+    """按时间顺序合并各块的转录片段，去掉块边界处重复的片段"""
+    merged = []
+    for segments in chunk_results:
+        for segment in segments:
+            if merged:
+                prev = merged[-1]
+                # 块边界附近出现与上一片段相同的文本，视为重复
+                if segment.text.strip() == prev.text.strip() and segment.start - prev.end < 1.0:
+                    continue
+                if segment.start < prev.end:
+                    segment = segment._replace(start=prev.end)
+            merged.append(segment)
+    return merged
+
+
+_CHUNK_POOL = None
+_CHUNK_POOL_KEY = None
+_CHUNK_POOL_LOCK = threading.Lock()
+
+
+def get_chunk_pool(model_path: str) -> ProcessPoolExecutor:
+    """获取长音频转录进程池，工作进程常驻以复用已加载的模型
+
+    工作进程的入口在 whisper_worker 模块中，反序列化任务时不会导入本模块及其缓存、任务库等全局对象。
+    """
+    global _CHUNK_POOL, _CHUNK_POOL_KEY
+    options = whisper_options()
+    key = (model_path, tuple(sorted(options.items())))
+    with _CHUNK_POOL_LOCK:
+        if _CHUNK_POOL is None or _CHUNK_POOL_KEY != key:
+            if _CHUNK_POOL is not None:
+                _CHUNK_POOL.shutdown(wait=False)
+            cpu_threads = max(1, (os.cpu_count() or 1) // LONG_AUDIO_WORKERS)
+            _CHUNK_POOL = ProcessPoolExecutor(
+                max_workers=LONG_AUDIO_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=whisper_worker.init_chunk_worker,
+                initargs=(model_path, WHISPER_DEVICE, WHISPER_COMPUTE_TYPE, cpu_threads, options),
+            )
+            _CHUNK_POOL_KEY = key
+        return _CHUNK_POOL
+
+
+def model_files(model_size: str) -> list:
+    """某个模型大小需要的文件列表"""
+    return MODEL_REPOS.get(model_size, (None, MODEL_FILES))[1]
+
+
+def _verify_file(file_path: str, expected: Dict):
+    """按清单校验文件大小以及 sha256 或 git blob 哈希"""
+    size = os.path.getsize(file_path)
+    if expected.get("size") is not None and size != expected["size"]:
+        raise ValueError(f"文件大小不符: 期望 {expected['size']} 字节，实际 {size} 字节")
+
+    if expected.get("sha256"):
+        digest = hashlib.sha256()
+    elif expected.get("git_sha1"):
+        digest = hashlib.sha1(f"blob {size}\0".encode())
+    else:
+        return
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(MODEL_DOWNLOAD_CHUNK), b""):
+            digest.update(block)
+    actual = digest.hexdigest()
+    wanted = expected.get("sha256") or expected.get("git_sha1")
+    if actual != wanted:
+        raise ValueError(f"文件哈希不符: 期望 {wanted}，实际 {actual}")
+
+
+class ModelStore:
+    """主机级共享模型仓库
+
+    不同大小的模型并列存放在 <root>/<size>/ 下，每个大小在一台主机上只下载一次。
+    同进程内用线程锁、跨进程用文件锁保护下载，并发请求会等待同一次下载完成。
+    """
+
+    def __init__(self, root: str = DEFAULT_MODEL_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._guard = threading.Lock()
+        self._locks: Dict[str, threading.Lock] = {}
+
+    def model_path(self, model_size: str) -> str:
+        return os.path.join(self.root, model_size)
+
+    def ensure(self, model_size: str) -> str:
+        """确保模型完整存在并返回模型目录，缺失时下载（同一模型只有一个下载者）"""
+        if self.is_complete(model_size):
+            return self.model_path(model_size)
+        with self._lock(model_size):
+            # 等待期间可能已由其他请求或进程下载完成
+            if not self.is_complete(model_size, quiet=True):
+                print(f"未发现完整的本地模型 {model_size}，开始下载...")
+                if not self.download(model_size):
+                    raise Exception("无法下载模型")
+        return self.model_path(model_size)
+
+    def repair(self, model_size: str) -> str:
+        """模型加载失败时调用：按清单完整校验每个文件，删除损坏的文件后重新下载"""
+        model_path = self.model_path(model_size)
+        with self._lock(model_size):
+            manifest = self._load_local_manifest(model_path)
+            for filename in model_files(model_size):
+                file_path = os.path.join(model_path, filename)
+                if not os.path.exists(file_path):
+                    continue
+                try:
+                    _verify_file(file_path, manifest.get(filename, {}))
+                except Exception as e:
+                    print(f"模型文件 {filename} 校验失败: {e}，将重新下载")
+                    os.remove(file_path)
+            if not self.download(model_size):
+                raise Exception("无法下载模型")
+        return model_path
+
+    @contextmanager
+    def _lock(self, model_size: str):
+        with self._guard:
+            lock = self._locks.setdefault(model_size, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            with open(os.path.join(self.root, f".{model_size}.lock"), "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def is_complete(self, model_size: str, quiet: bool = False) -> bool:
+        """检查模型文件是否已完整存在（有下载清单时同时校验文件大小）"""
+        model_path = self.model_path(model_size)
+        manifest = self._load_local_manifest(model_path)
         
         # 检查每个文件是否存在
-        all_files_exist = True
-        for filename in required_files:
+        for filename in model_files(model_size):
             file_path = os.path.join(model_path, filename)
             if not os.path.exists(file_path):
-                print(f"缺少模型文件: {filename}")
-                all_files_exist = False
-                break
-        
-        return all_files_exist
-        
-    def download_model(self, use_mirror: bool = True) -> bool:
-        """下载模型文件，使用镜像站点"""
-        model_size = WHISPER_MODEL_SIZE
+                if not quiet:
+                    print(f"缺少模型文件: {filename}")
+                return False
+            expected = manifest.get(filename, {}).get("size")
+            if expected is not None and os.path.getsize(file_path) != expected:
+                if not quiet:
+                    print(f"模型文件大小不符: {filename}")
+                return False
+        return True
+
+    def download(self, model_size: str, use_mirror: bool = True, base_url: Optional[str] = None) -> bool:
+        """下载模型文件，使用镜像站点
+
+        各文件并发下载，先写入 .part 临时文件，中断后用 HTTP Range 续传；下载完成后按
+        清单校验大小和哈希，再原子重命名为正式文件。base_url 可指向任意兼容的镜像。
+        """
         print(f"开始从镜像站点下载 {model_size} 模型...")
         
         # 使用镜像站点
-        base_url = "https://hf-mirror.com" if use_mirror else "https://huggingface.co"
-        repo_id = f"guillaumekln/faster-whisper-{model_size}"
+        if base_url is None:
+            base_url = MODEL_MIRROR or ("https://hf-mirror.com" if use_mirror else "https://huggingface.co")
+        repo_id, files = MODEL_REPOS.get(model_size, (f"guillaumekln/faster-whisper-{model_size}", MODEL_FILES))
         
         # 创建模型目录
-        model_dir = os.path.join(self.model_dir, model_size)
+        model_dir = self.model_path(model_size)
         os.makedirs(model_dir, exist_ok=True)
-        
-        # 需要下载的文件列表
-        files_to_download = [
-            "model.bin",
-            "config.json",
-            "tokenizer.json",
-            "vocabulary.txt"
-        ]
-        
-        # 下载文件
-        for filename in files_to_download:
-            file_path = os.path.join(model_dir, filename)
-            
-            if os.path.exists(file_path):
+
+        manifest = self._fetch_manifest(base_url, repo_id, files)
+        pending = [name for name in files if not os.path.exists(os.path.join(model_dir, name))]
+        for filename in files:
+            if filename not in pending:
                 print(f"文件 {filename} 已存在，跳过下载")
+
+        with ThreadPoolExecutor(max_workers=max(1, len(pending)), thread_name_prefix="model-download") as executor:
+            futures = {
+                filename: executor.submit(
+                    self._download_file,
+                    f"{base_url}/{repo_id}/resolve/main/{filename}",
+                    os.path.join(model_dir, filename),
+                    manifest.get(filename, {}),
+                )
+                for filename in pending
+            }
+            ok = True
+            for filename, future in futures.items():
+                try:
+                    # 清单缺失时记录 Content-Length 作为期望大小
+                    manifest[filename] = future.result()
+                    print(f"{filename} 下载完成")
+                except Exception as e:
+                    print(f"下载 {filename} 失败: {e}")
+                    ok = False
+
+        if ok:
+            local_manifest = self._load_local_manifest(model_dir)
+            local_manifest.update({name: info for name, info in manifest.items() if info})
+            with open(os.path.join(model_dir, MODEL_MANIFEST_NAME), "w", encoding="utf-8") as f:
+                json.dump(local_manifest, f, indent=2)
+        return ok
+
+    @staticmethod
+    def _load_local_manifest(model_path: str) -> Dict:
+        manifest_path = os.path.join(model_path, MODEL_MANIFEST_NAME)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _fetch_manifest(base_url: str, repo_id: str, files: list) -> Dict:
+        """从镜像的模型文件列表接口获取各文件的大小与哈希，失败时返回空清单（只校验 Content-Length）"""
+        try:
+            response = requests.get(f"{base_url}/api/models/{repo_id}/tree/main", timeout=30)
+            response.raise_for_status()
+            entries = response.json()
+        except Exception as e:
+            print(f"获取模型文件清单失败，将跳过哈希校验: {e}")
+            return {}
+
+        manifest = {}
+        for entry in entries:
+            if entry.get("type") != "file" or entry.get("path") not in files:
                 continue
-            
-            url = f"{base_url}/{repo_id}/resolve/main/{filename}"
-            print(f"下载 {filename} 从 {url}...")
-            
+            lfs = entry.get("lfs") or {}
+            if lfs.get("oid"):
+                # LFS 文件的 oid 是内容的 sha256
+                manifest[entry["path"]] = {"size": lfs.get("size", entry.get("size")), "sha256": lfs["oid"]}
+            else:
+                # 普通文件的 oid 是 git blob 哈希
+                manifest[entry["path"]] = {"size": entry.get("size"), "git_sha1": entry.get("oid")}
+        return manifest
+
+    @staticmethod
+    def _download_file(url: str, file_path: str, expected: Dict, retries: int = 3) -> Dict:
+        """下载单个文件：断点续传到 .part，校验通过后原子重命名，返回实际使用的校验信息"""
+        part_path = file_path + ".part"
+        for attempt in range(retries + 1):
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
             try:
-                response = requests.get(url, stream=True)
-                response.raise_for_status()
-                
-                total_size = int(response.headers.get('content-length', 0))
-                block_size = 1024  # 1 KB
-                downloaded = 0
-                
-                with open(file_path, 'wb') as f:
-                    for data in response.iter_content(block_size):
-                        downloaded += len(data)
-                        f.write(data)
-                        
-                        # 显示下载进度
-                        done = int(50 * downloaded / total_size) if total_size > 0 else 0
-                        sys.stdout.write(f"\r[{'=' * done}{' ' * (50-done)}] {downloaded/1024/1024:.2f}/{total_size/1024/1024:.2f} MB")
-                        sys.stdout.flush()
-                
-                print(f"\n{filename} 下载完成")
-                
-            except Exception as e:
-                print(f"下载 {filename} 失败: {e}")
-                if os.path.exists(file_path):
-                    os.remove(file_path)  # 删除可能部分下载的文件
-                return False
-        
-        return True
-        
-    def transcribe(self, audio_path: str) -> Dict:
-        """转录音频文件"""
-        model_size = WHISPER_MODEL_SIZE
-        model_path = os.path.join(self.model_dir, model_size)
-        
-        # 检查是否存在全局模型目录
-        global_model_path = os.path.join(DEFAULT_MODEL_DIR, model_size)
-        global_model_exists = os.path.exists(os.path.join(global_model_path, "model.bin"))
+                with requests.get(url, headers=headers, stream=True, timeout=(10, 60)) as response:
+                    if response.status_code == 416:
+                        # 临时文件已经完整
+                        break
+                    response.raise_for_status()
+                    if offset and response.status_code != 206:
+                        # 服务器不支持 Range，从头下载
+                        offset = 0
+                    total_size = expected.get("size")
+                    if total_size is None and response.headers.get("content-length"):
+                        total_size = offset + int(response.headers["content-length"])
+                        expected = dict(expected, size=total_size)
+                    if offset:
+                        print(f"续传 {os.path.basename(file_path)}，已完成 {offset / 1024 / 1024:.2f} MB")
+                    with open(part_path, "ab" if offset else "wb") as f:
+                        for data in response.iter_content(MODEL_DOWNLOAD_CHUNK):
+                            f.write(data)
+                break
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                print(f"下载 {os.path.basename(file_path)} 中断: {e}，准备续传 ({attempt + 1}/{retries})")
+                time.sleep(min(10, 2 ** attempt))
+
+        try:
+            _verify_file(part_path, expected)
+        except Exception:
+            os.remove(part_path)  # 校验失败的文件无法续传，删除后下次重新下载
+            raise
+        os.replace(part_path, file_path)
+        return expected
+
+
+
+_MODEL_STORES: Dict[str, ModelStore] = {}
+
+
+def get_model_store(root: str = DEFAULT_MODEL_DIR) -> ModelStore:
+    """同一目录共享一个 ModelStore 实例（以及其中的锁）"""
+    key = os.path.abspath(root)
+    if key not in _MODEL_STORES:
+        _MODEL_STORES[key] = ModelStore(root)
+    return _MODEL_STORES[key]
+
+
+class WhisperTranscriber:
+    """使用Faster-Whisper转录音频"""
+    
+    def __init__(self, model_dir: str = DEFAULT_MODEL_DIR, model_size: str = WHISPER_MODEL_SIZE):
+        self.model_dir = model_dir
+        self.model_size = model_size
+        self.store = get_model_store(model_dir)
+    
+    def check_model_files(self) -> bool:
+        """检查模型文件是否已完整存在"""
+        return self.store.is_complete(self.model_size)
         
-        # 优先使用全局模型目录
-        if global_model_exists:
-            print(f"发现全局模型目录 {global_model_path}，将使用该目录")
-            model_path = global_model_path
+    def download_model(self, use_mirror: bool = True, base_url: Optional[str] = None) -> bool:
+        """下载模型文件，使用镜像站点"""
+        return self.store.download(self.model_size, use_mirror=use_mirror, base_url=base_url)
         
-        # 检查模型文件是否完整存在
-        if os.path.exists(os.path.join(model_path, "model.bin")):
-            print(f"发现本地模型 {model_size}，直接加载...")
+    def transcribe(self, audio, on_segment: Optional[Callable] = None, resume_from: float = 0.0) -> Transcript:
+        """转录音频，audio 可以是音频文件路径或 16 kHz 单声道 PCM 数组；每得到一个片段回调 on_segment
+
+        resume_from 大于 0 时只转录该时间点之后的音频（用于从检查点继续），片段时间戳仍相对于整段音频。
+        """
+        if isinstance(audio, str):
+            audio = load_audio_pcm(audio)
+
+        if resume_from > 0:
+            print(f"从 {format_timestamp(resume_from)} 继续转录")
+            shift = lambda segment: segment._replace(
+                start=segment.start + resume_from, end=segment.end + resume_from
+            )
+            result = self.transcribe(
+                audio[int(resume_from * AUDIO_SAMPLE_RATE):],
+                on_segment=(lambda segment: on_segment(shift(segment))) if on_segment else None,
+            )
+            return result.shifted(resume_from)
+
+        with span("asr", model=self.model_size, engine=WHISPER_ENGINE) as asr_span:
+            asr_span["audio_seconds"] = round(len(audio) / AUDIO_SAMPLE_RATE, 3)
+            if LONG_AUDIO_WORKERS > 1 and len(audio) >= LONG_AUDIO_SECONDS * AUDIO_SAMPLE_RATE:
+                asr_span["mode"] = "parallel"
+                result = self.transcribe_parallel(audio, on_segment=on_segment)
+            else:
+                with self._timed_acquire() as model:
+                    result = self._run_transcription(model, audio, on_segment=on_segment)
+            asr_span["segments"] = len(result)
+        return result
+
+    def transcribe_parallel(self, audio: np.ndarray, on_segment: Optional[Callable] = None) -> Transcript:
+        """长音频模式：在静音处切块，由进程池并行转录后合并"""
+        model_path = self.store.ensure(self.model_size)
+
+        bounds = split_on_silence(audio, LONG_AUDIO_CHUNK_SECONDS)
+        print(f"长音频并行转录: {len(audio) / AUDIO_SAMPLE_RATE:.1f} 秒音频，"
+              f"切分为 {len(bounds)} 块，{LONG_AUDIO_WORKERS} 个进程")
+
+        pool = get_chunk_pool(model_path)
+        futures = [
+            pool.submit(whisper_worker.transcribe_chunk, np.ascontiguousarray(audio[start:end]),
+                        start / AUDIO_SAMPLE_RATE, AUDIO_SAMPLE_RATE)
+            for start, end in bounds
+        ]
+        results = []
+        for future in futures:
+            segments, language = future.result()
+            segments = [TranscriptSegment(*segment) for segment in segments]
+            results.append((segments, language))
+            if on_segment:
+                for segment in segments:
+                    on_segment(segment)
+
+        segments_list = merge_chunk_segments([segments for segments, _ in results])
+        language = results[0][1] if results else None
+        return Transcript.from_segments(segments_list, language)
+
+    @contextmanager
+    def _timed_acquire(self):
+        """借出模型，并把等待空闲副本（或首次加载）的时间记为排队等待"""
+        start = time.monotonic()
+        with self._acquire_model() as model:
+            record_queue_wait("model_pool", time.monotonic() - start)
+            yield model
+
+    def _acquire_model(self):
+        """从全局模型池借出模型，模型文件由共享模型仓库保证只下载一次"""
+        model_path = self.store.ensure(self.model_size)
+        size_bytes = os.path.getsize(os.path.join(model_path, "model.bin"))
+        pool_key = (os.path.abspath(model_path), WHISPER_COMPUTE_TYPE, WHISPER_DEVICE)
+        return WHISPER_POOL.acquire(pool_key, lambda: self._load_model(model_path), size_bytes)
+
+    def _load_model(self, model_path: str) -> faster_whisper.WhisperModel:
+        """加载模型，本地文件损坏时校验并重新下载"""
+        print(f"加载本地模型 {self.model_size}...")
+        with span("model_load", model=self.model_size):
             try:
-                model = WhisperModel(
-                    model_path,
-                    device="cpu", 
-                    compute_type="int8",
-                    local_files_only=True
-                )
+                return self._create_model(model_path)
             except Exception as e:
                 print(f"加载本地模型失败: {e}")
                 print("尝试重新下载...")
-                if not self.download_model():
-                    raise Exception("无法下载模型")
-                model = WhisperModel(
-                    model_path,
-                    device="cpu", 
-                    compute_type="int8",
-                    local_files_only=True
-                )
-        else:
-            print(f"未发现本地模型 {model_size}，开始下载...")
-            if self.download_model():
-                model = WhisperModel(
-                    model_path,
-                    device="cpu", 
-                    compute_type="int8",
-                    local_files_only=True
-                )
+                return self._create_model(self.store.repair(self.model_size))
+
+    def _create_model(self, model_path: str) -> faster_whisper.WhisperModel:
+        return faster_whisper.WhisperModel(
+            model_path,
+            device=WHISPER_DEVICE,
+            compute_type=WHISPER_COMPUTE_TYPE,
+            cpu_threads=WHISPER_CPU_THREADS,
+            local_files_only=True
+        )
+
+    def transcribe_stream(self, stream_url: str, headers: Dict,
+                          on_segment: Optional[Callable] = None) -> Transcript:
+        """边下载边转录音频流，每个片段转录完成后立即回调 on_segment"""
+        # 下载解码在独立线程中进行，通过有界队列限制缓冲的音频量
+        blocks = queue.Queue(maxsize=max(2, int(2 * STREAM_WINDOW_SECONDS / STREAM_BLOCK_SECONDS)))
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for block in iter_stream_pcm(stream_url, headers):
+                    while not stop.is_set():
+                        try:
+                            blocks.put(block, timeout=0.5)
+                            break
+                        except queue.Full:
+                            continue
+                    if stop.is_set():
+                        return
+                blocks.put(None)
+            except BaseException as e:
+                blocks.put(e)
+
+        producer = threading.Thread(target=produce, name="stream-decode", daemon=True)
+        producer.start()
+        try:
+            with span("asr", model=self.model_size, engine=WHISPER_ENGINE, mode="stream") as asr_span:
+                with self._timed_acquire() as model:
+                    result = self._run_stream_transcription(model, blocks, on_segment)
+                # 流式模式下解码与转录交错进行，音频时长取最后一个片段的结束时间
+                asr_span["audio_seconds"] = round(result.end, 3)
+                asr_span["segments"] = len(result)
+            return result
+        finally:
+            stop.set()
+
+    def _run_stream_transcription(self, model: faster_whisper.WhisperModel, blocks: queue.Queue,
+                                  on_segment: Optional[Callable]) -> Transcript:
+        """从队列读取 PCM 块，累积到窗口长度后在静音处切分并转录"""
+        window_samples = int(STREAM_WINDOW_SECONDS * AUDIO_SAMPLE_RATE)
+        window = np.zeros(0, dtype=np.float32)
+        offset = 0.0
+        segments_list = []
+        language = None
+        finished = False
+
+        while not finished:
+            block = blocks.get()
+            if block is None:
+                finished = True
+            elif isinstance(block, BaseException):
+                raise block
             else:
-                raise Exception("无法下载模型")
-        
+                window = np.concatenate([window, block])
+
+            while len(window) >= window_samples or (finished and len(window)):
+                cut = find_silence_cut(window[:window_samples]) if len(window) >= window_samples else len(window)
+                language = self._transcribe_window(model, window[:cut], offset, segments_list, on_segment)
+                offset += cut / AUDIO_SAMPLE_RATE
+                window = window[cut:]
+
+        print(f"流式转录完成: {offset:.1f} 秒音频")
+        return Transcript.from_segments(segments_list, language)
+
+    def _transcribe_window(self, model: faster_whisper.WhisperModel, audio: np.ndarray, offset: float,
+                           segments_list: list, on_segment: Optional[Callable]) -> str:
+        """转录一个窗口，片段时间加上窗口在整段音频中的偏移"""
+        segments, info = run_whisper(model, audio)
+        for segment in segments:
+            item = TranscriptSegment(segment.start + offset, segment.end + offset, segment.text)
+            segments_list.append(item)
+            if on_segment:
+                on_segment(item)
+        return info.language
+
+    def _run_transcription(self, model: faster_whisper.WhisperModel, audio: np.ndarray,
+                           on_segment: Optional[Callable] = None) -> Transcript:
+        """使用已加载的模型执行转录"""
         # 执行转录
-        print(f"开始转录: {audio_path}")
-        segments, info = model.transcribe(audio_path, language="zh", beam_size=5)
+        audio_seconds = len(audio) / AUDIO_SAMPLE_RATE
+        print(f"开始转录: {audio_seconds:.1f} 秒音频（引擎: {WHISPER_ENGINE}，beam_size: {WHISPER_BEAM_SIZE}）")
+        start = time.time()
+        segments, info = run_whisper(model, audio)
         
         # 打印检测到的语言和概率
         print(f"检测到语言: '{info.language}' (概率: {info.language_probability:.2f})")
         
-        # 收集所有文本片段
-        full_text = ""
-        segments_list = list(segments)  # 将生成器转换为列表
-        
-        for segment in segments_list:
-            full_text += segment.text + " "
-        
-        return {
-            "full_text": full_text.strip(),
-            "segments": segments_list,
-            "language": info.language
-        }
+        # 只保留起止时间与文本（以及开启时的逐词时间戳），不保留 faster-whisper 的 tokens 等字段
+        segments_list = []
+        words_list = []
+        for segment in segments:  # 逐个消费生成器
+            item = TranscriptSegment(segment.start, segment.end, segment.text)
+            segments_list.append(item)
+            words_list.append([(word.start, word.end, word.word) for word in segment.words or ()])
+            if on_segment:
+                on_segment(item)
+        elapsed = time.time() - start
+        if audio_seconds > 0:
+            print(f"转录耗时 {elapsed:.2f} 秒，实时率 RTF={elapsed / audio_seconds:.3f}")
+        return Transcript.from_segments(
+            segments_list, info.language, words=words_list if WHISPER_WORD_TIMESTAMPS else None
+        )
 
-class NotesGenerator:
-    """使用LLM生成笔记"""
-    
-    def __init__(self, api_base: str = API_BASE, 
-                 api_key: str = API_KEY,
-                 model: str = MODEL_NAME):
-        self.api_base = api_base
-        self.api_key = api_key
-        self.model = model
-        
-    def generate_notes(self, transcript_text: str, video_title: str = "", tags: str = "") -> str:
-        """根据转录文本生成笔记"""
-        print("开始生成笔记...")
-        
-        # 构建提示词
-        prompt = f"""
+class LLMClient:
+    """所有任务共享的异步 chat/completions 客户端
+
+    复用 httpx.AsyncClient 的连接池（keep-alive），设置连接/读取超时，对 429 与 5xx
+    做带抖动的指数退避重试，并用进程级信号量限制全局并发请求数。
+    AsyncClient 绑定事件循环：all 角色下 MCP 服务与任务执行器各有一个事件循环，
+    每个循环各自缓存一个客户端，并发上限由跨循环共享的 threading.BoundedSemaphore 保证。
+    """
+
+    RETRY_STATUS = {429, 500, 502, 503, 504}
+
+    def __init__(self, max_concurrency: int = LLM_CONCURRENCY, max_retries: int = LLM_MAX_RETRIES):
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self._limit = threading.BoundedSemaphore(max_concurrency)
+        # 事件循环 -> 客户端；循环被回收后条目自动删除
+        self._clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, httpx.AsyncClient]" = \
+            weakref.WeakKeyDictionary()
+        self._clients_lock = threading.Lock()
+
+    def _client(self) -> httpx.AsyncClient:
+        """当前事件循环的客户端，首次使用时创建"""
+        loop = asyncio.get_running_loop()
+        with self._clients_lock:
+            client = self._clients.get(loop)
+            if client is None:
+                client = self._clients[loop] = httpx.AsyncClient(
+                    timeout=httpx.Timeout(LLM_READ_TIMEOUT, connect=LLM_CONNECT_TIMEOUT),
+                    limits=httpx.Limits(
+                        max_connections=self.max_concurrency,
+                        max_keepalive_connections=self.max_concurrency,
+                    ),
+                )
+        return client
+
+    @asynccontextmanager
+    async def _slot(self):
+        """占用一个全局并发名额；线程信号量不能在事件循环中阻塞等待，名额用尽时短暂休眠后重试"""
+        waited = time.monotonic()
+        delay = 0.005
+        while not self._limit.acquire(blocking=False):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 0.1)
+        record_queue_wait("llm", time.monotonic() - waited)
+        try:
+            yield
+        finally:
+            self._limit.release()
+
+    async def chat(self, api_base: str, api_key: str, payload: Dict) -> Dict:
+        """发送 chat/completions 请求并返回 JSON 响应"""
+        client = self._client()
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        async with self._slot():
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                try:
+                    response = await client.post(
+                        f"{api_base}/chat/completions", headers=headers, json=payload
+                    )
+                    if response.status_code not in self.RETRY_STATUS or attempt == self.max_retries:
+                        response.raise_for_status()
+                        return response.json()
+                    print(f"LLM 接口返回 {response.status_code}，准备重试 ({attempt + 1}/{self.max_retries})")
+                    retry_after = response.headers.get("retry-after")
+                except httpx.TransportError as e:
+                    if attempt == self.max_retries:
+                        raise
+                    print(f"LLM 请求失败: {e}，准备重试 ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    async def chat_stream(self, api_base: str, api_key: str, payload: Dict,
+                          on_delta: Callable[[str], None], usage: Optional[Dict] = None) -> str:
+        """以 stream 模式请求 chat/completions，每收到一段增量文本回调 on_delta，返回完整文本
+
+        只有在收到第一段文本之前失败才会重试，避免重复推送已发送的内容。
+        提供 usage 字典时，接口在数据块中返回的 usage（实际 token 数）写入其中。
+        """
+        client = self._client()
+        headers = {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        }
+        payload = dict(payload, stream=True)
+        if LLM_STREAM_USAGE:
+            payload["stream_options"] = {"include_usage": True}
+        async with self._slot():
+            for attempt in range(self.max_retries + 1):
+                retry_after = None
+                parts = []
+                try:
+                    async with client.stream(
+                        "POST", f"{api_base}/chat/completions", headers=headers, json=payload
+                    ) as response:
+                        if response.status_code in self.RETRY_STATUS and attempt < self.max_retries:
+                            print(f"LLM 接口返回 {response.status_code}，准备重试 ({attempt + 1}/{self.max_retries})")
+                            retry_after = response.headers.get("retry-after")
+                        else:
+                            if response.is_error:
+                                await response.aread()
+                                response.raise_for_status()
+                            async for line in response.aiter_lines():
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[len("data:"):].strip()
+                                if data == "[DONE]":
+                                    break
+                                chunk = json.loads(data)
+                                if usage is not None and chunk.get("usage"):
+                                    usage.update(chunk["usage"])
+                                choices = chunk.get("choices") or []
+                                delta = (choices[0].get("delta") or {}).get("content") if choices else None
+                                if delta:
+                                    parts.append(delta)
+                                    on_delta(delta)
+                            return "".join(parts)
+                except httpx.TransportError as e:
+                    if parts or attempt == self.max_retries:
+                        raise
+                    print(f"LLM 请求失败: {e}，准备重试 ({attempt + 1}/{self.max_retries})")
+                await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    @staticmethod
+    def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+        if retry_after and retry_after.isdigit():
+            return float(retry_after)
+        return random.uniform(0, min(30.0, 2.0 ** attempt))
+
+    async def aclose(self):
+        """关闭当前事件循环的客户端（事件循环结束前调用）"""
+        with self._clients_lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+
+LLM_CLIENT = LLMClient()
+
+
+# 笔记提示词模板
+NOTES_SYSTEM_PROMPT = "你是一个专业的笔记助手，擅长将视频转录内容整理成笔记。"
+NOTES_TEMPERATURE = 0.7
+NOTES_PROMPT_TEMPLATE = """
 你是一个专业的笔记助手，擅长将视频转录内容整理成清晰、有条理且信息丰富的笔记。
 
 语言要求：
@@ -256,7 +2550,7 @@ class NotesGenerator:
 - 如果要加粗并保留编号，应使用 `1\\. **内容**`（加反斜杠），防止被误解析为有序列表。
 - 或者使用 `## 1. 内容` 的形式作为标题。
 
-视频转录内容：
+视频转录内容（每段开头的 [mm:ss] 是该段在视频中的起始时间，请据此标注时间标记）：
 
 ---
 {transcript_text}
@@ -278,44 +2572,311 @@ class NotesGenerator:
 
 请提供完整的笔记内容。
 """
+# 单次生成时转录内容前的说明，汇总提示词把它替换为分段摘要的说明
+NOTES_TRANSCRIPT_HEADER = "视频转录内容（每段开头的 [mm:ss] 是该段在视频中的起始时间，请据此标注时间标记）："
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
+
+# 分段总结（map）提示词：长视频按时间窗口分别总结
+NOTES_MAP_PROMPT_TEMPLATE = """
+下面是视频《{video_title}》第 {index}/{total} 段的转录内容，每行开头的 [mm:ss] 是该句在视频中的时间。
+
+---
+{transcript_text}
+---
+
+请用 **中文** 为这一段写一份详细的要点摘要：
+1. 按时间顺序列出主要话题，每个话题开头保留其起始时间，格式为 `[mm:ss]`。
+2. 保留重要事实、示例、结论、建议和数学公式（LaTeX 语法）。
+3. 省略广告、填充词、问候语和不相关的言论。
+4. 只返回摘要内容，不要添加额外说明。
+"""
+
+# 汇总（reduce）提示词：把各段摘要整理为最终笔记
+NOTES_REDUCE_PROMPT_TEMPLATE = NOTES_PROMPT_TEMPLATE.replace(
+    NOTES_TRANSCRIPT_HEADER,
+    "视频分段摘要（按时间顺序排列，[mm:ss] 为该内容在视频中的时间，请据此标注时间标记）：",
+)
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按每字 1 个计，其余字符按每 4 个 1 个计"""
+    cjk = len(re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]", text))
+    return cjk + (len(text) - cjk) // 4
+
+
+def format_timestamp(seconds: float) -> str:
+    """把秒数格式化为 mm:ss"""
+    seconds = int(seconds)
+    return f"{seconds // 60:02d}:{seconds % 60:02d}"
+
+
+# 单独出现的语气词（前后是标点、空白或首尾），连同其后的逗号一起去掉
+_FILLER_RE = re.compile(
+    r"(?<![^\s，,。！？!?、])(?:嗯|呃|额|唔|啊|哦|um|uh|erm)(?:[\s，,、]*(?:嗯|呃|额|唔|啊|哦|um|uh|erm))*"
+    r"(?=[\s，,。！？!?、]|$)[\s，,、]*",
+    re.IGNORECASE,
+)
+# 同一短语（4 字以上）连续重复三次以上（ASR 的重复幻觉），只保留一次；不含数字，避免改动数值。
+# 更短的单位（如“对对对”“哈哈”）常是真实的强调，只有连续八次以上时才压缩为三次
+_REPEAT_RE = re.compile(r"(\D{4,20}?)\1{2,}")
+_SHORT_REPEAT_RE = re.compile(r"(\D{1,3}?)\1{7,}")
+# Whisper 在静音或音乐处常见的幻觉文本；去掉标点和空白后整句与之相同才丢弃，
+# 句中顺带提到（如“感谢观看本期视频的……”）的不受影响
+_HALLUCINATION_RE = re.compile(
+    r"字幕由.{0,20}提供|(?:请不吝)?点赞.{0,4}订阅.{0,4}转发.{0,4}打赏(?:支持)?(?:明镜与点点栏目)?"
+    r"|.{0,12}amaraorg.{0,12}|.{0,8}yoyotelevision.{0,20}"
+    r"|(?:感谢|谢谢)(?:大家|各位)?(?:的)?(?:收看|观看)|thanks?(?:you)?forwatching",
+    re.IGNORECASE,
+)
+_HALLUCINATION_STRIP_RE = re.compile(r"[\W_]+")
+_SENTENCE_END = tuple("。！？，、；：,.!?;:")
+
+
+def clean_segment_text(text: str) -> str:
+    """去掉语气词、重复短语与常见幻觉文本，返回空字符串表示整句可以丢弃"""
+    text = text.strip()
+    if not text or _HALLUCINATION_RE.fullmatch(_HALLUCINATION_STRIP_RE.sub("", text)):
+        return ""
+    text = _FILLER_RE.sub("", text)
+    text = _REPEAT_RE.sub(r"\1", _SHORT_REPEAT_RE.sub(r"\1\1\1", text))
+    return text.strip(" ，,、")
+
+
+def encode_transcript_paragraphs(segments, paragraph_seconds: float = NOTES_PARAGRAPH_SECONDS,
+                                 clean: bool = True) -> List[Tuple[float, str]]:
+    """把转录片段清理后合并为段落，返回 [(段落起始时间, 文本)]
+
+    连续重复的片段只保留一次；段落超过 paragraph_seconds 秒，或已超过三分之一且遇到 2 秒以上的停顿时换段。
+    clean=False 时保留原始文本（检索索引使用，被清理掉的内容也能检索到）。
+    """
+    paragraphs = []
+    parts = []
+    start = last_end = 0.0
+    last_text = None
+    for segment in segments:
+        text = clean_segment_text(segment.text) if clean else segment.text.strip()
+        if not text or text == last_text:
+            continue
+        last_text = text
+        if parts:
+            elapsed = segment.start - start
+            pause = segment.start - last_end
+            if elapsed >= paragraph_seconds or (pause >= 2.0 and elapsed >= paragraph_seconds / 3):
+                paragraphs.append((start, _join_sentences(parts)))
+                parts = []
+        if not parts:
+            start = segment.start
+        parts.append(text)
+        last_end = segment.end
+    if parts:
+        paragraphs.append((start, _join_sentences(parts)))
+    return paragraphs
+
+
+def _join_sentences(parts: list) -> str:
+    # 前一句以标点结尾时直接相连，否则用一个空格分隔
+    text = parts[0]
+    for part in parts[1:]:
+        text += part if text.endswith(_SENTENCE_END) else " " + part
+    return text
+
+
+def encode_transcript(segments, paragraph_seconds: float = NOTES_PARAGRAPH_SECONDS) -> str:
+    """提示词中的转录内容：每行一个段落，开头为段落起始时间 [mm:ss]"""
+    return "\n".join(
+        f"[{format_timestamp(start)}] {text}" for start, text in encode_transcript_paragraphs(segments, paragraph_seconds)
+    )
+
+
+def transcript_token_report(segments, encoded: str) -> Dict:
+    """比较转录的几种写法的估算 token 数：不带时间的全文、逐句标注时间、段落编码"""
+    segments = list(segments)
+    report = {
+        "untimed": estimate_tokens(" ".join(segment.text.strip() for segment in segments)),
+        "per_segment": estimate_tokens("\n".join(
+            f"[{format_timestamp(segment.start)}] {segment.text.strip()}" for segment in segments
+        )),
+        "encoded": estimate_tokens(encoded),
+    }
+    report["saved_percent"] = round(100 * (1 - report["encoded"] / report["per_segment"]), 1) if report["per_segment"] else 0.0
+    return report
+
+
+def split_transcript_windows(segments: list, max_tokens: int) -> list:
+    """把转录按段落编码后按 token 预算切分为若干窗口，每个窗口是若干行 "[mm:ss] 段落" """
+    windows = []
+    lines = []
+    tokens = 0
+    for start, text in encode_transcript_paragraphs(segments):
+        line = f"[{format_timestamp(start)}] {text}"
+        line_tokens = estimate_tokens(line)
+        if lines and tokens + line_tokens > max_tokens:
+            windows.append("\n".join(lines))
+            lines = []
+            tokens = 0
+        lines.append(line)
+        tokens += line_tokens
+    if lines:
+        windows.append("\n".join(lines))
+    return windows
+
+
+class NotesGenerator:
+    """使用LLM生成笔记"""
+    
+    def __init__(self, api_base: str = API_BASE, 
+                 api_key: str = API_KEY,
+                 model: str = MODEL_NAME):
+        self.api_base = api_base
+        self.api_key = api_key
+        self.model = model
+        # 最近一次生成笔记时转录编码的 token 统计（transcript_token_report）
+        self.token_report: Optional[Dict] = None
+
+    def prompt_hash(self) -> str:
+        """提示词、转录清理规则、模型与采样参数的指纹，用作笔记缓存键的一部分"""
+        fingerprint = json.dumps(
+            [NOTES_SYSTEM_PROMPT, NOTES_PROMPT_TEMPLATE, NOTES_MAP_PROMPT_TEMPLATE,
+             NOTES_REDUCE_PROMPT_TEMPLATE, NOTES_CHUNK_TOKENS, NOTES_PARAGRAPH_SECONDS,
+             [regex.pattern for regex in (_FILLER_RE, _REPEAT_RE, _SHORT_REPEAT_RE, _HALLUCINATION_RE)],
+             self.model, NOTES_TEMPERATURE],
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(fingerprint.encode("utf-8")).hexdigest()[:16]
+        
+    async def generate_notes(self, transcript_text: str, video_title: str = "", tags: str = "",
+                             segments: Optional[list] = None,
+                             on_delta: Optional[Callable[[str], None]] = None,
+                             on_chunk: Optional[Callable[[int, int], None]] = None,
+                             summaries: Optional[Dict[int, str]] = None,
+                             on_summary: Optional[Callable[[int, str], None]] = None) -> str:
+        """根据转录文本生成笔记；提供分段且转录超出 token 预算时使用分段总结再汇总的方式
+
+        提供分段时，提示词中使用按段落合并并标注起始时间的转录（encode_transcript），
+        各种写法的 token 数记录在 token_report 中。on_delta 不为空时以流式方式生成最终笔记并逐段回调增量文本；on_chunk(完成数, 总数)
+        在每段总结完成后回调。summaries 为已完成的分段总结（按序号），这些分段不再请求；
+        on_summary(序号, 总结) 在每段总结成功后回调，用于保存检查点。
+        """
+        if segments:
+            transcript_text = encode_transcript(segments)
+            self.token_report = transcript_token_report(segments, transcript_text)
+            print(f"转录编码: 逐句标注时间 {self.token_report['per_segment']} tokens -> "
+                  f"按段落标注 {self.token_report['encoded']} tokens（节省 {self.token_report['saved_percent']}%，"
+                  f"不带时间的全文 {self.token_report['untimed']} tokens）")
+
+        if segments and self.token_report["encoded"] > NOTES_CHUNK_TOKENS:
+            return await self.generate_notes_map_reduce(
+                segments, video_title=video_title, tags=tags, on_delta=on_delta, on_chunk=on_chunk,
+                summaries=summaries, on_summary=on_summary,
+            )
+
+        print("开始生成笔记...")
         
+        # 构建提示词
+        prompt = NOTES_PROMPT_TEMPLATE.format(
+            video_title=video_title,
+            tags=tags,
+            transcript_text=transcript_text,
+        )
+        return await self._chat(prompt, on_delta=on_delta)
+
+    async def generate_notes_map_reduce(self, segments: list, video_title: str = "", tags: str = "",
+                                        on_delta: Optional[Callable[[str], None]] = None,
+                                        on_chunk: Optional[Callable[[int, int], None]] = None,
+                                        summaries: Optional[Dict[int, str]] = None,
+                                        on_summary: Optional[Callable[[int, str], None]] = None) -> str:
+        """长转录：按 token 预算切分窗口并发总结（map），再汇总生成最终笔记（reduce）"""
+        windows = split_transcript_windows(segments, NOTES_CHUNK_TOKENS)
+        done_summaries = dict(summaries or {})
+        print(f"转录内容较长，分为 {len(windows)} 段并发总结（并发数 {NOTES_MAP_CONCURRENCY}，"
+              f"已完成 {len(done_summaries)} 段）...")
+
+        limit = asyncio.Semaphore(NOTES_MAP_CONCURRENCY)
+        done = 0
+
+        async def summarize(index: int, window: str) -> str:
+            nonlocal done
+            summary = done_summaries.get(index)
+            if not summary:
+                prompt = NOTES_MAP_PROMPT_TEMPLATE.format(
+                    video_title=video_title,
+                    index=index + 1,
+                    total=len(windows),
+                    transcript_text=window,
+                )
+                async with limit:
+                    summary = await self._chat(prompt)
+                if summary and on_summary:
+                    on_summary(index, summary)
+            done += 1
+            if on_chunk:
+                on_chunk(done, len(windows))
+            return summary
+
+        summaries = await asyncio.gather(*(summarize(index, window) for index, window in enumerate(windows)))
+
+        if not all(summaries):
+            print("分段总结失败，无法生成笔记")
+            return ""
+
+        print("分段总结完成，开始汇总生成笔记...")
+        prompt = NOTES_REDUCE_PROMPT_TEMPLATE.format(
+            video_title=video_title,
+            tags=tags,
+            transcript_text="\n\n".join(
+                f"### 第 {index + 1} 段\n{summary}" for index, summary in enumerate(summaries)
+            ),
+        )
+        return await self._chat(prompt, on_delta=on_delta)
+
+    async def _chat(self, prompt: str, on_delta: Optional[Callable[[str], None]] = None) -> str:
+        """调用 chat/completions 接口，失败时返回空字符串；提供 on_delta 时使用流式响应"""
         data = {
             "model": self.model,
             "messages": [
                 {
                     "role": "system",
-                    "content": "你是一个专业的笔记助手，擅长将视频转录内容整理成笔记。"
+                    "content": NOTES_SYSTEM_PROMPT
                 },
                 {
                     "role": "user",
                     "content": prompt
                 }
             ],
-            "temperature": 0.7
+            "temperature": NOTES_TEMPERATURE
         }
         
-        try:
-            response = requests.post(f"{self.api_base}/chat/completions", headers=headers, json=data)
-            response.raise_for_status()
-            result = response.json()
-            return result["choices"][0]["message"]["content"]
-        except Exception as e:
-            print(f"调用API失败: {e}")
-            if 'response' in locals() and response:
-                print(f"响应状态码: {response.status_code}")
-                print(f"响应内容: {response.text}")
-            return ""
+        with span("llm", model=self.model, stream=bool(on_delta)) as llm_span:
+            llm_span["prompt_tokens"] = estimate_tokens(NOTES_SYSTEM_PROMPT + prompt)
+            try:
+                if on_delta:
+                    usage = {}
+                    content = await LLM_CLIENT.chat_stream(self.api_base, self.api_key, data, on_delta, usage=usage)
+                else:
+                    result = await LLM_CLIENT.chat(self.api_base, self.api_key, data)
+                    content = result["choices"][0]["message"]["content"]
+                    usage = result.get("usage") or {}
+                # 接口返回 usage 时使用实际 token 数，否则使用估算值
+                llm_span["prompt_tokens"] = usage.get("prompt_tokens") or llm_span["prompt_tokens"]
+                llm_span["completion_tokens"] = usage.get("completion_tokens") or estimate_tokens(content)
+                return content
+            except PipelineCancelled:
+                raise
+            except Exception as e:
+                llm_span["error"] = str(e)
+                print(f"调用API失败: {e}")
+                if isinstance(e, httpx.HTTPStatusError):
+                    print(f"响应状态码: {e.response.status_code}")
+                    print(f"响应内容: {e.response.text}")
+                return ""
 
 # 实现MCP工具
 @mcp.tool()
-async def generate_bilibili_notes(video_url: str) -> str:
+async def generate_bilibili_notes(video_url: str, ctx: Optional[Context] = None) -> str:
     """
     从B站视频生成笔记。该工具会下载视频音频，转录为文本，然后生成结构化笔记。
+    处理过程中通过进度通知推送下载百分比、转录位置和已生成的字数，
+    生成中的笔记文本以日志消息（logger: notes）增量推送。
     
     Args:
         video_url: B站视频链接，例如 https://www.bilibili.com/video/BV1z65TzuE94
@@ -323,52 +2884,286 @@ async def generate_bilibili_notes(video_url: str) -> str:
     Returns:
         str: 生成的笔记内容（Markdown格式）
     """
+    try:
+        return await _generate_notes(video_url, ctx)
+    except Exception as e:
+        error_message = f"生成笔记失败: {str(e)}"
+        print(error_message)
+        return error_message
+
+
+async def _generate_notes(video_url: str, ctx: Optional[Context] = None) -> str:
+    """生成一个视频的笔记，失败时抛出异常"""
+    if SERVER_ROLE == "frontend":
+        # 前端只入队，由工作进程执行，这里等待结果
+        job = await _enqueue_job(video_url)
+        return await _wait_for_job(job["id"], ctx)
+
+    # 规范化链接，同一视频（BV号+分P）的并发请求只执行一次流水线
+    canonical_url, video_id, part = await resolve_video_url(video_url)
+    flight_key = (video_id, part) if video_id else canonical_url
+    return await INFLIGHT.do(
+        flight_key,
+        lambda progress: _generate_notes_pipeline(canonical_url, video_id, part, progress),
+        ctx=ctx,
+    )
+
+
+async def _generate_notes_pipeline(video_url: str, video_id: Optional[str], part: int,
+                                   progress: PipelineProgress,
+                                   checkpoint: Optional[JobCheckpoint] = None) -> str:
+    """下载、转录并生成笔记的完整流水线
+
+    提供 checkpoint 时（后台任务），音频保存在任务目录中，各阶段产物写入检查点，
+    重新执行时从最近的检查点继续。失败（包括 LLM 没有返回笔记内容）时抛出异常。
+    """
     # 记录开始时间
     start_time = time.time()
     
-    # 创建临时目录
-    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-    output_dir = f"downloads_{timestamp}"
-    
-    # 检查全局模型目录是否存在
-    global_model_dir = DEFAULT_MODEL_DIR
-    model_path = os.path.join(global_model_dir, WHISPER_MODEL_SIZE)
-    
-    # 如果全局目录不存在或不完整，则使用临时目录
-    model_dir = global_model_dir
-    if not (os.path.exists(model_path) and 
-            os.path.exists(os.path.join(model_path, "model.bin"))):
-        model_dir = f"models_{timestamp}"
+    # 临时目录（位于受预算管理的暂存区中）只在需要音频文件时才创建，缓存命中不触碰暂存区
+    output_dir = checkpoint.output_dir if checkpoint is not None else None
+
+    async def ensure_workdir() -> str:
+        nonlocal output_dir
+        if output_dir is None:
+            output_dir = await run_stage(
+                "storage", SCRATCH.create_workdir, f"{video_id}_p{part}" if video_id else "download"
+            )
+        else:
+            os.makedirs(output_dir, exist_ok=True)
+        return output_dir
     
-    os.makedirs(output_dir, exist_ok=True)
+    notes_generator = NotesGenerator()
+    prompt_hash = notes_generator.prompt_hash()
+    cache_hits = []
+    resumed = []
+    completed = False
     
     try:
-        # 步骤1: 下载视频音频
-        downloader = BilibiliDownloader(output_dir=output_dir)
-        audio_info = downloader.download_audio(video_url)
+        audio_info = transcript = notes = None
+        if video_id:
+            audio_info = await run_stage("storage", RESULT_CACHE.get, "audio", video_id, part)
+            cached_notes = await run_stage(
+                "storage", RESULT_CACHE.get, "notes", video_id, part, WHISPER_MODEL_SIZE, prompt_hash
+            )
+            if isinstance(cached_notes, dict):
+                # 笔记条目带有生成时的视频信息，音频元数据缓存过期也不需要重新下载音频
+                notes = cached_notes["notes"]
+                audio_info = audio_info or cached_notes["audio"]
+            else:
+                # 旧版本只缓存了笔记文本
+                notes = cached_notes
+            # 笔记命中时转录不是必需的（只用于补建检索索引），转录缓存被淘汰也直接返回笔记
+            transcript = await run_stage("storage", load_cached_transcript, video_id, part)
+        need_transcript = notes is None
+        
+        if checkpoint is not None and transcript is None and checkpoint.get("transcript"):
+            transcript = Transcript.restore(checkpoint.get("transcript"))
+            resumed.append("转录")
+        
+        # 视频已有字幕（UP主字幕或 AI 字幕）时直接转换为转录，跳过下载音频与转录
+        probe = None
+        if transcript is None and need_transcript and SUBTITLE_POLICY == "prefer":
+            try:
+                with span("subtitle", video_id=video_id, part=part) as subtitle_span:
+                    # 探测只读取视频信息，不写文件，不需要临时目录
+                    downloader = BilibiliDownloader(output_dir=SCRATCH.work_dir)
+                    probe = await run_stage("download", downloader.probe_video, video_url)
+                    subtitle_span["found"] = probe["subtitle"] is not None
+            except Exception as e:
+                print(f"查找字幕失败，改为转录音频: {e}")
+            if probe and probe["subtitle"]:
+                subtitle = probe["subtitle"]
+                transcript = Transcript.from_segments(
+                    subtitle["segments"], subtitle_language(subtitle["lang"]), source=f"subtitle:{subtitle['lang']}"
+                )
+                audio_info = {k: v for k, v in probe.items() if k not in ('subtitle', 'info')}
+                if not video_id:
+                    video_id, part = parse_bilibili_url(audio_info['video_id'])
+                if video_id:
+                    await run_stage("storage", RESULT_CACHE.set, "audio", (video_id, part), audio_info)
+                    await run_stage("storage", store_cached_transcript, video_id, part, transcript)
+                if checkpoint is not None:
+                    checkpoint.save("audio", audio_info)
+                    checkpoint.save("transcript", transcript.to_bytes())
+                progress.emit("transcribe", 1, f"使用视频字幕（{subtitle['lang']}）", force=True)
+        
+        # 步骤1: 下载视频音频（已有转录缓存、笔记缓存或使用字幕时可跳过）
+        need_audio = audio_info is None or (transcript is None and need_transcript)
+        if need_audio and checkpoint is not None:
+            saved_audio = checkpoint.get("audio")
+            # 已有转录时只需要音频元数据，否则还需要任务目录中的音频文件仍然存在
+            if saved_audio and (transcript is not None or os.path.exists(saved_audio['file_path'])):
+                audio_info = saved_audio
+                need_audio = False
+                resumed.append("音频")
+        elif not need_audio and not (probe and probe["subtitle"]):
+            cache_hits.append("音频元数据")
+
+        # 暂存区中保留了同一视频的音频时跳过下载（还需要缓存的音频元数据）
+        if need_audio and video_id and audio_info is not None and SCRATCH.retain_audio:
+            retained = SCRATCH.reuse_audio(video_id, part, await ensure_workdir())
+            if retained:
+                audio_info = dict(audio_info, file_path=retained)
+                need_audio = False
+                cache_hits.append("音频文件")
+                if checkpoint is not None:
+                    checkpoint.save("audio", audio_info)
+        
+        if need_audio:
+            downloader = BilibiliDownloader(output_dir=await ensure_workdir())
+            progress.emit("download", 0, "开始下载音频", force=True)
+            # 后台任务需要可以从断点继续，始终把音频下载到任务目录
+            with span("download", video_id=video_id, part=part) as download_span:
+                if TRANSCRIBE_MODE == "stream" and checkpoint is None:
+                    audio_info = await run_stage("download", downloader.resolve_audio_stream, video_url)
+                else:
+                    audio_info = await run_stage(
+                        "download", downloader.download_audio, video_url,
+                        progress_hook=lambda event: _report_download(progress, event),
+                        info=probe["info"] if probe else None,
+                    )
+                if audio_info.get("file_path"):
+                    SCRATCH.track(audio_info["file_path"])
+                download_span["bytes"] = audio_info.get("bytes_downloaded")
+                download_span["format_id"] = audio_info.get("format_id")
+            progress.emit("download", 1, "音频准备完成", force=True)
+            if not video_id:
+                video_id, part = parse_bilibili_url(audio_info['video_id'])
+            if video_id:
+                await run_stage("storage", RESULT_CACHE.set, "audio", (video_id, part), audio_metadata(audio_info))
+            if checkpoint is not None:
+                checkpoint.save("audio", audio_info)
         
         # 步骤2: 转录音频
-        transcriber = WhisperTranscriber(model_dir=model_dir)
-        transcript = transcriber.transcribe(audio_info['file_path'])
+        if transcript is None and need_transcript:
+            transcriber = WhisperTranscriber()
+            duration = audio_info.get('duration') or 0
+
+            def on_segment(segment: TranscriptSegment):
+                _report_transcription(progress, segment, duration)
+                if checkpoint is not None:
+                    checkpoint.add_segment(segment)
+
+            if checkpoint is not None:
+                # 从已保存的最后一个片段结束处继续转录
+                partial = list(checkpoint.segments)
+                resume_from = partial[-1].end if partial else 0.0
+                if partial:
+                    resumed.append(f"转录片段（{format_timestamp(resume_from)} 之前）")
+                rest = await run_stage(
+                    "transcribe", transcriber.transcribe, audio_info['file_path'],
+                    on_segment=on_segment, resume_from=resume_from,
+                )
+                transcript = Transcript.from_segments(merge_chunk_segments([partial, rest]), rest.language)
+                checkpoint.save("transcript", transcript.to_bytes())
+            elif audio_info.get('stream_url'):
+                transcript = await run_stage(
+                    "transcribe", transcriber.transcribe_stream,
+                    audio_info['stream_url'], audio_info['http_headers'],
+                    on_segment=on_segment,
+                )
+            else:
+                transcript = await run_stage(
+                    "transcribe", transcriber.transcribe, audio_info['file_path'], on_segment=on_segment
+                )
+            progress.emit("transcribe", 1, "转录完成", force=True)
+            if video_id:
+                await run_stage("storage", store_cached_transcript, video_id, part, transcript)
+        elif transcript is None:
+            # 笔记命中且转录缓存已被淘汰，不需要转录
+            pass
+        elif not transcript.source.startswith("subtitle:"):
+            cache_hits.append("转录")
+        elif not (probe and probe["subtitle"]):
+            cache_hits.append("字幕转录")
+        
+        # 转录写入全文检索索引（缓存中已有但尚未索引的转录也在这里补建），失败不影响生成笔记
+        if video_id and transcript is not None and SEARCH_INDEX.enabled:
+            try:
+                if not await run_stage("storage", SEARCH_INDEX.is_indexed, video_id, part, transcript):
+                    await run_stage("storage", SEARCH_INDEX.add, video_id, part, audio_info.get('title'), transcript)
+            except Exception as e:
+                print(f"写入检索索引失败: {e}")
         
         # 步骤3: 生成笔记
-        notes_generator = NotesGenerator()
-        notes = notes_generator.generate_notes(
-            transcript["full_text"], 
-            video_title=audio_info['title'],
-            tags=""
-        )
+        if notes is None:
+            char_count = 0
+            summaries = {}
+            if checkpoint is not None:
+                saved = checkpoint.get("summaries")
+                if saved and saved["prompt_hash"] == prompt_hash:
+                    summaries = {int(index): summary for index, summary in saved["items"].items()}
+                    resumed.append(f"{len(summaries)} 段分段总结")
+
+            def on_summary(index: int, summary: str):
+                summaries[index] = summary
+                if checkpoint is not None:
+                    checkpoint.save("summaries", {"prompt_hash": prompt_hash, "items": summaries})
+
+            def on_delta(text: str):
+                # 流式增量的个数不等于 token 数，进度按已生成的字符数计算
+                nonlocal char_count
+                char_count += len(text)
+                progress.emit_text(text)
+                progress.emit("llm", 0.5 + 0.5 * min(1.0, char_count / 4000), f"已生成 {char_count} 字")
+
+            notes = await notes_generator.generate_notes(
+                transcript.full_text,
+                video_title=audio_info['title'],
+                tags="",
+                segments=transcript,
+                on_delta=on_delta,
+                on_chunk=lambda done, total: progress.emit(
+                    "llm", 0.5 * done / total, f"分段总结 {done}/{total}", force=True
+                ),
+                summaries=summaries,
+                on_summary=on_summary,
+            )
+            progress.emit_text("", force=True)
+            progress.emit("llm", 1, "笔记生成完成", force=True)
+            if notes and video_id:
+                await run_stage(
+                    "storage", RESULT_CACHE.set, "notes", (video_id, part, WHISPER_MODEL_SIZE, prompt_hash),
+                    {"notes": notes, "audio": audio_metadata(audio_info)},
+                )
+            if not notes:
+                raise RuntimeError("LLM 没有返回笔记内容" + (
+                    "，已保存的检查点会在重新提交时继续使用" if checkpoint is not None else ""
+                ))
+        else:
+            cache_hits.append("笔记")
         
-        # 删除音频文件
-        if os.path.exists(audio_info['file_path']):
-            os.remove(audio_info['file_path'])
-            print(f"已删除音频文件: {audio_info['file_path']}")
+        # 保留（开启音频保留时）或删除音频文件
+        with span("postprocess", video_id=video_id, part=part):
+            audio_path = audio_info.get('file_path')
+            if audio_path and os.path.exists(audio_path):
+                retained_path = SCRATCH.keep_audio(video_id, part, audio_path) if video_id else None
+                if retained_path:
+                    print(f"已保留音频文件: {retained_path}")
+                else:
+                    os.remove(audio_path)
+                    print(f"已删除音频文件: {audio_path}")
             
         # 记录结束时间
         end_time = time.time()
         processing_time = end_time - start_time
+        METRICS.observe("duration_seconds", "pipeline", processing_time)
         
         # 添加处理信息
+        if transcript is not None and transcript.source.startswith("subtitle:"):
+            transcript_source = f"转录来源: 视频字幕（{transcript.source[len('subtitle:'):]}）"
+        else:
+            transcript_source = f"使用模型: faster-whisper-{WHISPER_MODEL_SIZE}"
+        extra_info = ""
+        if notes_generator.token_report:
+            report = notes_generator.token_report
+            extra_info += (f"- 提示词转录: {report['encoded']} tokens（逐句标注时间为 {report['per_segment']} tokens，"
+                           f"节省 {report['saved_percent']}%）\n")
+        extra_info += f"- 断点续传: {'、'.join(resumed)}\n" if resumed else ""
+        if need_audio and audio_info.get('bytes_downloaded'):
+            extra_info += (f"- 下载音频: {audio_info['bytes_downloaded'] / 1024 / 1024:.2f} MB"
+                            f"（格式 {audio_info.get('format_id')}，{audio_info.get('abr') or '?'} kbps）\n")
         processing_info = f"""
 ---
 
@@ -376,28 +3171,389 @@ async def generate_bilibili_notes(video_url: str) -> str:
 - 视频标题: {audio_info['title']}
 - 视频ID: {audio_info['video_id']}
 - 处理时间: {processing_time:.2f} 秒
-- 使用模型: faster-whisper-{WHISPER_MODEL_SIZE}
-- 生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+- {transcript_source}
+- 缓存命中: {"、".join(cache_hits) or "无"}
+{extra_info}- 生成时间: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
 
 ---
 """
         
+        completed = True
         return notes + processing_info
         
-    except Exception as e:
-        error_message = f"生成笔记失败: {str(e)}"
-        print(error_message)
-        return error_message
+    except asyncio.CancelledError:
+        # 通知仍在工作线程中运行的阶段尽快退出
+        progress.cancel()
+        raise
     finally:
-        # 清理临时文件
-        if os.path.exists(output_dir):
-            import shutil
-            shutil.rmtree(output_dir, ignore_errors=True)
-        
-        # 如果使用的是临时模型目录，也清理它
-        if model_dir != global_model_dir and os.path.exists(model_dir):
-            import shutil
-            shutil.rmtree(model_dir, ignore_errors=True)
+        if checkpoint is not None and not completed:
+            # 保留任务目录与已转录的片段，重新执行时从这里继续（租约已失效时由新的持有者负责）
+            if checkpoint.segments and "transcript" not in checkpoint.data and not checkpoint.lease_lost:
+                checkpoint.save_segments()
+        elif output_dir is not None and os.path.exists(output_dir):
+            # 清理临时文件（删除目录可能较慢，不在事件循环中执行）
+            await run_stage("storage", SCRATCH.release_workdir, output_dir)
+
+def _report_download(progress: PipelineProgress, event: Dict):
+    """把 yt-dlp 下载进度事件转换为阶段进度"""
+    progress.check_cancelled()
+    if event.get("status") != "downloading":
+        return
+    total = event.get("total_bytes") or event.get("total_bytes_estimate") or 0
+    downloaded = event.get("downloaded_bytes") or 0
+    if total:
+        progress.emit("download", downloaded / total,
+                      f"下载音频 {downloaded / total:.0%} ({downloaded / 1024 / 1024:.1f} MB)")
+
+
+def _report_transcription(progress: PipelineProgress, segment: TranscriptSegment, duration: float):
+    """根据最新转录片段的结束时间上报转录位置"""
+    fraction = segment.end / duration if duration else 0
+    total = f" / {format_timestamp(duration)}" if duration else ""
+    progress.emit("transcribe", fraction, f"已转录到 {format_timestamp(segment.end)}{total}")
+
+
+class JobRunner:
+    """从持久化任务队列中领取并执行任务
+
+    与 MCP 请求的生命周期无关：客户端提交任务后即可断开，之后轮询状态和结果。
+    all 角色下在 MCP 服务进程的独立线程中运行；worker 角色下作为独立进程运行，
+    可以在多台主机上启动多个，共享同一个任务库，各自保持一个常驻的 Whisper 模型。
+    执行中的任务定期续约，进程崩溃后租约过期，任务由其他工作进程从检查点继续执行。
+    """
+
+    def __init__(self, store: JobStore, workers: int = JOB_WORKERS, worker_id: str = WORKER_ID):
+        self.store = store
+        self.workers = max(1, workers)
+        self.worker_id = worker_id
+        self._loop = None
+        self._wake = None
+        self._started = threading.Event()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """在后台线程中运行（all 角色）"""
+        with self._start_lock:
+            if self._started.is_set():
+                return
+            threading.Thread(target=self.run_forever, name="job-runner", daemon=True).start()
+            self._started.wait()
+
+    def run_forever(self):
+        """在当前线程中运行，直到进程退出（worker 角色）"""
+        asyncio.run(self._main())
+
+    def notify(self):
+        """有新任务时唤醒同一进程中空闲的工作协程；其他进程通过轮询发现新任务"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wake.set)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._started.set()
+        print(f"任务执行器 {self.worker_id} 已启动（{self.workers} 个并发任务）")
+        try:
+            await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+        finally:
+            await LLM_CLIENT.aclose()
+
+    async def _worker(self):
+        while True:
+            job = self.store.claim(self.worker_id)
+            if job is None:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._run_job(job)
+
+    async def _keep_lease(self, checkpoint: JobCheckpoint, task: asyncio.Task):
+        """定期续约；租约已被其他工作进程接手时停止写入并中止本地执行"""
+        while not task.done():
+            await asyncio.sleep(self.store.lease_seconds / 3)
+            if not self.store.renew_lease(checkpoint.job_id, checkpoint.token):
+                print(f"任务 {checkpoint.job_id} 的租约已失效，停止执行")
+                checkpoint.lease_lost = True
+                task.cancel()
+                return
+
+    async def _run_job(self, job: Dict):
+        job_id, token = job["id"], job["lease_token"]
+        print(f"开始执行任务 {job_id}（第 {job['attempts']} 次）: {job['video_url']}")
+        checkpoint = JobCheckpoint(self.store, job_id, token)
+        progress = PipelineProgress(
+            on_update=lambda stage, value, message: checkpoint.update(stage=stage, progress=value, message=message)
+        )
+        task = asyncio.ensure_future(_generate_notes_pipeline(
+            job["video_url"], job["video_id"], job["part"], progress, checkpoint=checkpoint
+        ))
+        lease = asyncio.ensure_future(self._keep_lease(checkpoint, task))
+        try:
+            result = await task
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            self.store.finish(job_id, token, status="failed", error=str(e))
+            print(f"任务 {job_id} 失败: {str(e)}")
+            return
+        finally:
+            lease.cancel()
+        if self.store.finish(job_id, token, status="done", progress=100, message="笔记生成完成", result=result):
+            checkpoint.clear()
+            print(f"任务 {job_id} 完成")
+
+
+JOB_RUNNER = LazyObject(lambda: JobRunner(JOB_STORE))
+
+
+def sweep_scratch():
+    """启动时清理暂存区：已退出进程遗留的临时目录、已完成或已删除任务的目录，再按预算淘汰保留的音频"""
+    SCRATCH.sweep_orphans()
+    if os.path.isdir(JOBS_DIR):
+        for job_id in os.listdir(JOBS_DIR):
+            job = JOB_STORE.get(job_id)
+            # 失败的任务保留目录，重新提交时从检查点继续
+            if job is None or job["status"] == "done":
+                shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+                print(f"清理任务目录: {job_id}")
+    SCRATCH.rescan()
+    SCRATCH.enforce_budget()
+
+
+def _job_status(job: Dict) -> Dict:
+    return {
+        "job_id": job["id"],
+        "video_url": job["video_url"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "progress": round(job["progress"], 1),
+        "message": job["message"],
+        "error": job["error"],
+        "attempts": job["attempts"],
+        "created_at": datetime.fromtimestamp(job["created_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+        "updated_at": datetime.fromtimestamp(job["updated_at"]).strftime("%Y-%m-%d %H:%M:%S"),
+    }
+
+
+@mcp.tool()
+async def submit_bilibili_notes_job(video_url: str) -> str:
+    """
+    提交一个后台笔记生成任务并立即返回任务ID，适合长视频。任务在服务端持久化，
+    服务重启后会从已完成的阶段继续。之后用 get_job_status 查询进度、用 get_job_result 获取笔记。
+    
+    Args:
+        video_url: B站视频链接，例如 https://www.bilibili.com/video/BV1z65TzuE94
+    
+    Returns:
+        str: JSON 格式的任务信息（job_id、status 等）
+    """
+    job = await _enqueue_job(video_url)
+    return json.dumps(_job_status(job), ensure_ascii=False)
+
+
+async def _enqueue_job(video_url: str) -> Dict:
+    """规范化链接后提交任务；frontend 角色只入队，由独立的工作进程执行"""
+    canonical_url, video_id, part = await resolve_video_url(video_url)
+    job = await run_stage("storage", JOB_STORE.submit, canonical_url, video_id, part)
+    if SERVER_ROLE != "frontend":
+        JOB_RUNNER.start()
+        JOB_RUNNER.notify()
+    return job
+
+
+async def _wait_for_job(job_id: str, ctx: Optional[Context] = None) -> str:
+    """等待任务完成并返回笔记，期间把任务进度转发为进度通知；任务失败时抛出异常"""
+    last_reported = None
+    while True:
+        job = await run_stage("storage", JOB_STORE.get, job_id)
+        if job is None:
+            raise RuntimeError(f"任务不存在: {job_id}")
+        if job["status"] == "done":
+            return job["result"]
+        if job["status"] == "failed":
+            raise RuntimeError(job["error"])
+        if ctx is not None and job["message"] and (job["progress"], job["message"]) != last_reported:
+            last_reported = (job["progress"], job["message"])
+            try:
+                await ctx.report_progress(job["progress"], 100, job["message"])
+            except Exception as e:
+                print(f"发送进度通知失败: {e}")
+        await asyncio.sleep(min(1.0, JOB_POLL_INTERVAL))
+
+
+@mcp.tool()
+async def get_job_status(job_id: str) -> str:
+    """
+    查询后台任务的状态：queued（排队中）、running（执行中）、done（已完成）、failed（失败）。
+    
+    Args:
+        job_id: submit_bilibili_notes_job 返回的任务ID
+    
+    Returns:
+        str: JSON 格式的任务状态，包括当前阶段、进度（0-100）和最近一条进度消息
+    """
+    job = await run_stage("storage", JOB_STORE.get, job_id)
+    if job is None:
+        return json.dumps({"job_id": job_id, "error": "任务不存在"}, ensure_ascii=False)
+    return json.dumps(_job_status(job), ensure_ascii=False)
+
+
+@mcp.tool()
+async def get_job_result(job_id: str) -> str:
+    """
+    获取后台任务生成的笔记。任务未完成时返回当前状态说明。
+    
+    Args:
+        job_id: submit_bilibili_notes_job 返回的任务ID
+    
+    Returns:
+        str: 生成的笔记内容（Markdown格式）
+    """
+    job = await run_stage("storage", JOB_STORE.get, job_id)
+    if job is None:
+        return f"任务不存在: {job_id}"
+    if job["status"] == "done":
+        return job["result"]
+    if job["status"] == "failed":
+        return f"任务失败: {job['error']}（重新提交同一视频会从已保存的进度继续）"
+    return f"任务尚未完成（{job['status']}，{job['progress']:.0f}%）: {job['message'] or '等待执行'}"
+
+
+async def _expand_batch(video_urls: List[str]) -> List[str]:
+    """展开批量链接：合集、收藏夹展开为视频，未指定分P的视频再展开全部分P；按视频ID+分P去重"""
+    async def expand(url: str) -> List[str]:
+        try:
+            return await run_stage("download", BilibiliDownloader.expand_playlist, url)
+        except Exception as e:
+            print(f"展开链接失败 {url}: {str(e)}")
+            return [url]
+
+    inputs = [url.strip() for url in video_urls if url.strip()]
+
+    async def expand_entry(url: str) -> List[str]:
+        # 合集或收藏夹中的条目可能是多P视频，再展开一层；输入的链接本身已经展开过
+        return [url] if url in inputs else await expand(url)
+
+    top_level = await asyncio.gather(*(expand(url) for url in inputs))
+    nested = await asyncio.gather(*(expand_entry(url) for urls in top_level for url in urls))
+
+    items, seen = [], set()
+    for url in (url for urls in nested for url in urls):
+        video_id, part = parse_bilibili_url(url)
+        key = (video_id, part) if video_id else url
+        if key in seen:
+            continue
+        seen.add(key)
+        items.append(url)
+    if len(items) > BATCH_MAX_ITEMS:
+        print(f"批量视频数 {len(items)} 超过上限 {BATCH_MAX_ITEMS}，只处理前 {BATCH_MAX_ITEMS} 个")
+    return items[:BATCH_MAX_ITEMS]
+
+
+@mcp.tool()
+async def generate_bilibili_notes_batch(video_urls: List[str], ctx: Optional[Context] = None) -> str:
+    """
+    批量为多个B站视频生成笔记。支持普通视频、多P视频（展开全部分P）、合集和收藏夹链接。
+    各视频的下载、转录、笔记生成交错执行（下一个视频的下载与当前视频的转录重叠），
+    每完成一个视频就通过日志消息（logger: batch）推送该视频的笔记，并上报完成数量。
+    
+    Args:
+        video_urls: B站视频、多P视频、合集或收藏夹链接列表
+    
+    Returns:
+        str: 所有视频的笔记（按完成顺序）以及整体吞吐统计（Markdown格式）
+    """
+    start_time = time.time()
+    items = await _expand_batch(video_urls)
+    if not items:
+        return "没有可处理的视频链接"
+    total = len(items)
+    print(f"批量生成笔记: {total} 个视频，流水线并发 {BATCH_CONCURRENCY}")
+    if ctx is not None:
+        await ctx.report_progress(0, total, f"共 {total} 个视频")
+
+    # 限制同时在流水线中的视频数，避免一次下载全部音频；各阶段的并发由阶段线程池控制
+    limit = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run_item(index: int, url: str) -> Tuple[int, str, str, bool]:
+        async with limit:
+            try:
+                return index, url, await _generate_notes(url), False
+            except Exception as e:
+                print(f"生成笔记失败: {url}: {str(e)}")
+                return index, url, f"生成笔记失败: {str(e)}", True
+
+    sections = []
+    succeeded = 0
+    audio_seconds = 0.0
+    for future in asyncio.as_completed([run_item(index, url) for index, url in enumerate(items)]):
+        index, url, notes, failed = await future
+        video_id, part = parse_bilibili_url(url)
+        audio_info = await run_stage("storage", RESULT_CACHE.get, "audio", video_id, part) if video_id else None
+        title = (audio_info or {}).get("title") or url
+        if not failed:
+            succeeded += 1
+            audio_seconds += (audio_info or {}).get("duration") or 0
+        section = f"## [{index + 1}/{total}] {title}\n\n{notes}"
+        sections.append(section)
+        done = len(sections)
+        print(f"批量进度 {done}/{total}: {title}{'（失败）' if failed else ''}")
+        if ctx is not None:
+            try:
+                await ctx.report_progress(done, total, f"已完成 {done}/{total}: {title}")
+                await ctx.log("info", section, logger_name="batch")
+            except Exception as e:
+                print(f"发送进度通知失败: {e}")
+
+    elapsed = time.time() - start_time
+    speed = f"{audio_seconds / elapsed:.2f} 倍实时" if audio_seconds and elapsed > 0 else "未知"
+    summary = f"""
+---
+
+**批量处理信息**:
+- 视频数: {total}（成功 {succeeded}，失败 {total - succeeded}）
+- 总耗时: {elapsed:.2f} 秒
+- 音频总时长: {audio_seconds / 60:.1f} 分钟
+- 吞吐: {total / elapsed * 60:.2f} 个视频/分钟，{speed}
+- 流水线并发: {BATCH_CONCURRENCY}
+
+---
+"""
+    return "\n\n".join(sections) + summary
+
+
+@mcp.tool()
+async def search_transcripts(query: str, video_id: str = "", limit: int = 10) -> str:
+    """
+    在已处理过的视频转录中按关键词检索，无需重新下载和转录。适合在同一系列课程或视频中查找
+    某个知识点出现的位置。
+    
+    Args:
+        query: 关键词，多个关键词用空格分隔（同时包含才命中）
+        video_id: 只在该视频（BV号）中检索，留空检索全部
+        limit: 返回的最大结果数（默认10）
+    
+    Returns:
+        str: JSON 格式的检索结果，每条包括视频ID、分P、标题、时间点、跳转链接和上下文片段
+    """
+    start = time.monotonic()
+    hits = await run_stage("storage", SEARCH_INDEX.search, query, video_id or None, max(1, min(limit, 50)))
+    results = []
+    for hit in hits:
+        link = f"https://www.bilibili.com/video/{hit['video_id']}/?t={int(hit['start'])}"
+        if hit["part"] > 1:
+            link += f"&p={hit['part']}"
+        results.append(dict(hit, timestamp=format_timestamp(hit["start"]), url=link))
+    return json.dumps({
+        "query": query,
+        "count": len(results),
+        "took_ms": round((time.monotonic() - start) * 1000, 1),
+        "results": results,
+    }, ensure_ascii=False)
+
 
 @mcp.tool()
 async def get_current_time() -> str:
@@ -432,6 +3588,112 @@ async def get_current_time() -> str:
     
     return result
 
+@contextmanager
+def startup_phase(name: str):
+    """记录一个启动阶段的耗时（秒）"""
+    start = time.time()
+    try:
+        yield
+    finally:
+        STARTUP_METRICS["phases"][name] = round(time.time() - start, 3)
+
+
+def mark_ready():
+    """标记服务就绪，并记录从进程启动到就绪的总耗时"""
+    STARTUP_METRICS["phases"]["ready"] = round(time.time() - _PROCESS_START, 3)
+    SERVER_READY.set()
+    print(f"服务就绪 (profile={STARTUP_PROFILE})，启动耗时 {STARTUP_METRICS['phases']['ready']:.2f} 秒")
+
+
+def warmup():
+    """warm 模式：导入重量级依赖、准备并加载模型、用一秒静音试解码，完成后再标记就绪"""
+    try:
+        with startup_phase("heavy_imports"):
+            for module in (np, av, yt_dlp, requests, faster_whisper, faster_whisper_vad):
+                module.load()
+
+        transcriber = WhisperTranscriber()
+        with startup_phase("model_fetch"):
+            transcriber.store.ensure(transcriber.model_size)
+        with startup_phase("model_load"):
+            with transcriber._acquire_model():
+                pass
+        with startup_phase("warmup_decode"):
+            with transcriber._acquire_model() as model:
+                segments, _ = run_whisper(model, np.zeros(AUDIO_SAMPLE_RATE, dtype=np.float32))
+                list(segments)
+    except Exception as e:
+        # 预热失败不阻塞服务，首个请求会按需重新加载
+        print(f"预热失败: {str(e)}")
+        STARTUP_METRICS["warmup_error"] = str(e)
+    finally:
+        mark_ready()
+
+
+def server_status() -> Dict:
+    """就绪状态与内存中的运行信息，不读磁盘，/health 直接返回"""
+    return {
+        "ready": SERVER_READY.is_set(),
+        "role": SERVER_ROLE,
+        "worker_id": WORKER_ID,
+        "profile": STARTUP_PROFILE,
+        "startup": STARTUP_METRICS,
+        "model_pool": WHISPER_POOL.stats(),
+    }
+
+
+def storage_status() -> Dict:
+    """暂存区等需要访问磁盘的状态，在存储线程池中读取"""
+    return {
+        "scratch_bytes": SCRATCH.usage(),
+        "search_index": SEARCH_INDEX.stats(),
+    }
+
+
+@mcp.tool()
+async def get_server_status() -> str:
+    """
+    查询服务状态：是否就绪、启动配置、各启动阶段耗时、模型池中已加载的模型，以及暂存区占用与检索索引规模。
+
+    Returns:
+        str: JSON 格式的状态信息
+    """
+    status = server_status()
+    status.update(await run_stage("storage", storage_status))
+    return json.dumps(status, ensure_ascii=False)
+
+
+@mcp.custom_route("/metrics", methods=["GET"])
+async def metrics(request):
+    """Prometheus 指标：各阶段耗时与排队等待的直方图、字节数、音频秒数、token 数和峰值内存"""
+    from starlette.responses import PlainTextResponse
+
+    return PlainTextResponse(METRICS.render(), media_type="text/plain; version=0.0.4")
+
+
+@mcp.custom_route("/health", methods=["GET"])
+async def health(request):
+    """健康检查：预热完成前返回 503，供负载均衡或编排系统判断是否可以接流量"""
+    from starlette.responses import JSONResponse
+
+    return JSONResponse(server_status(), status_code=200 if SERVER_READY.is_set() else 503)
+
+
 if __name__ == "__main__":
+    STARTUP_METRICS["phases"]["module_import"] = round(time.time() - _PROCESS_START, 3)
+    sweep_scratch()
+    if SERVER_ROLE == "worker":
+        # 工作进程：先加载常驻模型，再从共享队列领取任务，不提供 MCP 服务
+        warmup()
+        JOB_RUNNER.run_forever()
+        sys.exit(0)
+
+    if STARTUP_PROFILE == "warm" and SERVER_ROLE != "frontend":
+        threading.Thread(target=warmup, name="warmup", daemon=True).start()
+    else:
+        mark_ready()
+    if SERVER_ROLE != "frontend":
+        # 启动后台任务执行器，继续上次未完成的任务
+        JOB_RUNNER.start()
     # 初始化并运行服务器
     mcp.run(transport='sse')  # 服务器发送事件
@@ -0,0 +1,49 @@
+"""长音频并行转录的工作进程入口
+
+进程池以 spawn 方式启动工作进程，工作进程反序列化任务时只导入本模块：这里没有模块级的初始化，
+不会打开结果缓存、任务库、检索索引，也不会创建 MCP 服务。解码参数由主进程通过 initargs 传入，
+本模块不读取环境变量。
+"""
+from typing import Dict, List, Optional, Tuple
+
+# 工作进程中常驻的模型与解码参数
+_MODEL = None
+_OPTIONS: Dict = {}
+
+
+def run_whisper(model, audio, engine: str = "sequential", language: Optional[str] = None,
+                beam_size: int = 5, batch_size: int = 8, word_timestamps: bool = False):
+    """按指定的解码引擎与解码参数执行转录，返回 faster-whisper 的 (segments, info)"""
+    import faster_whisper
+
+    if engine == "batched":
+        pipeline = faster_whisper.BatchedInferencePipeline(model=model)
+        return pipeline.transcribe(
+            audio, language=language, beam_size=beam_size, batch_size=batch_size, word_timestamps=word_timestamps,
+        )
+    return model.transcribe(audio, language=language, beam_size=beam_size, word_timestamps=word_timestamps)
+
+
+def init_chunk_worker(model_path: str, device: str, compute_type: str, cpu_threads: int, options: Dict):
+    """进程池初始化：每个工作进程加载一个模型"""
+    import faster_whisper
+
+    global _MODEL, _OPTIONS
+    _MODEL = faster_whisper.WhisperModel(
+        model_path,
+        device=device,
+        compute_type=compute_type,
+        cpu_threads=cpu_threads,
+        local_files_only=True
+    )
+    _OPTIONS = options
+
+
+def transcribe_chunk(audio, offset: float, sample_rate: int) -> Tuple[List[Tuple[float, float, str]], str]:
+    """转录一个音频块，返回 ([(开始, 结束, 文本)], 语言)；时间戳加上块偏移并截断到块范围内"""
+    chunk_end = offset + len(audio) / sample_rate
+    segments, info = run_whisper(_MODEL, audio, **_OPTIONS)
+    return [
+        (segment.start + offset, min(segment.end + offset, chunk_end), segment.text)
+        for segment in segments
+    ], info.language
@@ -0,0 +1,603 @@
+"""离线基准测试：端到端笔记流水线
+
+不访问网络：用合成音频生成不同时长的 m4a 样本，由本地 HTTP 服务提供下载；
+yt-dlp 使用伪造的 B 站提取器返回这些音频流（仍经过真实的格式选择与下载器）；
+LLM 请求发送到本地 OpenAI 兼容的桩服务，首 token 延迟、预填充速率与生成速率可配置。
+本地没有 Whisper 模型时使用按给定实时率（RTF）产出片段的伪转录，解码、下载、
+分段总结与流式生成等其余环节仍走真实代码。
+
+按并发等级运行一组请求，统计各阶段（subtitle、download、decode、asr、llm、postprocess）的
+p50/p95 耗时、吞吐、排队等待、转录实时率、端到端延迟与峰值内存，结果写入 JSON，
+并可与基线结果比较，超出允许的退化比例时以非零状态退出。
+
+指定 --engines / --beam-sizes 时，另外对每个样本音频按 解码引擎 × beam_size 的组合单独计时转录
+（不含下载与解码），输出各组合的转录实时率（RTF）。
+
+在 demo 目录下运行（真实转录使用 demo/models 中的模型）：
+    python ../tests/benchmark_pipeline.py --concurrency 1,4 --output bench.json
+    python ../tests/benchmark_pipeline.py --baseline bench.json
+    python ../tests/benchmark_pipeline.py --asr real --lengths 30,120 --concurrency 1 --requests 1 \\
+        --engines sequential,batched --beam-sizes 1,5
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import logging
+import functools
+import platform
+import subprocess
+import tempfile
+import threading
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, SimpleHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import av
+import numpy as np
+import yt_dlp
+from yt_dlp.extractor.common import InfoExtractor
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "demo")
+
+# 样本音频的采样率与各档码率（kbps），对应 B 站常见的 30216 / 30232 音频流
+FIXTURE_SAMPLE_RATE = 44100
+FIXTURE_FORMATS = {"30216": 64, "30232": 132}
+
+
+def synth_speech(seconds: float, rate: int = FIXTURE_SAMPLE_RATE, seed: int = 0) -> np.ndarray:
+    """合成类似语音节奏的音频：每 4 秒一句，3.2 秒按音节调幅的谐波音，其余为静音"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * rate)) / rate
+    pitch = 140 + 40 * np.sin(2 * np.pi * 0.3 * t)
+    phase = 2 * np.pi * np.cumsum(pitch) / rate
+    voice = sum(np.sin(k * phase) / k for k in range(1, 5))
+    syllables = 0.5 * (1 + np.sin(2 * np.pi * 4 * t))
+    voiced = (t % 4.0) < 3.2
+    noise = 0.01 * rng.standard_normal(len(t))
+    return (0.3 * voice * syllables * voiced + noise).astype(np.float32)
+
+
+def write_m4a(path: str, pcm: np.ndarray, bitrate_kbps: int, rate: int = FIXTURE_SAMPLE_RATE):
+    """用 PyAV 把 PCM 编码为 AAC（m4a 容器）"""
+    with av.open(path, "w", format="mp4") as container:
+        stream = container.add_stream("aac", rate=rate)
+        stream.bit_rate = bitrate_kbps * 1000
+        stream.layout = "mono"
+        frame_size = 1024
+        for start in range(0, len(pcm), frame_size):
+            frame = av.AudioFrame.from_ndarray(pcm[None, start:start + frame_size], format="fltp", layout="mono")
+            frame.sample_rate = rate
+            for packet in stream.encode(frame):
+                container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+
+def prepare_fixtures(fixture_dir: str, lengths: list) -> dict:
+    """为每个时长生成各档码率的样本音频（已存在时复用），返回 {时长: {format_id: 文件名}}"""
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures = {}
+    for seconds in lengths:
+        pcm = None
+        fixtures[seconds] = {}
+        for format_id, abr in FIXTURE_FORMATS.items():
+            name = f"{seconds}s_{abr}k.m4a"
+            path = os.path.join(fixture_dir, name)
+            if not os.path.exists(path):
+                if pcm is None:
+                    pcm = synth_speech(seconds, seed=seconds)
+                print(f"生成样本音频: {name}")
+                write_m4a(path + ".part", pcm, abr)
+                os.replace(path + ".part", path)
+            fixtures[seconds][format_id] = name
+    return fixtures
+
+
+class QuietFileHandler(SimpleHTTPRequestHandler):
+    """提供样本音频下载的静态文件服务"""
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    """OpenAI 兼容的 /chat/completions 桩服务，支持 stream 与非 stream 响应"""
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        config = self.server.config
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        prompt = "".join(message["content"] for message in body["messages"])
+        prompt_tokens = self.server.count_tokens(prompt)
+        with self.server.lock:
+            self.server.stats["requests"] += 1
+            self.server.stats["prompt_tokens"] += prompt_tokens
+            self.server.stats["completion_tokens"] += config.tokens
+
+        # 首 token 延迟 = 固定延迟 + 预填充时间
+        time.sleep(config.latency + (prompt_tokens / config.prefill_tps if config.prefill_tps else 0))
+        tokens = [f"要点{index % 10}" if index % 16 else "\n- " for index in range(config.tokens)]
+
+        if not body.get("stream"):
+            time.sleep(config.tokens / config.tps)
+            self._send_json({
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": config.tokens},
+            })
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        start = time.monotonic()
+        for index, token in enumerate(tokens):
+            delay = start + index / config.tps - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n")
+        if (body.get("stream_options") or {}).get("include_usage"):
+            usage = {"prompt_tokens": prompt_tokens, "completion_tokens": config.tokens}
+            self._write_chunk(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n")
+        self._write_chunk("data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _send_json(self, payload: dict):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _write_chunk(self, text: str):
+        data = text.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+
+def start_server(server: ThreadingHTTPServer) -> str:
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+class FakeBilibiliIE(InfoExtractor):
+    """伪造的 B 站提取器：按视频ID返回本地样本音频的各档音频流"""
+
+    _VALID_URL = r"https?://(?:www\.)?bilibili\.com/video/(?P<id>BV[0-9A-Za-z]{10})"
+    # 视频ID -> (时长, {format_id: 下载地址}, 是否带字幕)
+    VIDEOS = {}
+
+    def _real_extract(self, url):
+        video_id = self._match_id(url)
+        seconds, urls, with_subtitle = self.VIDEOS[video_id]
+        subtitles = {"danmaku": [{"ext": "xml", "url": f"{urls['30216']}.xml"}]}
+        if with_subtitle:
+            subtitles["zh-CN"] = [{"ext": "json", "data": fixture_subtitle_json(seconds)}]
+        return {
+            "id": video_id,
+            "title": f"基准测试样本 {video_id}（{seconds} 秒）",
+            "duration": seconds,
+            "formats": [
+                {
+                    "format_id": format_id, "url": urls[format_id], "ext": "m4a",
+                    "acodec": "mp4a.40.2", "vcodec": "none", "abr": abr,
+                }
+                for format_id, abr in FIXTURE_FORMATS.items()
+            ],
+            "subtitles": subtitles,
+        }
+
+
+def fixture_subtitle_json(seconds: float, line_seconds: float = 4.0) -> str:
+    """B站字幕 JSON 格式的样本字幕（body 中每行 from/to/content）"""
+    body = []
+    start = 0.0
+    while start < seconds:
+        end = min(seconds, start + line_seconds)
+        body.append({"from": start, "to": end, "content": f"第{len(body) + 1}句，这是用于基准测试的样本字幕。"})
+        start = end
+    return json.dumps({"body": body}, ensure_ascii=False)
+
+
+class BenchYoutubeDL(yt_dlp.YoutubeDL):
+    """B 站链接只交给伪造的提取器处理，其余行为与 yt-dlp 一致"""
+
+    def __init__(self, params=None, auto_init=True):
+        super().__init__(dict(params or {}, proxy=""), auto_init)
+        self.add_info_extractor(FakeBilibiliIE())
+
+    def extract_info(self, url, download=True, ie_key=None, *args, **kwargs):
+        if ie_key is None and FakeBilibiliIE.suitable(url):
+            ie_key = FakeBilibiliIE.ie_key()
+        return super().extract_info(url, download, ie_key, *args, **kwargs)
+
+
+class FakeWhisperModel:
+    """伪转录使用的占位模型"""
+
+
+def fake_run_whisper(model, audio, rtf: float, sample_rate: int, segment_seconds: float = 4.0):
+    """按给定实时率逐个产出 4 秒一句的合成片段，接口与 run_whisper 一致"""
+    seconds = len(audio) / sample_rate
+
+    def segments():
+        start, index = 0.0, 0
+        while start < seconds:
+            end = min(seconds, start + segment_seconds)
+            time.sleep((end - start) * rtf)
+            yield SimpleNamespace(start=start, end=end, words=None,
+                                  text=f"第{index + 1}句，这是用于基准测试的合成转录内容，编号{index}。")
+            start, index = end, index + 1
+
+    return segments(), SimpleNamespace(language="zh", language_probability=1.0)
+
+
+def percentile(values: list, q: float) -> float:
+    """最近秩百分位数，空列表返回 0"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[index], 4)
+
+
+def summarize_spans(records: list) -> dict:
+    """按阶段汇总 JSON 阶段日志：耗时分位数、排队等待、吞吐与转录实时率"""
+    stages = {}
+    for record in records:
+        stages.setdefault(record["span"], []).append(record)
+
+    summary = {}
+    for stage, items in sorted(stages.items()):
+        durations = [item["duration_s"] for item in items]
+        busy = sum(durations) or 1e-9
+        total = lambda key: sum(item.get(key) or 0 for item in items)
+        stats = {
+            "count": len(items),
+            "errors": sum(1 for item in items if item["status"] != "ok"),
+            "p50_s": percentile(durations, 50),
+            "p95_s": percentile(durations, 95),
+            "mean_s": round(busy / len(items), 4),
+            "queue_wait_p95_s": percentile([item.get("queue_wait_s", 0) for item in items], 95),
+        }
+        if total("bytes"):
+            stats["bytes_per_s"] = round(total("bytes") / busy)
+        if total("audio_seconds"):
+            stats["audio_seconds_per_s"] = round(total("audio_seconds") / busy, 2)
+        if total("completion_tokens"):
+            stats["completion_tokens_per_s"] = round(total("completion_tokens") / busy, 1)
+            stats["prompt_tokens"] = total("prompt_tokens")
+        if stage == "asr":
+            rtfs = [item["rtf"] for item in items if "rtf" in item]
+            stats["rtf_p50"] = percentile(rtfs, 50)
+            stats["rtf_p95"] = percentile(rtfs, 95)
+        summary[stage] = stats
+    return summary
+
+
+def read_spans(log_path: str, offset: int) -> tuple:
+    """读取阶段日志中 offset 之后的记录，返回 (记录列表, 新的 offset)"""
+    if not os.path.exists(log_path):
+        return [], offset
+    with open(log_path, encoding="utf-8") as f:
+        f.seek(offset)
+        records = [json.loads(line) for line in f if line.strip()]
+        return records, f.tell()
+
+
+async def run_level(bm, urls: list, concurrency: int) -> dict:
+    """以给定并发数处理一组视频，返回端到端延迟与错误数"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def run_one(url: str):
+        async with semaphore:
+            start = time.monotonic()
+            try:
+                result = await bm.generate_bilibili_notes(url)
+            except Exception as e:
+                result = f"生成笔记失败: {e}"
+            latencies.append(time.monotonic() - start)
+            notes = result.split("\n---\n")[0].strip()
+            if result.startswith("生成笔记失败") or not notes:
+                errors.append(f"{url}: {result[:200]}")
+
+    start = time.monotonic()
+    await asyncio.gather(*(run_one(url) for url in urls))
+    wall = time.monotonic() - start
+    await bm.LLM_CLIENT.aclose()
+    return {
+        "wall_s": round(wall, 3),
+        "latency": {
+            "p50_s": percentile(latencies, 50),
+            "p95_s": percentile(latencies, 95),
+            "max_s": round(max(latencies), 4) if latencies else 0.0,
+        },
+        "requests_per_min": round(len(urls) / wall * 60, 2) if wall else 0.0,
+        "errors": errors,
+    }
+
+
+def compare_with_baseline(results: dict, baseline: dict, max_regression: float, floor: float) -> list:
+    """对比同一并发等级下端到端与各阶段的 p95 耗时及峰值内存，返回超出允许退化的项目"""
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline.get("levels", [])}
+
+    def check(name: str, new: float, old: float, unit_floor: float):
+        if old and new > old * (1 + max_regression) and new - old > unit_floor:
+            regressions.append(f"{name}: {old} -> {new}（+{(new / old - 1) * 100:.0f}%）")
+
+    for level in results["levels"]:
+        old = baseline_levels.get(level["concurrency"])
+        if not old:
+            continue
+        prefix = f"并发 {level['concurrency']}"
+        check(f"{prefix} 端到端 p95_s", level["latency"]["p95_s"], old["latency"]["p95_s"], floor)
+        for stage, stats in level["stages"].items():
+            if stage in old["stages"]:
+                check(f"{prefix} {stage} p95_s", stats["p95_s"], old["stages"][stage]["p95_s"], floor)
+        check(f"{prefix} peak_rss_bytes", level["peak_rss_bytes"], old["peak_rss_bytes"], 16 * 1024 * 1024)
+    return regressions
+
+
+def print_report(results: dict):
+    for level in results["levels"]:
+        print(f"\n并发 {level['concurrency']}：{level['requests']} 个请求，耗时 {level['wall_s']} 秒，"
+              f"端到端 p50 {level['latency']['p50_s']} 秒 / p95 {level['latency']['p95_s']} 秒，"
+              f"峰值内存 {level['peak_rss_bytes'] / 1024 / 1024:.0f} MB，失败 {len(level['errors'])} 个")
+        print(f"  {'阶段':<12}{'次数':>6}{'p50(s)':>10}{'p95(s)':>10}{'排队p95':>10}  吞吐")
+        for stage, stats in level["stages"].items():
+            throughput = []
+            if "bytes_per_s" in stats:
+                throughput.append(f"{stats['bytes_per_s'] / 1024 / 1024:.1f} MB/s")
+            if "audio_seconds_per_s" in stats:
+                throughput.append(f"{stats['audio_seconds_per_s']}x 实时")
+            if "completion_tokens_per_s" in stats:
+                throughput.append(f"{stats['completion_tokens_per_s']} tokens/s")
+            if "rtf_p50" in stats:
+                throughput.append(f"RTF p50 {stats['rtf_p50']} / p95 {stats['rtf_p95']}")
+            print(f"  {stage:<12}{stats['count']:>6}{stats['p50_s']:>10}{stats['p95_s']:>10}"
+                  f"{stats['queue_wait_p95_s']:>10}  {'，'.join(throughput)}")
+
+
+def run_asr_sweep(bm, fixture_paths: dict, engines: list, beam_sizes: list) -> list:
+    """按 解码引擎 × beam_size 逐一转录每个样本（音频预先解码，单进程），返回各组合的耗时与 RTF"""
+    audios = {seconds: bm.load_audio_pcm(path, mmap=False) for seconds, path in fixture_paths.items()}
+    bm.LONG_AUDIO_WORKERS = 1
+    transcriber = bm.WhisperTranscriber()
+    # 首次转录包含模型加载，先用 1 秒音频预热
+    transcriber.transcribe(next(iter(audios.values()))[:bm.AUDIO_SAMPLE_RATE])
+    rows = []
+    for engine in engines:
+        for beam_size in beam_sizes:
+            bm.WHISPER_ENGINE, bm.WHISPER_BEAM_SIZE = engine, beam_size
+            for seconds, audio in audios.items():
+                start = time.monotonic()
+                transcript = transcriber.transcribe(audio)
+                elapsed = time.monotonic() - start
+                rows.append({"engine": engine, "beam_size": beam_size, "audio_seconds": seconds,
+                             "asr_s": round(elapsed, 3), "rtf": round(elapsed / seconds, 4),
+                             "segments": len(transcript)})
+    return rows
+
+
+def print_sweep(rows: list):
+    print(f"\n转录参数扫描（{len(rows)} 组）")
+    print(f"  {'引擎':<12}{'beam':>6}{'音频(s)':>10}{'转录(s)':>10}{'RTF':>10}{'片段':>6}")
+    for row in rows:
+        print(f"  {row['engine']:<12}{row['beam_size']:>6}{row['audio_seconds']:>10}{row['asr_s']:>10}"
+              f"{row['rtf']:>10}{row['segments']:>6}")
+
+
+def cpu_model() -> str:
+    """CPU 型号（Linux 读取 /proc/cpuinfo，其他平台使用 platform.processor）"""
+    try:
+        with open("/proc/cpuinfo", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=DEMO_DIR, capture_output=True, text=True, timeout=5
+        ).stdout.strip()
+    except Exception:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="离线运行端到端笔记流水线的基准测试")
+    parser.add_argument("--lengths", default="30,120,300", help="样本音频时长（秒），逗号分隔")
+    parser.add_argument("--concurrency", default="1,4", help="并发等级，逗号分隔")
+    parser.add_argument("--requests", type=int, default=6, help="每个并发等级的请求数（不同视频）")
+    parser.add_argument("--asr", choices=["auto", "fake", "real"], default="auto",
+                        help="转录方式：real 使用本地模型，fake 按 --fake-rtf 模拟，auto 有模型时使用 real")
+    parser.add_argument("--fake-rtf", type=float, default=0.02, help="伪转录的实时率")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="LLM 桩服务的固定首 token 延迟（秒）")
+    parser.add_argument("--llm-prefill-tps", type=float, default=5000, help="LLM 桩服务的预填充速率（tokens/s，0 不计）")
+    parser.add_argument("--llm-tps", type=float, default=200, help="LLM 桩服务的生成速率（tokens/s）")
+    parser.add_argument("--llm-tokens", type=int, default=256, help="LLM 桩服务每次生成的 token 数")
+    parser.add_argument("--subtitle-ratio", type=float, default=0.0,
+                        help="带字幕视频的比例，这些视频走字幕快速路径，跳过下载与转录")
+    parser.add_argument("--notes-chunk-tokens", type=int, default=1200,
+                        help="分段总结阈值，默认值使较长的样本走分段总结再汇总的路径")
+    parser.add_argument("--fixture-dir", default="", help="样本音频目录（默认在临时目录中生成）")
+    parser.add_argument("--output", default="benchmark_results.json", help="结果 JSON 路径")
+    parser.add_argument("--baseline", default="", help="基线结果 JSON，用于检测性能退化")
+    parser.add_argument("--max-regression", type=float, default=0.2, help="允许的 p95 / 内存退化比例")
+    parser.add_argument("--min-delta", type=float, default=0.05, help="小于该秒数的 p95 变化不计为退化")
+    parser.add_argument("--engines", default="",
+                        help="转录参数扫描的解码引擎（sequential,batched），逗号分隔；不指定时使用当前配置")
+    parser.add_argument("--beam-sizes", default="",
+                        help="转录参数扫描的 beam_size，逗号分隔；与 --engines 都不指定时不扫描")
+    parser.add_argument("--verbose", action="store_true", help="输出流水线日志")
+    args = parser.parse_args()
+
+    lengths = [int(value) for value in args.lengths.split(",")]
+    levels = [int(value) for value in args.concurrency.split(",")]
+
+    with tempfile.TemporaryDirectory(prefix="bilimind-bench-") as workdir:
+        fixture_dir = args.fixture_dir or os.path.join(workdir, "fixtures")
+        fixtures = prepare_fixtures(fixture_dir, lengths)
+
+        file_server = ThreadingHTTPServer(
+            ("127.0.0.1", 0), functools.partial(QuietFileHandler, directory=fixture_dir)
+        )
+        fixture_base = start_server(file_server)
+        llm_server = ThreadingHTTPServer(("127.0.0.1", 0), StubLLMHandler)
+        llm_server.config = SimpleNamespace(
+            latency=args.llm_latency, prefill_tps=args.llm_prefill_tps, tps=args.llm_tps, tokens=args.llm_tokens
+        )
+        llm_server.lock = threading.Lock()
+        llm_server.stats = {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0}
+        llm_server.count_tokens = lambda text: len(text)
+        llm_base = start_server(llm_server)
+
+        # 导入服务模块前配置环境：缓存、检索索引、暂存区与任务库都放在临时目录中，每次运行互不影响
+        metrics_log = os.path.join(workdir, "spans.jsonl")
+        os.environ.update({
+            "API_BASE": llm_base,
+            "OPENAI_API_KEY": "sk-bench",
+            "CACHE_DB": os.path.join(workdir, "cache", "results.db"),
+            "JOBS_DB": os.path.join(workdir, "cache", "jobs.db"),
+            "SEARCH_DB": os.path.join(workdir, "cache", "search.db"),
+            "SCRATCH_DIR": os.path.join(workdir, "scratch"),
+            "METRICS_LOG": metrics_log,
+            "NOTES_CHUNK_TOKENS": str(args.notes_chunk_tokens),
+            "TRANSCRIBE_MODE": "file",
+            "NO_PROXY": "127.0.0.1,localhost",
+            "no_proxy": "127.0.0.1,localhost",
+        })
+        os.makedirs(os.path.join(workdir, "cache"), exist_ok=True)
+        sys.path.insert(0, DEMO_DIR)
+        import bilimind_mcp as bm
+
+        llm_server.count_tokens = bm.estimate_tokens
+        bm.yt_dlp.YoutubeDL = BenchYoutubeDL
+        if not args.verbose:
+            logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        asr = args.asr
+        if asr != "fake" and not bm.WhisperTranscriber().store.is_complete(bm.WHISPER_MODEL_SIZE, quiet=True):
+            if asr == "real":
+                sys.exit(f"本地没有完整的 {bm.WHISPER_MODEL_SIZE} 模型（{bm.DEFAULT_MODEL_DIR}），离线基准测试不会下载模型")
+            print(f"本地没有 {bm.WHISPER_MODEL_SIZE} 模型，使用伪转录（RTF={args.fake_rtf}）")
+            asr = "fake"
+        elif asr == "auto":
+            asr = "real"
+        if asr == "fake":
+            bm.run_whisper = functools.partial(
+                fake_run_whisper, rtf=args.fake_rtf, sample_rate=bm.AUDIO_SAMPLE_RATE
+            )
+            bm.WhisperTranscriber._acquire_model = lambda self: bm.WHISPER_POOL.acquire(
+                ("fake-asr",), FakeWhisperModel, 0
+            )
+            bm.LONG_AUDIO_WORKERS = 1
+
+        results = {
+            "meta": {
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "revision": git_revision(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu": cpu_model(),
+                "cpu_count": os.cpu_count(),
+                "asr": asr,
+                "whisper_model": bm.WHISPER_MODEL_SIZE if asr == "real" else None,
+                "config": vars(args),
+            },
+            "levels": [],
+        }
+
+        offset = 0
+        video_index = 0
+        for concurrency in levels:
+            urls = []
+            for _ in range(args.requests):
+                seconds = lengths[video_index % len(lengths)]
+                video_id = f"BV1bnch{video_index:05d}"
+                # 按比例均匀分布带字幕的视频
+                with_subtitle = int((video_index + 1) * args.subtitle_ratio) > int(video_index * args.subtitle_ratio)
+                FakeBilibiliIE.VIDEOS[video_id] = (seconds, {
+                    format_id: f"{fixture_base}/{name}" for format_id, name in fixtures[seconds].items()
+                }, with_subtitle)
+                urls.append(f"https://www.bilibili.com/video/{video_id}/")
+                video_index += 1
+
+            print(f"运行并发等级 {concurrency}：{len(urls)} 个请求...")
+            with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+                level = asyncio.run(run_level(bm, urls, concurrency))
+            records, offset = read_spans(metrics_log, offset)
+            level.update(
+                concurrency=concurrency,
+                requests=len(urls),
+                stages=summarize_spans(records),
+                peak_rss_bytes=bm.peak_rss_bytes(),
+            )
+            results["levels"].append(level)
+
+        if args.engines or args.beam_sizes:
+            engines = args.engines.split(",") if args.engines else [bm.WHISPER_ENGINE]
+            beam_sizes = [int(value) for value in args.beam_sizes.split(",")] if args.beam_sizes \
+                else [bm.WHISPER_BEAM_SIZE]
+            if asr == "fake":
+                print("伪转录的实时率固定为 --fake-rtf，扫描结果只用于检查脚本本身")
+            print(f"转录参数扫描：引擎 {engines} × beam_size {beam_sizes}...")
+            fixture_paths = {
+                seconds: os.path.join(fixture_dir, names["30232"]) for seconds, names in fixtures.items()
+            }
+            with open(os.devnull, "w") as devnull, redirect_stdout(sys.stdout if args.verbose else devnull):
+                results["asr_sweep"] = run_asr_sweep(bm, fixture_paths, engines, beam_sizes)
+
+        results["llm_stub"] = dict(llm_server.stats)
+        file_server.shutdown()
+        llm_server.shutdown()
+
+    print_report(results)
+    if results.get("asr_sweep"):
+        print_sweep(results["asr_sweep"])
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存到: {args.output}")
+
+    failed = sum(len(level["errors"]) for level in results["levels"])
+    if failed:
+        print(f"有 {failed} 个请求失败")
+        for level in results["levels"]:
+            for error in level["errors"][:3]:
+                print(f"  {error}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(results, baseline, args.max_regression, args.min_delta)
+        if regressions:
+            print(f"与基线 {args.baseline} 相比出现性能退化：")
+            for item in regressions:
+                print(f"  {item}")
+            sys.exit(1)
+        print(f"与基线 {args.baseline} 相比没有超过 {args.max_regression * 100:.0f}% 的退化")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,14 @@ import json
 import time
 import requests
 import argparse
+import functools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any
+from urllib.parse import urlparse, parse_qs
 import yt_dlp
-from faster_whisper import WhisperModel
+from faster_whisper import BatchedInferencePipeline, WhisperModel
 
 from dotenv import load_dotenv
 
@@ -31,12 +36,16 @@ class BilibiliDownloader:
         output_path = os.path.join(self.output_dir, "%(id)s.%(ext)s")
         
         ydl_opts = {
-            'format': 'bestaudio[ext=m4a]/bestaudio/best',
+            # 转录只需要 16 kHz 单声道，选择码率不低于 48 kbps 的最小音频流即可
+            'format': 'worstaudio[abr>=?48]/worstaudio/worst',
+            'concurrent_fragment_downloads': 4,
             'outtmpl': output_path,
             'postprocessors': [{
                 'key': 'FFmpegExtractAudio',
                 'preferredcodec': 'mp3',
             }],
+            # 多P视频只下载链接指定的分P，批量模式下由 expand_urls 展开全部分P
+            'noplaylist': True,
             'quiet': True,
         }
 
@@ -54,11 +63,41 @@ class BilibiliDownloader:
             'video_id': video_id,
         }
 
+
+def expand_urls(urls: List[str]) -> List[str]:
+    """把合集、收藏夹和多P视频展开为逐个视频（分P）的链接，去掉重复链接"""
+    ydl_opts = {'extract_flat': 'in_playlist', 'quiet': True}
+    expanded = []
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        pending = deque((url, 0) for url in urls)
+        while pending:
+            url, depth = pending.popleft()
+            # 已指定分P的链接不再展开
+            if depth > 1 or "p" in parse_qs(urlparse(url).query):
+                expanded.append(url)
+                continue
+            try:
+                info = ydl.extract_info(url, download=False)
+            except Exception as e:
+                print(f"展开链接失败 {url}: {e}")
+                expanded.append(url)
+                continue
+            if info.get("_type") != "playlist":
+                expanded.append(url)
+                continue
+            entries = [entry.get("url") or entry.get("webpage_url") for entry in info.get("entries") or []]
+            print(f"展开 {info.get('title') or url}: {len(entries)} 个视频")
+            # 合集中的条目可能是多P视频，再展开一层
+            pending.extend((entry, depth + 1) for entry in entries if entry)
+    return list(dict.fromkeys(expanded))
+
+
 class WhisperTranscriber:
     """使用Faster-Whisper转录音频"""
     
     def __init__(self, model_dir: str = "./models"):
         self.model_dir = model_dir
+        self._models = {}
         os.makedirs(model_dir, exist_ok=True)
         
     def download_model(self, model_size: str = "tiny", use_mirror: bool = True) -> bool:
@@ -120,8 +159,10 @@ class WhisperTranscriber:
         
         return True
         
-    def transcribe(self, audio_path: str, model_size: str = "tiny") -> Dict:
-        """转录音频文件"""
+    def load_model(self, model_size: str = "tiny") -> WhisperModel:
+        """加载模型，同一个转录器中只加载一次（批量模式下所有视频共用）"""
+        if model_size in self._models:
+            return self._models[model_size]
         model_path = os.path.join(self.model_dir, model_size)
         
         # 检查是否已经下载了模型
@@ -156,10 +197,23 @@ class WhisperTranscriber:
                 )
             else:
                 raise Exception("无法下载模型")
+        self._models[model_size] = model
+        return model
+
+    def transcribe(self, audio_path: str, model_size: str = "tiny", language: str = "zh",
+                   beam_size: int = 5, batch_size: int = 0) -> Dict:
+        """转录音频文件，batch_size > 0 时使用批量解码引擎"""
+        model = self.load_model(model_size)
         
         # 执行转录
         print(f"开始转录: {audio_path}")
-        segments, info = model.transcribe(audio_path, language="zh", beam_size=5)
+        start_time = time.time()
+        if batch_size > 0:
+            pipeline = BatchedInferencePipeline(model=model)
+            segments, info = pipeline.transcribe(audio_path, language=language,
+                                                 beam_size=beam_size, batch_size=batch_size)
+        else:
+            segments, info = model.transcribe(audio_path, language=language, beam_size=beam_size)
         
         # 打印检测到的语言和概率
         print(f"检测到语言: '{info.language}' (概率: {info.language_probability:.2f})")
@@ -170,11 +224,16 @@ class WhisperTranscriber:
         
         for segment in segments_list:
             full_text += segment.text + " "
+
+        elapsed = time.time() - start_time
+        if info.duration > 0:
+            print(f"转录耗时 {elapsed:.2f} 秒，实时率 RTF={elapsed / info.duration:.3f}")
         
         return {
             "full_text": full_text.strip(),
             "segments": segments_list,
-            "language": info.language
+            "language": info.language,
+            "duration": info.duration,
         }
 
 # 定义常量
@@ -270,18 +329,156 @@ class NotesGenerator:
                 print(f"响应内容: {response.text}")
             return ""
 
+def enforce_audio_budget(audio_dir: str, max_mb: float):
+    """保留的音频超出容量上限时，按最久未使用删除"""
+    if max_mb <= 0 or not os.path.isdir(audio_dir):
+        return
+    files = sorted(
+        (entry for entry in os.scandir(audio_dir) if entry.is_file()),
+        key=lambda entry: entry.stat().st_mtime,
+    )
+    total = sum(entry.stat().st_size for entry in files)
+    for entry in files:
+        if total <= max_mb * 1024 * 1024:
+            break
+        total -= entry.stat().st_size
+        os.remove(entry.path)
+        print(f"音频目录超出 {max_mb:.0f} MB，删除: {entry.path}")
+
+
+def save_transcript(transcript: Dict, transcript_file: str):
+    """保存转录文本和分段详情"""
+    with open(transcript_file, 'w', encoding='utf-8') as f:
+        f.write(transcript["full_text"])
+        f.write("\n\n分段详情:\n")
+        for segment in transcript["segments"]:
+            f.write(f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}\n")
+
+
+def run_batch(urls: List[str], args):
+    """批量模式：下载、转录、生成笔记三个阶段流水线执行
+
+    下载在线程池中提前进行（最多领先 --prefetch 个视频），转录在主线程中逐个执行并复用同一个模型，
+    笔记生成在线程池中并发执行；每完成一个视频就写出笔记，最后输出整体吞吐。
+    """
+    os.makedirs(args.output_dir, exist_ok=True)
+    downloader = BilibiliDownloader()
+    transcriber = WhisperTranscriber()
+    notes_generator = NotesGenerator()
+
+    start_time = time.time()
+    lock = threading.Lock()
+    stats = {"done": 0, "failed": 0, "audio_seconds": 0.0}
+
+    def report(url: str, message: str, failed: bool = False):
+        with lock:
+            stats["failed" if failed else "done"] += 1
+            finished = stats["done"] + stats["failed"]
+        print(f"[{finished}/{len(urls)}] {url}: {message}（已用 {time.time() - start_time:.1f} 秒）")
+
+    def on_notes(url: str, audio_info: Dict, duration: float, future):
+        try:
+            notes = future.result()
+        except Exception as e:
+            notes = ""
+            print(f"生成笔记失败: {e}")
+        if not notes:
+            report(url, "生成笔记失败", failed=True)
+            return
+        output_file = os.path.join(args.output_dir, f"{audio_info['video_id']}.md")
+        with open(output_file, 'w', encoding='utf-8') as f:
+            f.write(notes)
+        with lock:
+            stats["audio_seconds"] += duration
+        report(url, f"笔记已保存到 {output_file}")
+
+    with ThreadPoolExecutor(args.download_workers) as download_pool, \
+            ThreadPoolExecutor(args.llm_workers) as llm_pool:
+        pending = iter(urls)
+        downloads = deque()
+
+        def prefetch():
+            while len(downloads) <= args.prefetch:
+                url = next(pending, None)
+                if url is None:
+                    return
+                downloads.append((url, download_pool.submit(downloader.download_audio, url)))
+
+        prefetch()
+        while downloads:
+            url, future = downloads.popleft()
+            # 转录当前视频的同时，后面的视频继续下载
+            prefetch()
+            try:
+                audio_info = future.result()
+            except Exception as e:
+                report(url, f"下载音频失败: {e}", failed=True)
+                continue
+
+            try:
+                transcript = transcriber.transcribe(audio_info['file_path'], model_size=args.model_size,
+                                                    language=args.language, beam_size=args.beam_size,
+                                                    batch_size=args.batch_size)
+            except Exception as e:
+                report(url, f"转录音频失败: {e}", failed=True)
+                continue
+            finally:
+                if not args.keep_audio and os.path.exists(audio_info['file_path']):
+                    os.remove(audio_info['file_path'])
+            save_transcript(transcript, os.path.join(args.output_dir, f"{audio_info['video_id']}_transcript.txt"))
+
+            notes_future = llm_pool.submit(notes_generator.generate_notes, transcript["full_text"],
+                                           video_title=audio_info['title'], tags="")
+            notes_future.add_done_callback(
+                functools.partial(on_notes, url, audio_info, transcript["duration"])
+            )
+
+    elapsed = time.time() - start_time
+    print(f"\n批量处理完成: {len(urls)} 个视频，成功 {stats['done']}，失败 {stats['failed']}")
+    print(f"总耗时 {elapsed:.1f} 秒，音频总时长 {stats['audio_seconds'] / 60:.1f} 分钟")
+    if elapsed > 0:
+        print(f"吞吐: {len(urls) / elapsed * 60:.2f} 个视频/分钟，"
+              f"{stats['audio_seconds'] / elapsed:.2f} 倍实时")
+
+
 def main():
     DEFAULT_VIDEO_URL = "https://www.bilibili.com/video/BV1z65TzuE94"
     
     parser = argparse.ArgumentParser(description='从B站视频生成笔记')
-    parser.add_argument('--url', '-u', default=DEFAULT_VIDEO_URL, 
-                        help=f'B站视频链接 (默认: {DEFAULT_VIDEO_URL})')
+    parser.add_argument('--url', '-u', nargs='+', default=[DEFAULT_VIDEO_URL],
+                        help=f'B站视频、多P视频、合集或收藏夹链接，可以指定多个 (默认: {DEFAULT_VIDEO_URL})')
+    parser.add_argument('--url-file', help='批量模式：从文件读取链接，每行一个')
     parser.add_argument('--output', '-o', default='video_notes.md', help='输出笔记文件路径')
     parser.add_argument('--model-size', '-m', default='tiny', choices=['tiny', 'base', 'small', 'medium', 'large-v3'], 
                         help='Whisper模型大小')
     parser.add_argument('--keep-audio', '-k', action='store_true', help='保留下载的音频文件')
+    parser.add_argument('--max-audio-mb', type=float, default=1024,
+                        help='保留音频时 downloads 目录的容量上限（MB），超出时删除最久未使用的音频，0 为不限制')
+    parser.add_argument('--language', default='zh', help='转录语言')
+    parser.add_argument('--beam-size', type=int, default=5, help='解码束宽，1 为贪心解码')
+    parser.add_argument('--batch-size', type=int, default=0, help='批量解码的批大小，0 为逐段解码')
+    parser.add_argument('--output-dir', default='notes', help='批量模式下笔记的输出目录')
+    parser.add_argument('--prefetch', type=int, default=2, help='批量模式下提前下载的视频数')
+    parser.add_argument('--download-workers', type=int, default=2, help='批量模式下的并发下载数')
+    parser.add_argument('--llm-workers', type=int, default=2, help='批量模式下并发生成笔记的请求数')
     
     args = parser.parse_args()
+
+    urls = list(args.url)
+    if args.url_file:
+        with open(args.url_file, encoding='utf-8') as f:
+            urls = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    urls = expand_urls(urls)
+    if not urls:
+        print("没有可处理的视频链接")
+        return
+    if len(urls) > 1:
+        print(f"批量处理 {len(urls)} 个视频，使用模型: {args.model_size}，输出目录: {args.output_dir}")
+        run_batch(urls, args)
+        if args.keep_audio:
+            enforce_audio_budget(BilibiliDownloader().output_dir, args.max_audio_mb)
+        return
+    args.url = urls[0]
     
     print(f"处理视频: {args.url}")
     print(f"使用模型: {args.model_size}")
@@ -298,7 +495,9 @@ def main():
     # 步骤2: 转录音频
     transcriber = WhisperTranscriber()
     try:
-        transcript = transcriber.transcribe(audio_info['file_path'], model_size=args.model_size)
+        transcript = transcriber.transcribe(audio_info['file_path'], model_size=args.model_size,
+                                            language=args.language, beam_size=args.beam_size,
+                                            batch_size=args.batch_size)
     except Exception as e:
         print(f"转录音频失败: {e}")
         return
@@ -322,11 +521,7 @@ def main():
     
     # 保存转录文本
     transcript_file = f"{os.path.splitext(args.output)[0]}_transcript.txt"
-    with open(transcript_file, 'w', encoding='utf-8') as f:
-        f.write(transcript["full_text"])
-        f.write("\n\n分段详情:\n")
-        for segment in transcript["segments"]:
-            f.write(f"[{segment.start:.2f}s -> {segment.end:.2f}s] {segment.text}\n")
+    save_transcript(transcript, transcript_file)
     print(f"转录文本已保存到: {transcript_file}")
     
     # 如果不保留音频文件，则删除
@@ -335,6 +530,7 @@ def main():
         print(f"已删除音频文件: {audio_info['file_path']}")
     else:
         print(f"音频文件保留在: {audio_info['file_path']}")
+        enforce_audio_budget(downloader.output_dir, args.max_audio_mb)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -0,0 +1,23 @@
+import os
+
+import pytest
+
+DEMO_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "demo")
+
+
+@pytest.fixture(scope="session")
+def bm(tmp_path_factory):
+    """导入服务模块；缓存、检索索引、任务库、暂存区与模型目录都放在临时目录中，结束后恢复环境变量"""
+    workdir = tmp_path_factory.mktemp("bilimind")
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("CACHE_DB", str(workdir / "cache" / "results.db"))
+        mp.setenv("JOBS_DB", str(workdir / "cache" / "jobs.db"))
+        mp.setenv("SEARCH_DB", str(workdir / "cache" / "search.db"))
+        mp.setenv("SCRATCH_DIR", str(workdir / "scratch"))
+        mp.syspath_prepend(DEMO_DIR)
+        import bilimind_mcp
+
+        # WhisperTranscriber() 默认使用当前目录下的 models/，改为共享临时目录中的模型仓库
+        mp.setitem(bilimind_mcp._MODEL_STORES, os.path.abspath(bilimind_mcp.DEFAULT_MODEL_DIR),
+                   bilimind_mcp.ModelStore(str(workdir / "models")))
+        yield bilimind_mcp
@@ -0,0 +1,44 @@
+"""长音频并行转录的工作进程：spawn 子进程不应打开缓存、任务库等全局对象"""
+import os
+import pickle
+import subprocess
+import sys
+
+from conftest import DEMO_DIR
+
+
+def run_python(code: str, tmp_path) -> subprocess.CompletedProcess:
+    env = dict(os.environ,
+               CACHE_DB=str(tmp_path / "cache" / "results.db"),
+               JOBS_DB=str(tmp_path / "cache" / "jobs.db"),
+               SEARCH_DB=str(tmp_path / "cache" / "search.db"),
+               SCRATCH_DIR=str(tmp_path / "scratch"))
+    return subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env=env,
+                          capture_output=True, text=True, timeout=60)
+
+
+def test_worker_entry_point_does_not_import_server(bm, tmp_path):
+    assert pickle.loads(pickle.dumps(bm.whisper_worker.transcribe_chunk)).__module__ == "whisper_worker"
+
+    result = run_python(
+        f"import sys; sys.path.insert(0, {DEMO_DIR!r}); import whisper_worker; "
+        "print(sorted(name for name in ('bilimind_mcp', 'mcp', 'faster_whisper') if name in sys.modules))",
+        tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert result.stdout.strip() == "[]"
+
+
+def test_reimporting_main_module_has_no_storage_side_effects(tmp_path):
+    # spawn 子进程以 __mp_main__ 的名字重新执行主模块（sys.path 与主进程相同）
+    main_path = os.path.join(DEMO_DIR, "bilimind_mcp.py")
+    result = run_python(
+        f"import runpy, sys; sys.path.insert(0, {DEMO_DIR!r}); "
+        f"runpy.run_path({main_path!r}, run_name='__mp_main__')",
+        tmp_path,
+    )
+
+    assert result.returncode == 0, result.stderr
+    assert not (tmp_path / "cache").exists()
+    assert not (tmp_path / "scratch").exists()
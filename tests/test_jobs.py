@@ -0,0 +1,25 @@
+"""后台任务：提交、查询与等待都通过存储线程池访问任务库"""
+import asyncio
+import json
+
+import pytest
+
+
+def test_wait_for_missing_job_raises_not_found(bm):
+    with pytest.raises(RuntimeError, match="任务不存在"):
+        asyncio.run(bm._wait_for_job("missing-job"))
+
+
+def test_job_status_and_result_for_missing_job(bm):
+    status = json.loads(asyncio.run(bm.get_job_status("missing-job")))
+    assert status == {"job_id": "missing-job", "error": "任务不存在"}
+    assert asyncio.run(bm.get_job_result("missing-job")) == "任务不存在: missing-job"
+
+
+def test_wait_for_job_returns_result(bm):
+    job = bm.JOB_STORE.submit("https://www.bilibili.com/video/BV1Ns411c7ee/", "BV1Ns411c7ee", 1)
+    claimed = bm.JOB_STORE.claim("test-worker")
+    assert claimed["id"] == job["id"]
+    bm.JOB_STORE.update(job["id"], claimed["lease_token"], status="done", result="# 笔记")
+
+    assert asyncio.run(bm._wait_for_job(job["id"])) == "# 笔记"
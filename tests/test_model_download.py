@@ -0,0 +1,181 @@
+"""模型下载：用本地 http.server 模拟镜像站点，覆盖断点续传、损坏修复与哈希校验失败"""
+import hashlib
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+REPO_ID = "test/faster-whisper-fixture"
+MODEL_SIZE = "fixture"
+FILES = {
+    "model.bin": os.urandom(300 * 1024),
+    "config.json": json.dumps({"alignment_heads": [[1, 0]], "lang_ids": [1]}).encode(),
+}
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    """兼容 Hugging Face 镜像的最小实现：文件列表接口与支持 Range 的文件下载"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        if self.path == f"/api/models/{REPO_ID}/tree/main":
+            self._send(200, json.dumps(server.tree).encode(), "application/json")
+            return
+        name = self.path.rsplit("/", 1)[-1]
+        if not self.path.startswith(f"/{REPO_ID}/resolve/main/") or name not in server.files:
+            self._send(404, b"not found")
+            return
+        data = server.files[name]
+        requested = self.headers.get("Range")
+        server.requests.append((name, requested))
+        if not requested:
+            self._send(200, data)
+            return
+        start = int(requested[len("bytes="):].split("-")[0])
+        if start >= len(data):
+            self._send(416, b"", headers={"Content-Range": f"bytes */{len(data)}"})
+            return
+        self._send(206, data[start:], headers={"Content-Range": f"bytes {start}-{len(data) - 1}/{len(data)}"})
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/octet-stream", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def tree_entries(files: dict) -> list:
+    """镜像文件列表：model.bin 作为 LFS 文件（oid 为 sha256），其余为普通文件（oid 为 git blob 哈希）"""
+    entries = []
+    for name, data in files.items():
+        if name == "model.bin":
+            entries.append({"type": "file", "path": name, "size": len(data),
+                            "lfs": {"oid": hashlib.sha256(data).hexdigest(), "size": len(data)}})
+        else:
+            blob = hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+            entries.append({"type": "file", "path": name, "size": len(data), "oid": blob})
+    return entries
+
+
+@pytest.fixture
+def mirror():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MirrorHandler)
+    server.files = dict(FILES)
+    server.tree = tree_entries(FILES)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(bm, tmp_path, monkeypatch):
+    monkeypatch.setitem(bm.MODEL_REPOS, MODEL_SIZE, (REPO_ID, list(FILES)))
+    return bm.ModelStore(str(tmp_path / "models"))
+
+
+def base_url(server) -> str:
+    return f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def read(path) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def test_download_verifies_files_and_writes_manifest(store, mirror):
+    assert store.download(MODEL_SIZE, base_url=base_url(mirror))
+
+    model_dir = store.model_path(MODEL_SIZE)
+    for name, data in FILES.items():
+        assert read(os.path.join(model_dir, name)) == data
+        assert not os.path.exists(os.path.join(model_dir, name + ".part"))
+    manifest = json.loads(read(os.path.join(model_dir, ".manifest.json")))
+    assert manifest["model.bin"]["sha256"] == hashlib.sha256(FILES["model.bin"]).hexdigest()
+    assert "git_sha1" in manifest["config.json"]
+    assert store.is_complete(MODEL_SIZE)
+
+
+def test_interrupted_download_resumes_with_range(store, mirror):
+    model_dir = store.model_path(MODEL_SIZE)
+    os.makedirs(model_dir)
+    half = len(FILES["model.bin"]) // 2
+    with open(os.path.join(model_dir, "model.bin.part"), "wb") as f:
+        f.write(FILES["model.bin"][:half])
+
+    assert store.download(MODEL_SIZE, base_url=base_url(mirror))
+
+    assert ("model.bin", f"bytes={half}-") in mirror.requests
+    assert read(os.path.join(model_dir, "model.bin")) == FILES["model.bin"]
+
+
+def test_complete_partial_file_is_finished_after_416(store, mirror):
+    model_dir = store.model_path(MODEL_SIZE)
+    os.makedirs(model_dir)
+    with open(os.path.join(model_dir, "model.bin.part"), "wb") as f:
+        f.write(FILES["model.bin"])
+
+    assert store.download(MODEL_SIZE, base_url=base_url(mirror))
+
+    assert ("model.bin", f"bytes={len(FILES['model.bin'])}-") in mirror.requests
+    assert read(os.path.join(model_dir, "model.bin")) == FILES["model.bin"]
+
+
+def test_corrupted_partial_file_is_discarded_and_redownloaded(store, mirror):
+    model_dir = store.model_path(MODEL_SIZE)
+    os.makedirs(model_dir)
+    # 与完整文件等长但内容错误：续传直接得到 416，哈希校验失败后删除
+    with open(os.path.join(model_dir, "model.bin.part"), "wb") as f:
+        f.write(b"\0" * len(FILES["model.bin"]))
+
+    assert not store.download(MODEL_SIZE, base_url=base_url(mirror))
+    assert not os.path.exists(os.path.join(model_dir, "model.bin"))
+    assert not os.path.exists(os.path.join(model_dir, "model.bin.part"))
+
+    assert store.download(MODEL_SIZE, base_url=base_url(mirror))
+    assert read(os.path.join(model_dir, "model.bin")) == FILES["model.bin"]
+
+
+def test_repair_replaces_corrupted_model_file(bm, store, mirror, monkeypatch):
+    monkeypatch.setattr(bm, "MODEL_MIRROR", base_url(mirror))
+    assert store.download(MODEL_SIZE, base_url=base_url(mirror))
+    model_path = os.path.join(store.model_path(MODEL_SIZE), "model.bin")
+    # 大小不变的损坏只有完整校验哈希才能发现
+    with open(model_path, "r+b") as f:
+        f.write(b"corrupt")
+    assert store.is_complete(MODEL_SIZE)
+    mirror.requests.clear()
+
+    store.repair(MODEL_SIZE)
+
+    assert read(model_path) == FILES["model.bin"]
+    assert [name for name, _ in mirror.requests] == ["model.bin"]
+
+
+def test_checksum_mismatch_fails_without_leaving_files(store, mirror):
+    mirror.files["model.bin"] = os.urandom(len(FILES["model.bin"]))
+
+    assert not store.download(MODEL_SIZE, base_url=base_url(mirror))
+
+    model_dir = store.model_path(MODEL_SIZE)
+    assert not os.path.exists(os.path.join(model_dir, "model.bin"))
+    assert not os.path.exists(os.path.join(model_dir, "model.bin.part"))
+    assert not os.path.exists(os.path.join(model_dir, ".manifest.json"))
+    # 其他文件校验通过，不受影响
+    assert read(os.path.join(model_dir, "config.json")) == FILES["config.json"]
+
+
+def test_default_model_store_is_isolated_from_cwd(bm):
+    store = bm.WhisperTranscriber().store
+
+    assert os.path.abspath(store.root) != os.path.abspath(bm.DEFAULT_MODEL_DIR)
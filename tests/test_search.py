@@ -0,0 +1,46 @@
+"""转录全文检索：中文按 bigram 切分，单字与多字查询都能命中任意位置"""
+import pytest
+
+
+@pytest.fixture
+def index(bm, tmp_path):
+    index = bm.SearchIndex(str(tmp_path / "search.db"))
+    if not index.enabled:
+        pytest.skip("SQLite 未启用 FTS5")
+    transcript = bm.Transcript.from_segments([
+        bm.TranscriptSegment(0.0, 3.0, "今天我们来讲梯度下降"),
+        bm.TranscriptSegment(30.0, 33.0, "学习率决定每一步走多远"),
+    ], "zh")
+    index.add("BV1Ns411c7ff", 1, "优化方法", transcript)
+    return index
+
+
+def test_search_tokens_emit_trailing_unigram(bm):
+    assert bm.search_tokens("梯度下降") == ["梯度", "度下", "下降", "降"]
+    assert bm.search_tokens("降") == ["降"]
+    assert bm.search_tokens("SGD 下降") == ["sgd", "下降", "降"]
+
+
+@pytest.mark.parametrize("query", ["降", "梯", "下降", "梯度下降", "远", "学习率"])
+def test_search_matches_substrings(index, query):
+    results = index.search(query)
+
+    assert results
+    assert query in results[0]["snippet"]
+
+
+def test_single_char_query_finds_char_at_end_of_run(index):
+    results = index.search("降")
+
+    assert [(result["video_id"], result["start"]) for result in results] == [("BV1Ns411c7ff", 0.0)]
+    assert "【降】" in results[0]["snippet"]
+
+
+def test_old_index_is_cleared_on_tokenizer_change(bm, index):
+    index._conn.execute("PRAGMA user_version = 1")
+    index._conn.commit()
+
+    reopened = bm.SearchIndex(index.db_path)
+
+    assert reopened.stats() == {"videos": 0, "passages": 0}
+    assert reopened.search("降") == []
@@ -0,0 +1,209 @@
+"""B站字幕：字幕解析、按语言优先级选择轨道，以及没有字幕时回退到下载音频并转录"""
+import asyncio
+import io
+import os
+import threading
+import time
+
+import pytest
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "bilibili_subtitle.json")
+
+
+def load_fixture() -> str:
+    with open(FIXTURE, encoding="utf-8") as f:
+        return f.read()
+
+
+class FakeYDL:
+    """只实现 _select_subtitle 用到的 urlopen，按 URL 返回预置的字幕内容"""
+
+    def __init__(self, responses: dict):
+        self.responses = responses
+        self.opened = []
+
+    def urlopen(self, url):
+        self.opened.append(url)
+        content = self.responses[url]
+        if isinstance(content, Exception):
+            raise content
+        return io.BytesIO(content.encode("utf-8"))
+
+
+def test_parse_bilibili_json_subtitle(bm):
+    segments = bm.parse_subtitle(load_fixture(), "json")
+
+    # 空白内容的条目被丢弃，时间保持为秒
+    assert [segment.text for segment in segments] == [
+        "大家好，今天我们来讲梯度下降", "它是训练神经网络最常用的方法", "先看一个例子",
+    ]
+    assert segments[0].start == pytest.approx(0.36)
+    assert segments[0].end == pytest.approx(2.88)
+    assert segments[-1].start == pytest.approx(61.5)
+    assert segments[-1].end == pytest.approx(64.25)
+
+
+@pytest.mark.parametrize("content, ext", [
+    ("1\n00:01:01,500 --> 00:01:04,250\n先看一个例子\n\n2\n01:00:00,000 --> 01:00:02,000\n<i>结束</i>\n", "srt"),
+    ("WEBVTT\n\n01:01.500 --> 01:04.250\n先看一个例子\n\n1:00:00.000 --> 1:00:02.000\n<i>结束</i>\n", "vtt"),
+])
+def test_parse_srt_and_vtt_timestamps(bm, content, ext):
+    segments = bm.parse_subtitle(content, ext)
+
+    assert [(segment.start, segment.end, segment.text) for segment in segments] == [
+        (61.5, 64.25, "先看一个例子"),
+        (3600.0, 3602.0, "结束"),
+    ]
+
+
+def test_subtitle_language(bm):
+    assert bm.subtitle_language("zh-CN") == "zh"
+    assert bm.subtitle_language("ai-zh") == "zh"
+    assert bm.subtitle_language("en-US") == "en"
+
+
+def test_select_subtitle_follows_language_preference(bm):
+    subtitles = {
+        "ai-zh": [{"ext": "json", "url": "https://example.com/ai-zh.json"}],
+        "zh-CN": [{"ext": "json", "url": "https://example.com/zh-CN.json"}],
+        "danmaku": [{"ext": "xml", "url": "https://example.com/danmaku.xml"}],
+    }
+    ydl = FakeYDL({
+        "https://example.com/ai-zh.json": load_fixture(),
+        "https://example.com/zh-CN.json": load_fixture(),
+    })
+
+    selected = bm.BilibiliDownloader._select_subtitle(ydl, subtitles, ["zh-CN", "ai-zh"])
+    assert selected["lang"] == "zh-CN"
+    assert len(selected["segments"]) == 3
+
+    selected = bm.BilibiliDownloader._select_subtitle(ydl, subtitles, ["ai-zh", "zh-CN"])
+    assert selected["lang"] == "ai-zh"
+    assert "https://example.com/danmaku.xml" not in ydl.opened
+
+
+def test_select_subtitle_skips_unusable_tracks(bm):
+    subtitles = {
+        "zh-CN": [{"ext": "json", "url": "https://example.com/broken.json"}],
+        "zh-Hans": [{"ext": "json", "data": '{"body": []}'}],
+        "ai-zh": [{"ext": "ass", "url": "https://example.com/ai-zh.ass"},
+                  {"ext": "json", "url": "https://example.com/ai-zh.json"}],
+    }
+    ydl = FakeYDL({
+        "https://example.com/broken.json": OSError("403 Forbidden"),
+        "https://example.com/ai-zh.json": load_fixture(),
+    })
+
+    selected = bm.BilibiliDownloader._select_subtitle(ydl, subtitles, ["zh-CN", "zh-Hans", "ai-zh"])
+
+    assert selected["lang"] == "ai-zh"
+    assert ydl.opened == ["https://example.com/broken.json", "https://example.com/ai-zh.json"]
+
+
+def test_select_subtitle_returns_none_without_tracks(bm):
+    ydl = FakeYDL({})
+    assert bm.BilibiliDownloader._select_subtitle(ydl, {}, ["zh-CN", "ai-zh"]) is None
+    assert bm.BilibiliDownloader._select_subtitle(
+        ydl, {"en-US": [{"ext": "json", "data": load_fixture()}]}, ["zh-CN"]
+    ) is None
+
+
+@pytest.fixture
+def fake_pipeline(bm, monkeypatch):
+    """替换下载、转录与 LLM，记录流水线实际走过的阶段"""
+    calls = {"download": [], "transcribe": 0}
+    probe_info = {"id": "probe-info"}
+    subtitle = {}
+
+    def probe_video(self, video_url):
+        return {"title": "示例视频", "duration": 65, "cover_url": None, "video_id": "BV1",
+                "subtitle": subtitle.get("value"), "info": probe_info}
+
+    def download_audio(self, video_url, progress_hook=None, info=None):
+        calls["download"].append(info)
+        file_path = os.path.join(self.output_dir, "audio.m4a")
+        with open(file_path, "wb") as f:
+            f.write(b"\0")
+        return {"title": "示例视频", "duration": 65, "video_id": "BV1", "file_path": file_path}
+
+    def transcribe(self, audio, on_segment=None, resume_from=0.0):
+        calls["transcribe"] += 1
+        return bm.Transcript.from_segments([bm.TranscriptSegment(0.0, 2.0, "语音转录的内容")], "zh")
+
+    async def generate_notes(self, transcript_text, video_title="", tags="", **kwargs):
+        return f"# {video_title}\n\n{transcript_text}"
+
+    monkeypatch.setattr(bm.BilibiliDownloader, "probe_video", probe_video)
+    monkeypatch.setattr(bm.BilibiliDownloader, "download_audio", download_audio)
+    monkeypatch.setattr(bm.WhisperTranscriber, "transcribe", transcribe)
+    monkeypatch.setattr(bm.NotesGenerator, "generate_notes", generate_notes)
+    monkeypatch.setattr(bm, "SUBTITLE_POLICY", "prefer")
+    monkeypatch.setattr(bm, "TRANSCRIBE_MODE", "file")
+    calls["probe_info"] = probe_info
+    calls["subtitle"] = subtitle
+    return calls
+
+
+def run_pipeline(bm, video_id: str) -> str:
+    async def main():
+        return await bm._generate_notes_pipeline(
+            f"https://www.bilibili.com/video/{video_id}", video_id, 1, bm.PipelineProgress()
+        )
+
+    return asyncio.run(main())
+
+
+def test_pipeline_falls_back_to_asr_without_subtitles(bm, fake_pipeline):
+    notes = run_pipeline(bm, "BV1Ns411c7aa")
+
+    # 复用探测时得到的视频信息下载音频，再转录
+    assert fake_pipeline["download"] == [fake_pipeline["probe_info"]]
+    assert fake_pipeline["transcribe"] == 1
+    assert "语音转录的内容" in notes
+    assert "使用模型: faster-whisper-" in notes
+
+
+def test_pipeline_uses_subtitle_track_without_download(bm, fake_pipeline):
+    fake_pipeline["subtitle"]["value"] = {"lang": "ai-zh", "segments": bm.parse_subtitle(load_fixture(), "json")}
+
+    notes = run_pipeline(bm, "BV1Ns411c7bb")
+
+    assert fake_pipeline["download"] == []
+    assert fake_pipeline["transcribe"] == 0
+    assert "大家好，今天我们来讲梯度下降" in notes
+    assert "转录来源: 视频字幕（ai-zh）" in notes
+
+
+def test_notes_cache_hit_skips_download_pool_and_scratch(bm, fake_pipeline, monkeypatch):
+    run_pipeline(bm, "BV1Ns411c7cc")
+    created = []
+    monkeypatch.setattr(bm.SCRATCH, "create_workdir", lambda name: created.append(name))
+    # 下载线程池被占满时，缓存命中也不应排队等待
+    busy = threading.Event()
+    blockers = [bm.STAGE_EXECUTORS["download"].submit(busy.wait, 5) for _ in range(bm.DOWNLOAD_CONCURRENCY)]
+    try:
+        started = time.monotonic()
+        notes = run_pipeline(bm, "BV1Ns411c7cc")
+        assert time.monotonic() - started < 2
+    finally:
+        busy.set()
+        for blocker in blockers:
+            blocker.result()
+
+    assert "缓存命中: " in notes and "笔记" in notes
+    assert created == []
+    assert len(fake_pipeline["download"]) == 1
+
+
+def test_notes_cache_hit_does_not_need_audio_metadata(bm, fake_pipeline):
+    run_pipeline(bm, "BV1Ns411c7dd")
+    # 音频元数据比笔记先过期
+    key = bm.RESULT_CACHE.make_key("audio", "BV1Ns411c7dd", 1)
+    with bm.RESULT_CACHE._lock:
+        bm.RESULT_CACHE._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+        bm.RESULT_CACHE._conn.commit()
+
+    notes = run_pipeline(bm, "BV1Ns411c7dd")
+
+    assert len(fake_pipeline["download"]) == 1
+    assert "- 视频标题: 示例视频" in notes
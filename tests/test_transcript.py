@@ -0,0 +1,89 @@
+"""列式转录：memoryview 列、切片视图、二进制序列化往返与时间平移"""
+import pytest
+
+SEGMENTS = [(0.0, 2.5, "大家好"), (2.5, 6.0, "今天讲梯度下降"), (7.0, 9.5, "先看一个例子")]
+WORDS = [
+    [(0.0, 1.0, "大家"), (1.0, 2.5, "好")],
+    [(2.5, 3.5, "今天"), (3.5, 4.0, "讲"), (4.0, 6.0, "梯度下降")],
+    [(7.0, 9.5, "先看一个例子")],
+]
+
+
+@pytest.fixture
+def transcript(bm):
+    return bm.Transcript.from_segments(
+        [bm.TranscriptSegment(*segment) for segment in SEGMENTS], "zh", words=WORDS
+    )
+
+
+def as_tuples(transcript):
+    return [(segment.start, segment.end, segment.text) for segment in transcript]
+
+
+def test_columns_are_memoryviews(bm, transcript):
+    columns = transcript._columns
+    assert all(isinstance(column, memoryview) for column in columns.values())
+    assert list(columns["starts"]) == [0.0, 2.5, 7.0]
+    assert list(columns["ends"]) == [2.5, 6.0, 9.5]
+    assert columns["offsets"][-1] == len(columns["text"])
+    assert transcript.full_text == "大家好 今天讲梯度下降 先看一个例子"
+    assert transcript.nbytes == sum(column.nbytes for column in columns.values())
+
+
+def test_slice_is_a_view_on_shared_buffers(transcript):
+    view = transcript[1:]
+
+    assert as_tuples(view) == SEGMENTS[1:]
+    assert view.words(0) == WORDS[1]
+    assert view._columns["text"].obj is transcript._columns["text"].obj
+    assert view.full_text == "今天讲梯度下降 先看一个例子"
+    with pytest.raises(ValueError):
+        transcript[::2]
+
+
+@pytest.mark.parametrize("part", [slice(None), slice(1, 3), slice(1, 2)])
+def test_bytes_round_trip(bm, transcript, part):
+    original = transcript[part]
+
+    restored = bm.Transcript.from_bytes(original.to_bytes())
+
+    assert as_tuples(restored) == as_tuples(original)
+    assert [restored.words(index) for index in range(len(restored))] == \
+        [original.words(index) for index in range(len(original))]
+    assert (restored.language, restored.source) == ("zh", "asr")
+    assert bm.Transcript.restore(original.to_bytes()).full_text == original.full_text
+
+
+def test_from_bytes_builds_views_without_copying(bm, transcript):
+    buffer = bytearray(transcript.to_bytes())
+
+    restored = bm.Transcript.from_bytes(buffer)
+
+    assert all(column.obj is buffer for column in restored._columns.values())
+    # 直接修改缓冲区中的文本，视图立即可见
+    position = bytes(buffer).index("大家好".encode("utf-8"))
+    buffer[position:position + 9] = "大家早".encode("utf-8")
+    assert restored[0].text == "大家早"
+
+
+def test_from_bytes_rejects_other_formats(bm):
+    with pytest.raises(ValueError):
+        bm.Transcript.from_bytes(b'{"segments": []}')
+
+
+def test_restore_reads_legacy_json(bm):
+    restored = bm.Transcript.restore({"segments": [list(segment) for segment in SEGMENTS], "language": "zh"})
+
+    assert as_tuples(restored) == SEGMENTS
+    assert restored.source == "asr"
+
+
+def test_shifted_moves_segments_and_words(transcript):
+    shifted = transcript.shifted(60.0)
+
+    assert as_tuples(shifted) == [(start + 60.0, end + 60.0, text) for start, end, text in SEGMENTS]
+    assert shifted.words(1) == [(start + 60.0, end + 60.0, word) for start, end, word in WORDS[1]]
+    assert shifted.end == 69.5
+    # 文本缓冲区共享，原转录不变
+    assert shifted._columns["text"] is transcript._columns["text"]
+    assert as_tuples(transcript) == SEGMENTS
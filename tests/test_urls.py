@@ -0,0 +1,19 @@
+"""B站链接解析：同一视频分P的各种写法得到相同的缓存与合并请求的键"""
+import pytest
+
+
+@pytest.mark.parametrize("url, expected", [
+    ("https://www.bilibili.com/video/BV1xx411c7mD", ("BV1xx411c7mD", 1)),
+    ("https://www.bilibili.com/video/BV1xx411c7mD/?p=3&spm_id_from=333.788", ("BV1xx411c7mD", 3)),
+    ("https://www.bilibili.com/video/BV1xx411c7mD?p=0", ("BV1xx411c7mD", 1)),
+    ("https://www.bilibili.com/video/av170001?p=2", ("av170001", 2)),
+    ("BV1xx411c7mD_p4", ("BV1xx411c7mD", 4)),
+    ("https://example.com/watch", (None, 1)),
+])
+def test_parse_bilibili_url(bm, url, expected):
+    assert bm.parse_bilibili_url(url) == expected
+
+
+def test_canonicalize_part_zero_matches_default_part(bm):
+    assert bm.canonicalize_bilibili_url("https://www.bilibili.com/video/BV1xx411c7mD?p=0") == \
+        bm.canonicalize_bilibili_url("https://www.bilibili.com/video/BV1xx411c7mD/?vd_source=abc")